@@ -25,3 +25,7 @@ CFG_APSHARVEST_MD5_FILE = "manifest-md5.txt"
 CFG_APSHARVEST_FFT_DOCTYPE = "APS"
 CFG_APSHARVEST_BUNCH_SIZE = 100
 CFG_APSHARVEST_THRESHOLD_DAYS = 30
+CFG_APSHARVEST_STAGE_WORKERS = {'download': 2,
+                                'validate': 2,
+                                'convert': 4}
+CFG_APSHARVEST_QUEUE_SIZE = 50
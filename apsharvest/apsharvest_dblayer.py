@@ -20,6 +20,7 @@
 """xtrJOB db layer."""
 
 from invenio.dbquery import run_sql
+from invenio.apsharvest_config import CFG_APSHARVEST_RECORD_DOI_TAG
 from datetime import datetime
 
 
@@ -78,6 +79,28 @@ def get_all_modified_records(since, last_recid):
     return run_sql(sql, (since.isoformat(), last_recid))
 
 
+def get_recids_from_dois(dois, chunk_size=1000):
+    """
+    Get the record IDs of all the given DOIs in one query per chunk of
+    DOIs, straight from the DOI index table.
+
+    @return: dictionary of lowercased DOI to the set of its record IDs.
+    """
+    tag = CFG_APSHARVEST_RECORD_DOI_TAG
+    bibxxx = "bib%sx" % (tag[0:2],)
+    recids = {}
+    dois = list(set(dois))
+    for i in xrange(0, len(dois), chunk_size):
+        chunk = dois[i:i + chunk_size]
+        sql = "SELECT b.`value`, bb.`id_bibrec` FROM `%s` AS b " \
+            "JOIN `bibrec_%s` AS bb ON bb.`id_bibxxx` = b.`id` " \
+            "WHERE b.`tag` = %%s AND b.`value` IN (%s)" % \
+            (bibxxx, bibxxx, ",".join(["%s"] * len(chunk)))
+        for doi, recid in run_sql(sql, tuple([tag] + chunk)):
+            recids.setdefault(doi.lower(), set()).add(recid)
+    return recids
+
+
 def can_launch_bibupload(taskid):
     """
     Checks if task can be launched.
@@ -28,11 +28,14 @@ import datetime
 import shutil
 import time
 import traceback
+import threading
+import Queue
 
 from invenio.bibtask import (write_message,
                              task_sleep_now_if_required,
                              task_update_progress,
                              )
+from invenio.intbitset import intbitset
 from invenio.filedownloadutils import (download_url,
                                        InvenioFileDownloadError)
 
@@ -40,7 +43,7 @@ from invenio.apsharvest_utils import (create_records_from_file,
                                       create_records_from_string,
                                       create_work_folder,
                                       create_folders,
-                                      get_record_from_doi,
+                                      get_records_from_dois,
                                       get_doi_from_record,
                                       generate_xml_for_records,
                                       submit_records_via_ftp,
@@ -57,7 +60,9 @@ from invenio.apsharvest_utils import (create_records_from_file,
 from invenio.apsharvest_config import (CFG_APSHARVEST_FFT_DOCTYPE,
                                        CFG_APSHARVEST_REQUEST_TIMEOUT,
                                        CFG_APSHARVEST_FULLTEXT_URL,
-                                       CFG_APSHARVEST_MD5_FILE)
+                                       CFG_APSHARVEST_MD5_FILE,
+                                       CFG_APSHARVEST_STAGE_WORKERS,
+                                       CFG_APSHARVEST_QUEUE_SIZE)
 from invenio.apsharvest_dblayer import (store_last_updated,
                                         can_launch_bibupload)
 from invenio.apsharvest_errors import (APSHarvesterSearchError,
@@ -65,6 +70,7 @@ from invenio.apsharvest_errors import (APSHarvesterSearchError,
                                        APSHarvesterFileExits,
                                        APSHarvesterConversionError,
                                        APSFileChecksumError,
+                                       APSHarvesterStageError,
                                        )
 from invenio.docextract_record import (BibRecord,
                                        BibRecordControlField)
@@ -81,22 +87,135 @@ except ImportError:
     CFG_APSHARVEST_EMAIL = "desydoc@desy.de"
 
 
+
+class RequestThrottle(object):
+    """
+    Politeness towards the APS servers, shared by all the download workers.
+
+    As when downloading one record at a time, only one request is sent at
+    a time, and the next one waits as long as the previous one took (unless
+    it took longer than CFG_APSHARVEST_REQUEST_TIMEOUT). Every wait() must
+    be followed by a done() once the request is over.
+    """
+    def __init__(self, max_delay=CFG_APSHARVEST_REQUEST_TIMEOUT):
+        self.max_delay = max_delay
+        self.next_request = 0
+        # Held from wait() until done()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Wait until the next request may be sent."""
+        self.lock.acquire()
+        delay = self.next_request - time.time()
+        if delay > 0:
+            write_message("Initiating sleep for %.1f seconds"
+                          % (delay,), verbose=3)
+            time.sleep(delay)
+
+    def done(self, request_dt):
+        """Record the time a request took and let the next one go."""
+        write_message("Checking request time (%d)" % (request_dt,), verbose=3)
+        if request_dt > 0 and request_dt < self.max_delay:
+            self.next_request = time.time() + request_dt
+        else:
+            self.next_request = 0
+        self.lock.release()
+
+
+_STOP = object()
+
+
+def _stage_worker(function, inbox, outbox, running):
+    """Run function on the items of inbox and pass them on to outbox."""
+    while True:
+        item = inbox.get()
+        if item is _STOP:
+            # Let the other workers of the stage see it too
+            inbox.put(_STOP)
+            running[1].acquire()
+            try:
+                running[0] -= 1
+                if not running[0]:
+                    outbox.put(_STOP)
+            finally:
+                running[1].release()
+            return
+        record, data, error_message = item
+        if not error_message:
+            try:
+                data = function(record, data)
+            except APSHarvesterStageError, e:
+                error_message = str(e)
+            except StandardError, e:
+                error_message = "Unexpected error for %s: %s\n%s" % \
+                                (record.recid or record.doi, str(e),
+                                 traceback.format_exc()[:-1])
+                write_message(error_message, stream=sys.stderr)
+        outbox.put((record, data, error_message))
+
+
+def _feed_pipeline(items, outbox):
+    for item in items:
+        outbox.put((item, None, ""))
+    outbox.put(_STOP)
+
+
+def run_pipeline(items, stages, queue_size=CFG_APSHARVEST_QUEUE_SIZE):
+    """
+    Run every item through the given stages and yield (item, error_message)
+    as they come out of the last one.
+
+    Each stage is a (function, workers) tuple: function(item, data) is called
+    in `workers` threads with what the previous stage returned, and raises
+    APSHarvesterStageError to take the item out of the pipeline. Stages are
+    connected by queues of at most queue_size items, so a fast stage never
+    gets far ahead of a slow one.
+    """
+    queues = [Queue.Queue(queue_size) for dummy in range(len(stages) + 1)]
+    threads = [threading.Thread(target=_feed_pipeline, args=(items, queues[0]))]
+    for index, (function, workers) in enumerate(stages):
+        running = [max(workers, 1), threading.Lock()]
+        for dummy in range(running[0]):
+            threads.append(threading.Thread(target=_stage_worker,
+                                            args=(function, queues[index],
+                                                  queues[index + 1], running)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    results = queues[-1]
+    while True:
+        task_sleep_now_if_required(can_stop_too=False)
+        try:
+            # Do not block forever, so that bibsched signals get handled
+            item = results.get(True, 1.0)
+        except Queue.Empty:
+            continue
+        if item is _STOP:
+            break
+        record, dummy, error_message = item
+        yield record, error_message
+    for thread in threads:
+        thread.join()
+
+
 class APSRecordList(list):
     """
     Class representing the list of records to harvest.
     """
     def __init__(self):
         super(APSRecordList, self).__init__()
-        self.recids = []
+        self.recids = intbitset()
 
     def append(self, record):
         """
         Append a APSRecord to the list if it is not already there.
         """
-        if record.recid not in self.recids:
+        if not record.recid:
             super(APSRecordList, self).append(record)
-            if record.recid:
-                self.recids.append(record.recid)
+        elif int(record.recid) not in self.recids:
+            super(APSRecordList, self).append(record)
+            self.recids.add(int(record.recid))
 
 
 class APSHarvestJob(object):
@@ -110,6 +229,7 @@ class APSHarvestJob(object):
         self.out_folder = create_work_folder(directory)
         self.date_started = date_started or datetime.datetime.now()
         self.date_harvested_from = date_harvested_from
+        self.throttle = RequestThrottle()
         self.mail_subject = "APS harvest results: %s" % \
                             (self.date_started.strftime("%Y-%m-%d %H:%M:%S"),)
         from invenio.refextract_kbs import get_kbs
@@ -128,28 +248,21 @@ class APSHarvestJob(object):
         @return: a tuple of (new_records, existing_records)
         @rtype: tuple
         """
-        # We check if any records already exists
+        # We check if any records already exists, with one lookup for
+        # the DOIs of the whole bunch
         new_records = []
         existing_records = []
+        recids, mismatches = get_records_from_dois([record.doi for record in self.records_harvested
+                                                    if not record.recid and record.doi])
         for record in self.records_harvested:
             # Do we already have the record id perhaps?
-            if not record.recid:
-                try:
-                    record.recid = get_record_from_doi(record.doi)
-                except APSHarvesterSearchError, e:
-                    write_message("Error while getting recid from %s: %s" %
-                                  (record.doi, str(e)))
-
-                    # Problem detected, send mail immediately:
-                    problem_rec = generate_xml_for_records(records=[record],
-                                                           directory=self.out_folder,
-                                                           suffix="problem.xml")
-                    subject = "APS harvest problem: %s" % \
-                              (self.date_started.strftime("%Y-%m-%d %H:%M:%S"),)
-                    body = "There was a problem harvesting %s. \n %s \n Path: \n%s" % \
-                           (record.doi, str(e), problem_rec)
-                    submit_records_via_mail(subject, body, CFG_APSHARVEST_EMAIL)
+            if not record.recid and record.doi:
+                if record.doi in mismatches:
+                    error = APSHarvesterSearchError("DOI mismatch: %s did not find only 1 record: %s" %
+                                                    (record.doi, ",".join([str(recid) for recid in mismatches[record.doi]])))
+                    self.report_match_problem(record, error)
                     continue
+                record.recid = recids.get(record.doi)
 
             # What about now?
             if record.recid:
@@ -187,49 +300,59 @@ class APSHarvestJob(object):
         updated), yield a APSRecord with added FFT dictionary containing URL to
         fulltext/metadata XML downloaded locally.
 
+        The records go through the download, validate and convert stages,
+        each one with its own pool of workers as
+        given by parameters["workers"], so that a slow stage does not hold
+        back the others. Records are yielded in the order they are done.
+
         If a download is unsuccessful, an error message is given.
 
         @return: tuple of (APSRecord, error_message)
         """
-        count = 0
-        request_end = None
-        request_start = None
-        for record in record_list:
-            task_sleep_now_if_required(can_stop_too=False)
-            # Unless this is the first request, lets sleep a bit
-            if request_end and request_start:
-                request_dt = request_end-request_start
-                write_message("Checking request time (%d)"
-                              % (request_dt,), verbose=3)
-                if count and request_dt > 0 and request_dt < CFG_APSHARVEST_REQUEST_TIMEOUT:
-                    write_message("Initiating sleep for %.1f seconds"
-                                  % (request_dt,), verbose=3)
-                    time.sleep(request_dt)
+        workers = dict(CFG_APSHARVEST_STAGE_WORKERS)
+        workers.update(parameters.get("workers") or {})
+        stages = [(self.download_fulltext, workers['download']),
+                  (self.validate_fulltext, workers['validate']),
+                  (lambda record, data: self.convert_fulltext(record, data, parameters),
+                   workers['convert'])]
 
+        count = 0
+        for record, error_message in run_pipeline(record_list, stages):
             count += 1
             task_update_progress("Harvesting record (%d/%d)" % (count,
                                                                 len(record_list)))
+            if not error_message and record.date:
+                store_last_updated(record.recid, record.date, name="apsharvest")
+            yield record, error_message
 
-            if not record.doi:
-                msg = "No DOI found for record %d" % (record.recid or "",)
-                write_message("Error: %s" % (msg,), stream=sys.stderr)
-                yield record, msg
-                continue
-
-            url = CFG_APSHARVEST_FULLTEXT_URL % {'doi': record.doi}
-            result_file = os.path.join(self.zip_folder,
-                                       "%s.zip" % (record.doi.replace('/', '_')))
-            try:
-                request_start = time.time()
-                if os.path.exists(result_file):
-                    # File already downloaded recently, lets see if it is the same
-                    file_last_modified = get_file_modified_date(result_file)
-                    if record.last_modified and not compare_datetime_to_iso8601_date(file_last_modified, record.last_modified):
-                        # File is not older than APS version, we should not download.
-                        raise APSHarvesterFileExits
+    def download_fulltext(self, record, dummy):
+        """
+        Download stage: fetch the zipped fulltext package of the record,
+        unless the local copy is up to date.
 
-                write_message("Trying to save to %s" % (result_file,), verbose=5)
+        @return: path to the zip file.
+        """
+        if not record.doi:
+            msg = "No DOI found for record %s" % (record.recid or "",)
+            write_message("Error: %s" % (msg,), stream=sys.stderr)
+            raise APSHarvesterStageError(msg)
+
+        url = CFG_APSHARVEST_FULLTEXT_URL % {'doi': record.doi}
+        result_file = os.path.join(self.zip_folder,
+                                   "%s.zip" % (record.doi.replace('/', '_')))
+        if os.path.exists(result_file):
+            # File already downloaded recently, lets see if it is the same
+            file_last_modified = get_file_modified_date(result_file)
+            if record.last_modified and not compare_datetime_to_iso8601_date(file_last_modified, record.last_modified):
+                # File is not older than APS version, we should not download.
+                write_message("File exists at %s" % (result_file,), verbose=2)
+                return result_file
 
+        write_message("Trying to save to %s" % (result_file,), verbose=5)
+        self.throttle.wait()
+        request_start = time.time()
+        try:
+            try:
                 result_file = download_url(url=url,
                                            download_to_file=result_file,
                                            content_type="zip",
@@ -241,113 +364,126 @@ class APSHarvestJob(object):
                 msg = "URL could not be opened: %s" % (url,)
                 write_message("Error: %s" % (msg,),
                               stream=sys.stderr)
-                yield record, msg
-                continue
-
-            except APSHarvesterFileExits:
-                write_message("File exists at %s" % (result_file,), verbose=2)
-
+                raise APSHarvesterStageError(msg)
             except StandardError, e:
                 if 'urlopen' in str(e) or 'URL could not be opened' in str(e):
                     msg = "URL could not be opened: %s" % (url,)
                     write_message("Error: %s" % (msg,),
                                   stream=sys.stderr)
                     write_message("No fulltext found for %s" %
-                                 (record.recid or record.doi,))
-                    yield record, msg
-                    continue
+                                  (record.recid or record.doi,))
+                    raise APSHarvesterStageError(msg)
                 raise
-            finally:
-                request_end = time.time()
+        finally:
+            self.throttle.done(time.time() - request_start)
+        return result_file
 
-            # Unzip the compressed file
-            unzipped_folder = unzip(result_file, base_directory=self.out_folder)
+    def validate_fulltext(self, record, result_file):
+        """
+        Validate stage: unzip the package, check the MD5 checksums of its
+        files and the publication date of the article.
 
-            # Validate the checksum of the compressed fulltext file.
-            try:
-                checksum_validated_files = find_and_validate_md5_checksums(
-                    in_folder=unzipped_folder,
-                    md5key_filename=CFG_APSHARVEST_MD5_FILE)
-            except APSFileChecksumError, e:
-                info_msg = "Skipping %s in %s" % \
-                           (record.recid or record.doi, unzipped_folder)
-                msg = "Error while validating checksum: %s\n%s\n%s" % \
-                      (info_msg, str(e), traceback.format_exc()[:-1])
-                write_message(msg)
-                yield record, msg
-                continue
-            if not checksum_validated_files:
-                write_message("Warning: No files found to perform checksum"
-                              " validation on inside %s" % (unzipped_folder,))
-                continue
-            elif not [name for name in checksum_validated_files if name.endswith('fulltext.xml')]:
-                msg = "Warning: No fulltext file found inside %s for %s" % \
-                      (unzipped_folder, record.recid or record.doi)
-                write_message(msg)
-                yield record, msg
-                continue
-
-            # We have the fulltext file as fulltext.xml as expected.
-            fulltext_file = [name for name in checksum_validated_files if name.endswith('fulltext.xml')][0]
-
-            write_message("Harvested record %s (%s)" %
-                         (record.recid or "new record", count))
-            write_message("File: %s" % (fulltext_file,), verbose=2)
-
-            # Check if published date is after threshold:
-            if is_beyond_threshold_date(parameters.get("threshold_date"), fulltext_file):
-                # The published date is beyond the threshold, we continue
-                msg = "Warning: Article published beyond threshold: %s" % \
-                      (record.doi,)
-                write_message(msg)
-                yield record, msg
-                continue
-            else:
-                write_message("OK. Record is below the threshold.", verbose=3)
+        @return: path to the fulltext XML file.
+        """
+        unzipped_folder = unzip(result_file, base_directory=self.out_folder)
+
+        # Validate the checksum of the compressed fulltext file.
+        try:
+            checksum_validated_files = find_and_validate_md5_checksums(
+                in_folder=unzipped_folder,
+                md5key_filename=CFG_APSHARVEST_MD5_FILE)
+        except APSFileChecksumError, e:
+            info_msg = "Skipping %s in %s" % \
+                       (record.recid or record.doi, unzipped_folder)
+            msg = "Error while validating checksum: %s\n%s\n%s" % \
+                  (info_msg, str(e), traceback.format_exc()[:-1])
+            write_message(msg)
+            raise APSHarvesterStageError(msg)
+        if not checksum_validated_files:
+            msg = "Warning: No files found to perform checksum" \
+                  " validation on inside %s" % (unzipped_folder,)
+            write_message(msg)
+            raise APSHarvesterStageError(msg)
+        fulltext_files = [name for name in checksum_validated_files if name.endswith('fulltext.xml')]
+        if not fulltext_files:
+            msg = "Warning: No fulltext file found inside %s for %s" % \
+                  (unzipped_folder, record.recid or record.doi)
+            write_message(msg)
+            raise APSHarvesterStageError(msg)
+
+        # We have the fulltext file as fulltext.xml as expected.
+        fulltext_file = fulltext_files[0]
+        write_message("Harvested record %s" % (record.recid or "new record",))
+        write_message("File: %s" % (fulltext_file,), verbose=2)
+        return fulltext_file
+
+    def convert_fulltext(self, record, fulltext_file, parameters):
+        """
+        Convert stage: add the metadata and the FFT of the fulltext file
+        to the record.
+        """
+        # Check if published date is after threshold:
+        if is_beyond_threshold_date(parameters.get("threshold_date"), fulltext_file):
+            # The published date is beyond the threshold, we continue
+            msg = "Warning: Article published beyond threshold: %s" % \
+                  (record.doi,)
+            write_message(msg)
+            raise APSHarvesterStageError(msg)
+        else:
+            write_message("OK. Record is below the threshold.", verbose=3)
 
-            if parameters.get("metadata"):
-                from harvestingkit.aps_package import (ApsPackage,
-                                                       ApsPackageXMLError)
-                # Generate Metadata,FFT and yield it
-                aps = ApsPackage(self.journal_mappings)
+        if parameters.get("metadata"):
+            from harvestingkit.aps_package import (ApsPackage,
+                                                   ApsPackageXMLError)
+            # Generate Metadata,FFT and yield it
+            aps = ApsPackage(self.journal_mappings)
+            try:
+                xml = aps.get_record(fulltext_file)
+                record.add_metadata_by_string(xml)
+            except ApsPackageXMLError, e:
+                # This must be old-format XML
+                write_message("Warning: old-style metadata detected for %s" %
+                              (fulltext_file))
+                # Remove any DTD info in the file before converting
+                cleaned_fulltext_file = remove_dtd_information(fulltext_file)
                 try:
-                    xml = aps.get_record(fulltext_file)
-                    record.add_metadata_by_string(xml)
-                except ApsPackageXMLError, e:
-                    # This must be old-format XML
-                    write_message("Warning: old-style metadata detected for %s" %
-                                  (fulltext_file))
-                    # Remove any DTD info in the file before converting
-                    cleaned_fulltext_file = remove_dtd_information(fulltext_file)
-                    try:
-                        convert_xml_using_saxon(cleaned_fulltext_file,
-                                                CFG_APSHARVEST_XSLT)
-
-                        # Conversion is a success. Let's derive location of converted file
-                        source_directory = os.path.dirname(cleaned_fulltext_file)
-                        path_to_converted = "%s%s%s.xml" % \
-                                            (source_directory,
-                                             os.sep,
-                                             record.doi.replace('/', '_'))
-                        write_message("Converted meta-data for %s" %
-                                     (record.recid or "new record"), verbose=2)
-                        record.add_metadata(path_to_converted)
-                    except APSHarvesterConversionError, e:
-                        msg = "Metadata conversion failed: %s\n%s" % \
-                              (str(e), traceback.format_exc()[:-1])
-                        write_message(msg, stream=sys.stderr)
-                        yield record, msg
-
-                write_message("Converted metadata for %s" %
-                              (record.recid or "new record"), verbose=2)
-
-            if parameters.get("fulltext"):
-                record.add_fft(fulltext_file, parameters.get("hidden"))
-
-            if record.date:
-                store_last_updated(record.recid, record.date, name="apsharvest")
-
-            yield record, ""
+                    convert_xml_using_saxon(cleaned_fulltext_file,
+                                            CFG_APSHARVEST_XSLT)
+                except APSHarvesterConversionError, e:
+                    msg = "Metadata conversion failed: %s\n%s" % \
+                          (str(e), traceback.format_exc()[:-1])
+                    write_message(msg, stream=sys.stderr)
+                    raise APSHarvesterStageError(msg)
+
+                # Conversion is a success. Let's derive location of converted file
+                source_directory = os.path.dirname(cleaned_fulltext_file)
+                path_to_converted = "%s%s%s.xml" % \
+                                    (source_directory,
+                                     os.sep,
+                                     record.doi.replace('/', '_'))
+                record.add_metadata(path_to_converted)
+
+            write_message("Converted metadata for %s" %
+                          (record.recid or "new record"), verbose=2)
+
+        if parameters.get("fulltext"):
+            record.add_fft(fulltext_file, parameters.get("hidden"))
+        return fulltext_file
+
+    def report_match_problem(self, record, error):
+        """Send a mail about a record whose DOI could not be matched."""
+        write_message("Error while getting recid from %s: %s" %
+                      (record.doi, str(error)))
+
+        # Problem detected, send mail immediately:
+        problem_rec = generate_xml_for_records(records=[record],
+                                               directory=self.out_folder,
+                                               suffix="problem.xml")
+        subject = "APS harvest problem: %s" % \
+                  (self.date_started.strftime("%Y-%m-%d %H:%M:%S"),)
+        body = "There was a problem harvesting %s. \n %s \n Path: \n%s" % \
+               (record.doi, str(error), problem_rec)
+        submit_records_via_mail(subject, body, CFG_APSHARVEST_EMAIL)
 
     def process_record_submission(self, parameters):
         """Run the submission process."""
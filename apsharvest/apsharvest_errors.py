@@ -54,3 +54,9 @@ class APSHarvesterFileExits(Exception):
     """Exception raised when local file is the newest.
     """
     pass
+
+
+class APSHarvesterStageError(Exception):
+    """Exception raised by a harvesting stage when a record cannot go further.
+    """
+    pass
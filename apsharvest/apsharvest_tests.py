@@ -25,6 +25,7 @@ The tests will not modifiy the database.
 
 import unittest
 import zipfile
+import time
 from invenio.config import CFG_TMPSHAREDDIR
 import os
 from invenio.testutils import make_test_suite, run_test_suite
@@ -36,6 +37,10 @@ from invenio.apsharvest_utils import (unzip,
                                       compare_datetime_to_iso8601_date)
 from invenio.bibdocfile import calculate_md5_external
 from invenio.bibsched_tasklets.bst_apsharvest import APSRecord, APSRecordList
+from invenio import apsharvest_engine
+from invenio.apsharvest_engine import run_pipeline, RequestThrottle, APSHarvestJob
+from invenio.httpstubutils import HTTPStubServer
+from invenio.apsharvest_errors import APSHarvesterStageError
 
 
 def get_files_and_folders(in_folder):
@@ -115,6 +120,64 @@ class APSRecordTest(unittest.TestCase):
         self.assertEqual(1, len(l))
 
 
+class PipelineTest(unittest.TestCase):
+    def test_all_records_go_through(self):
+        records = [APSRecord(recid, doi="dummy%d" % recid) for recid in range(1, 51)]
+
+        def double(record, data):
+            return record.recid * 2
+
+        def check(record, data):
+            if data % 3 == 0:
+                raise APSHarvesterStageError("multiple of 3")
+            return data
+
+        results = dict((record.recid, error) for record, error in
+                       run_pipeline(records, [(double, 3), (check, 2)], queue_size=2))
+        self.assertEqual(50, len(results))
+        self.assertEqual("multiple of 3", results[3])
+        self.assertEqual("", results[4])
+
+    def test_throttle(self):
+        throttle = RequestThrottle(max_delay=1.0)
+        throttle.wait()
+        throttle.done(0.2)
+        start = time.time()
+        throttle.wait()
+        self.assertTrue(time.time() - start >= 0.15)
+        # Slow requests do not delay the next one
+        throttle.done(5.0)
+        start = time.time()
+        throttle.wait()
+        self.assertTrue(time.time() - start < 0.1)
+        throttle.done(5.0)
+
+    def test_throttled_downloads(self):
+        """concurrent download workers still send one request at a time"""
+        zipped = get_temporary_file(prefix="aps_", suffix=".zip")
+        z = zipfile.ZipFile(zipped, 'w')
+        z.writestr("dummy.txt", "dummy")
+        z.close()
+        body = open(zipped, 'rb').read()
+        os.remove(zipped)
+        server = HTTPStubServer(lambda path: (200, 'application/zip', body), delay=0.2)
+        server.start()
+        fulltext_url = apsharvest_engine.CFG_APSHARVEST_FULLTEXT_URL
+        apsharvest_engine.CFG_APSHARVEST_FULLTEXT_URL = server.url + "/%(doi)s"
+        try:
+            job = APSHarvestJob(os.path.join(CFG_TMPSHAREDDIR, "apsharvest_tests"))
+            records = [APSRecord(None, doi="10.1103/Dummy.%d" % i) for i in range(3)]
+            results = list(run_pipeline(records, [(job.download_fulltext, 2)]))
+        finally:
+            apsharvest_engine.CFG_APSHARVEST_FULLTEXT_URL = fulltext_url
+            server.stop()
+        self.assertEqual([""] * 3, [error for dummy, error in results])
+        self.assertEqual(1, server.max_in_flight)
+        for (start1, end1), (start2, dummy) in zip(server.requests, server.requests[1:]):
+            # The next request waits as long as the previous one took
+            self.assertTrue(start2 - end1 >= (end1 - start1) * 0.9)
+
+
 class APSUtilsTest(unittest.TestCase):
     def test_date_validation(self):
         self.assertTrue(validate_date("2012-12-12"))
@@ -135,7 +198,7 @@ class APSUtilsTest(unittest.TestCase):
         self.assertFalse(compare_datetime_to_iso8601_date(file_last_modified,
                                                           comparison_date))
 
-TEST_SUITE = make_test_suite(FileTest, APSRecordTest, APSUtilsTest)
+TEST_SUITE = make_test_suite(FileTest, APSRecordTest, PipelineTest, APSUtilsTest)
 
 if __name__ == '__main__':
     run_test_suite(TEST_SUITE)
@@ -43,6 +43,7 @@ from invenio.apsharvest_errors import (APSHarvesterSearchError,
                                        APSFileChecksumError,
                                        APSHarvesterConversionError)
 from invenio.apsharvest_config import CFG_APSHARVEST_RECORD_DOI_TAG
+from invenio.apsharvest_dblayer import get_recids_from_dois
 from harvestingkit.ftp_utils import FtpHandler
 
 
@@ -364,6 +365,32 @@ def get_record_from_doi(doi):
     return int(recids[0])
 
 
+def get_records_from_dois(dois):
+    """
+    Bulk version of get_record_from_doi: match all the given DOIs at once.
+
+    @param dois: DOI identifiers to match records against
+    @type dois: list
+
+    @return: tuple of (recids, mismatches) where recids maps every DOI
+             found on exactly one record to its record ID and mismatches
+             maps every DOI found on several records to their record IDs.
+    @rtype: tuple
+    """
+    found = get_recids_from_dois(dois)
+    recids = {}
+    mismatches = {}
+    for doi in dois:
+        doi_recids = found.get(doi.lower())
+        if not doi_recids:
+            continue
+        elif len(doi_recids) != 1:
+            mismatches[doi] = sorted(doi_recids)
+        else:
+            recids[doi] = int(list(doi_recids)[0])
+    return recids, mismatches
+
+
 def get_doi_from_record(recid):
     """
     Given a record ID we fetch it from the DB and return
@@ -26,11 +26,123 @@ raw pubnote in the raw-reference
 ambigous INSPIRE search (journal, year, artid) + confirmation by author or title
 
 Clear cases will be corrected automatically, others flagged.
+
+For full reruns build_offline_tables() loads once the (journal, volume,
+artid) and (journal, year, artid) tables of JHEP, JCAP, PTEP and
+J.Stat.Mech. together with author/title fingerprints of their articles.
+The searches below are then answered from memory, and
+analyse_refs_in_parallel() spreads analyse_refs over a process pool.
 """
 
 import re
+from itertools import islice
+from multiprocessing import Pool
+
 from invenio.search_engine import (get_fieldvalues, get_record,
-                                   perform_request_search)
+                                   perform_request_search, search_pattern)
+from invenio.recidindexutils import get_field_values
+from invenio.referenceresolver import (get_reference_resolver, normalize_doi,
+                                       normalize_reportnumber)
+
+CFG_OFFLINE_JOURNALS = ('JHEP', 'JCAP', 'PTEP', 'J.Stat.Mech.')
+
+# Filled by build_offline_tables()
+OFFLINE_JOURNALS = set()
+PUBNOTE_TABLE = {}   # (journal, volume, artid) -> set of recids
+YEAR_TABLE = {}      # (journal, year, artid) -> set of recids
+VOLUME_ARTIDS = {}   # (journal, volume) -> list of (artid, recid)
+RECORD_PUBNOTES = {} # recid -> list of pbn dicts
+FINGERPRINTS = {}    # recid -> {tag: values} for the confirmation tags
+
+# Enough authors to tell 'Too many authors' and to check the first three
+FINGERPRINT_AUTHORS = 9
+
+
+def build_offline_tables(journals=CFG_OFFLINE_JOURNALS, debug=False):
+    """
+    Load the pubnotes of all the articles of the given journals,
+    and the authors, collaborations and titles needed to confirm them.
+    """
+    wanted = set(journal.lower() for journal in journals)
+    recids = set()
+    for journal in journals:
+        recids |= set(search_pattern(p='773__p:"%s"' % journal))
+    recids = sorted(recids)
+    if debug:
+        print 'Building offline tables for %s records' % len(recids)
+
+    for chunk_start in xrange(0, len(recids), 1000):
+        chunk = recids[chunk_start:chunk_start + 1000]
+
+        fields = {}
+        for recid, field_number, tag, value in get_field_values(['773__p', '773__v', '773__c', '773__y', '773__x'], chunk):
+            fields.setdefault((recid, field_number), {'y': ''})[tag[-1]] = value
+        for (recid, dummy), pbn in sorted(fields.iteritems()):
+            if 'p' in pbn and 'v' in pbn and 'c' in pbn:
+                RECORD_PUBNOTES.setdefault(recid, []).append(pbn)
+            journal = pbn.get('p', '').lower()
+            if journal not in wanted:
+                continue
+            volume, artid, year = pbn.get('v'), pbn.get('c'), pbn['y']
+            if volume and artid:
+                PUBNOTE_TABLE.setdefault((journal, volume, artid), set()).add(recid)
+                VOLUME_ARTIDS.setdefault((journal, volume), []).append((artid, recid))
+            if year and artid:
+                YEAR_TABLE.setdefault((journal, year, artid), set()).add(recid)
+
+        authors = {}
+        for tag in ('100__a', '700__a'):
+            for recid, field_number, dummy, value in sorted(get_field_values([tag], chunk)):
+                if len(authors.setdefault(recid, [])) < FINGERPRINT_AUTHORS:
+                    authors[recid].append(value)
+        for recid in chunk:
+            FINGERPRINTS[recid] = {'authors': authors.get(recid, []),
+                                   '710__g': [],
+                                   '245__a': []}
+        for tag in ('710__g', '245__a'):
+            for recid, field_number, dummy, value in sorted(get_field_values([tag], chunk)):
+                FINGERPRINTS[recid][tag].append(value)
+    OFFLINE_JOURNALS.update(wanted)
+
+
+def get_candidate_fieldvalues(candidate, tag):
+    """ get_fieldvalues answered from the fingerprints when possible """
+    fingerprint = FINGERPRINTS.get(candidate)
+    if fingerprint is None:
+        return get_fieldvalues(candidate, tag)
+    return fingerprint[tag]
+
+
+def get_candidate_authors(candidate):
+    """ first authors of candidate, enough for confirm_by_authors """
+    fingerprint = FINGERPRINTS.get(candidate)
+    if fingerprint is None:
+        return get_fieldvalues(candidate, '100__a') + get_fieldvalues(candidate, '700__a')
+    return fingerprint['authors']
+
+
+def search_pubnote(journal, artid, volume=None, year=None):
+    """
+    773__p:"journal" and 773__c:"artid" and 773__v:"volume" (or 773__y:"year")
+    answered from the offline tables for the journals they hold
+    """
+    if journal.lower() in OFFLINE_JOURNALS:
+        if volume is not None:
+            return list(PUBNOTE_TABLE.get((journal.lower(), volume, artid), ()))
+        return list(YEAR_TABLE.get((journal.lower(), year, artid), ()))
+    if volume is not None:
+        pattern = '773__p:"%s" and 773__c:"%s" and 773__v:"%s"' % (journal, artid, volume)
+    else:
+        pattern = '773__p:"%s" and 773__c:"%s" and 773__y:"%s"' % (journal, artid, year)
+    return perform_request_search(p=pattern)
+
+
+def search_identifier(key, pattern):
+    """ search a DOI or report number, in the reference resolver if built """
+    resolver = get_reference_resolver()
+    if resolver is not None:
+        return list(resolver.get(key))
+    return perform_request_search(p=pattern)
 
 
 def parse_ref(markfield):
@@ -198,7 +310,7 @@ def confirm_by_collaboration(text, candidate):
     ok = 0
     confirmation_reason = ''
 
-    collaborations = get_fieldvalues(candidate, '710__g')
+    collaborations = get_candidate_fieldvalues(candidate, '710__g')
     for collaboration in collaborations:
         if collaboration.lower() in text:
             ok += 1
@@ -215,7 +327,7 @@ def confirm_by_authors(text, candidate):
     If the cited record has more than 8 authors
     most likely only the first is given in the reference (et.al.)
     """
-    authors = get_fieldvalues(candidate, '100__a') + get_fieldvalues(candidate, '700__a')
+    authors = get_candidate_authors(candidate)
     if len(authors) > 8:
         confirmation_reason = 'Too many authors'
     else:
@@ -244,7 +356,7 @@ def confirm_by_title(text, candidate):
     Confirmed if all good title words are in text, at least 2 good words
     Return reason - result of confirmation analysis
     """
-    titles = get_fieldvalues(candidate, '245__a')
+    titles = get_candidate_fieldvalues(candidate, '245__a')
     title_words = []
     if titles:
         for word in titles[0].split(' '):
@@ -268,13 +380,13 @@ def get_citation_from_doi(doi):
     """ search for DOI, return recid if exactly one result"""
     recid_citation = None
     if doi:
-        candidates = perform_request_search(p='doi:%s' % doi)
+        candidates = search_identifier('doi:' + normalize_doi(doi), 'doi:%s' % doi)
         if len(candidates) == 1:
             recid_citation = candidates[0]
         elif not candidates:
             # check for trailing ';' or ')'
             if doi[-1] in [';', ','] or (doi[-1] == ')' and doi.find('(') < 0):
-                candidates = perform_request_search(p='doi:%s' % doi[:-1])
+                candidates = search_identifier('doi:' + normalize_doi(doi[:-1]), 'doi:%s' % doi[:-1])
                 if len(candidates) == 1:
                     recid_citation = candidates[0]
     return recid_citation
@@ -284,7 +396,7 @@ def get_citation_from_repno(repno):
     """ search for report number, return recid if exactly one result"""
     recid_citation = None
     if repno:
-        candidates = perform_request_search(p='reportnumber:%s' % repno)
+        candidates = search_identifier('repno:' + normalize_reportnumber(repno), 'reportnumber:%s' % repno)
         if len(candidates) == 1:
             recid_citation = candidates[0]
     return recid_citation
@@ -323,7 +435,7 @@ def get_citation_for_PTEP(ref_pbn, text, debug):
         true_artid = search_res.group(1)
         pubnote = '%s,%s,%s' % (journal, year, true_artid)
         pattern = '773__p:"%s" and 773__c:"%s" and 773__v:"%s"' % (journal, true_artid, year)
-        candidates = perform_request_search(p=pattern)
+        candidates = search_pubnote(journal, true_artid, volume=year)
         if debug:
             print '    found %s candidates for pbn %s' % (len(candidates), pattern)
         if len(candidates) == 1:
@@ -365,7 +477,7 @@ def get_citation_for_JHEP(ref_pbn, text, debug):
                 true_artid = '%03i' % int(true_artid)
                 pubnote = '%s,%s%s,%s' % (journal, year[-2:], month, true_artid)
                 pattern = '773__p:"%s" and 773__c:"%s" and 773__v:"%s%s"' % (journal, true_artid, year[-2:], month)
-                candidates = perform_request_search(p=pattern)
+                candidates = search_pubnote(journal, true_artid, volume=year[-2:] + month)
                 if debug:
                     print '    found %s candidates for pbn %s' % (len(candidates), pattern)
                 if len(candidates) == 1:
@@ -419,6 +531,9 @@ def get_candidates_by_artid_substring(ref_pbn, debug):
     volume = ref_pbn['v']
     artid = ref_pbn['c']
 
+    if journal.lower() in OFFLINE_JOURNALS:
+        return [recid for candidate_artid, recid in VOLUME_ARTIDS.get((journal.lower(), volume), ())
+                if artid in candidate_artid]
     pattern = "773__p:%s and 773__c:'%s' and 773__v:%s" % (journal, artid, volume)
     if debug:
         print pattern
@@ -439,14 +554,11 @@ def get_candidates_by_journal_year_artid(ref_pbn):
     if volume and artid:
         year = guess_year(ref_pbn)
         # maybe it's correct - make it Y2020 complient and add the correct search to candidates
-        pattern = '773__p:"%s" and 773__c:"%s" and 773__v:"%s"' % (journal, artid, volume)
-        candidates = perform_request_search(p=pattern)
+        candidates = search_pubnote(journal, artid, volume=volume)
         # maybe it's mixed up - switch volume and artid
-        pattern = '773__p:"%s" and 773__c:"%s" and 773__v:"%s"' % (journal, volume, artid)
-        candidates += perform_request_search(p=pattern)
+        candidates += search_pubnote(journal, volume, volume=artid)
         # ignore the potentially wrong volume, use only the year
-        pattern = '773__p:"%s" and 773__c:"%s" and 773__y:"%s"' % (journal, artid, year)
-        candidates += perform_request_search(p=pattern)
+        candidates += search_pubnote(journal, artid, year=year)
     return set(candidates)
 
 
@@ -507,6 +619,8 @@ def pubnotes_from_recid(recid, debug=False):
     return journal pubnotes as list of dicts
     if there are at least p,v,c
     """
+    if recid in RECORD_PUBNOTES:
+        return [dict(pbn) for pbn in RECORD_PUBNOTES[recid]]
     record = get_record(recid)
     pbns = []
     pubnotes = record.get('773', [])
@@ -686,6 +800,39 @@ def analyse_refs(recid, debug):
     return text, log_text
 
 
+def analyse_refs_chunk(args):
+    """ analyse_refs for a chunk of recids, run in a worker process """
+    recids, debug = args
+    return [analyse_refs(recid, debug) for recid in recids]
+
+
+def analyse_refs_in_parallel(recids, debug=False, processes=4, chunk_size=50):
+    """
+    analyse_refs for all recids, spread over a pool of processes.
+    Call build_offline_tables() first: the workers inherit the tables.
+    Return an iterator of (xml text, log text), in the order of recids.
+    """
+    def get_chunks():
+        iterator = iter(recids)
+        while True:
+            chunk = list(islice(iterator, chunk_size))
+            if not chunk:
+                return
+            yield chunk, debug
+
+    pool = Pool(processes)
+    try:
+        for results in pool.imap(analyse_refs_chunk, get_chunks()):
+            for result in results:
+                yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
 def get_recids_startpbn(bad_references):
     """ looking for references starting with ... """
     recids = []
@@ -752,8 +899,8 @@ def main():
     xmlfile = codecs.EncodedFile(codecs.open('fix_ref.%s.xml' % journal, mode='wb'), 'utf8')
     xmlfile.write('<?xml version="1.0" encoding="UTF-8"?>\n<collection>\n')
 
-    for recid in recids:
-        text, log_text = analyse_refs(recid, debug)
+    build_offline_tables(debug=debug)
+    for text, log_text in analyse_refs_in_parallel(recids, debug):
         logfile.write(log_text)
         if text:
             xmlfile.write(text+'\n')
@@ -20,6 +20,10 @@
 
 """ Bibcheck plugin checking that reference info in 999C50 agrees with
     citation info in 999C5r and 999C5s
+
+    In batch mode (check_records) the distinct pubnotes, report numbers and
+    DOIs of the whole chunk of records are searched once up front, and the
+    resulting hitsets are shared by all the references quoting them.
 """
 
 import re
@@ -28,6 +32,7 @@ from collections import defaultdict, namedtuple
 from invenio.intbitset import intbitset
 from invenio.search_engine import (get_collection_reclist, search_pattern,
                                    search_unit)
+from invenio.recidindexutils import LRUCache
 
 Reftags = namedtuple('Reftags', 'pubnote repno DOI citedrecid curatorflag')
 FIELDS = Reftags('999C5s', '999C5r', '999C5a', '999C50', '999C59')
@@ -38,6 +43,31 @@ HEPRECS = get_collection_reclist('HEP')
 CATEGORY = re.compile(ur'^(.*)\[[^\]]+\]')
 ARXIVPREFIX = re.compile(ur'^(arXiv:(\s+)?)\D', re.I)
 
+# Hitsets of popular references are shared across chunks of records
+HITSET_CACHE = LRUCache(500000)
+
+
+def search_reference_value(key, val):
+    """ perform key appropriate search for a single value """
+    if key == 'pubnote':
+        hits = search_pattern(f='journal', p=val, ap=1)
+    elif key == 'repno':
+        hits = search_unit(f='reportnumber', p=val)
+    elif key == 'DOI':
+        hits = search_unit(f='doi', p=val, m='a')
+    else:
+        hits = intbitset()
+    return hits & HEPRECS
+
+
+def get_value_hitset(key, val):
+    """ return the (cached) HEP hitset of a single reference value """
+    hits = HITSET_CACHE.get((key, val))
+    if hits is None:
+        hits = search_reference_value(key, val)
+        HITSET_CACHE[(key, val)] = hits
+    return hits
+
 
 class Reference(object):
     """ container for various ref info """
@@ -95,17 +125,9 @@ class Reference(object):
         if pos is None:
             pos = slice(None, None)
         hits = intbitset()
-        if key == 'pubnote':
-            for val in self._fields[key][pos]:
-                hits |= search_pattern(f='journal', p=val, ap=1)
-        elif key == 'repno':
-            for val in self._fields[key][pos]:
-                hits |= search_unit(f='reportnumber', p=val)
-        elif key == 'DOI':
-            for val in self._fields[key][pos]:
-                hits |= search_unit(f='doi', p=val, m='a')
-
-        return hits & HEPRECS
+        for val in self._fields[key][pos]:
+            hits |= get_value_hitset(key, val)
+        return hits
 
 
     def stringify(self):
@@ -117,16 +139,44 @@ class Reference(object):
         return ', '.join(refstring)
 
 
-def check_record(record):
-    """ check internal consistency of references """
-
+def get_references(record):
+    """ group the 999C5 subfields of record by reference """
     references = defaultdict(Reference)
 
     for pos, val in record.iterfield('999C5%'):
         for name in FIELDS._fields:
             if pos[0] == FIELDS.__getattribute__(name):
                 references[pos[1]].add_info(name, val)
+    return references
+
+
+def check_records(records):
+    """ check internal consistency of references of a chunk of records
+
+    All distinct values are resolved before the first record is checked.
+    """
+    records = list(records)
+    all_references = [get_references(record) for record in records]
+
+    distinct = set()
+    for references in all_references:
+        for ref in references.itervalues():
+            for key in FIELDS._fields[:3]:
+                distinct.update((key, val) for val in ref.get_all_info(key))
+    for key, val in distinct:
+        get_value_hitset(key, val)
+
+    for record, references in zip(records, all_references):
+        check_references(record, references)
+
+
+def check_record(record):
+    """ check internal consistency of references """
+    check_references(record, get_references(record))
+
 
+def check_references(record, references):
+    """ report inconsistencies between the references of record """
     for pos, ref in references.iteritems():
         allhits = [(k, ref.get_hitset(k)) for k in FIELDS._fields[:3]]
         for k, hits in allhits:
@@ -25,15 +25,167 @@ dump from SPIRES.
 -X:  erase all previously created split files (otherwise pick up
 -numbering where you left off)
 -n:  number of records in a chunk (default 1000)
--c:  (deprecated) run clean-spires-data.sh
+-b:  maximum number of bytes in a chunk (default: no limit); a chunk is
+     closed as soon as either limit is reached
+-c:  run clean-spires-data.sh on every finished chunk
+-j:  number of chunks cleaned in parallel (default 4)
+-r:  re-create (and clean with -c) only the given chunk, using the
+     manifest of a previous run
 
-Output: many small "<input_filename>_000234" files
+Output: many small "<input_filename>_000234" files, named after the number
+of records written so far, and "<input_filename>.manifest" listing for
+each chunk its record count and its byte offsets in the input file.
+
+The input is scanned as a stream for </goal_record> end tags, whatever the
+whitespace around them. Raw SPIRES dumps are not always well-formed XML
+(this is what clean-spires-data.sh is for), so no XML parser is used.
 """
 
 import getopt
 import sys
 import re
 import os
+import json
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+RE_RECORD_END = re.compile(r'<\s*/\s*goal_record\s*>', re.I)
+READ_SIZE = 1024 * 1024
+
+
+def iter_records(input_file):
+    """
+    Yield the byte offset of the end of every record of input_file.
+
+    The file is read by blocks, so memory usage does not depend on the
+    size of the dump.
+    """
+    buf = ''
+    buf_offset = 0
+    while True:
+        block = input_file.read(READ_SIZE)
+        if not block:
+            return
+        buf += block
+        last_end = 0
+        for match in RE_RECORD_END.finditer(buf):
+            last_end = match.end()
+            yield buf_offset + last_end
+        # Keep enough to catch an end tag split between two blocks
+        keep_from = max(last_end, len(buf) - 64)
+        buf_offset += keep_from
+        buf = buf[keep_from:]
+
+
+def copy_range(input_file, out, start, end):
+    """Copy the bytes [start, end) of input_file to out."""
+    input_file.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        block = input_file.read(min(READ_SIZE, remaining))
+        if not block:
+            break
+        out.write(block)
+        remaining -= len(block)
+
+
+def write_chunk(input_filename, chunk):
+    """Write the chunk described by a manifest entry."""
+    input_file = open(input_filename, "rb")
+    out = open(chunk['file'], "wb")
+    if chunk['start'] > 0:
+        out.write("<records>")
+    copy_range(input_file, out, chunk['start'], chunk['end'])
+    if not chunk['last']:
+        out.write("\n</records>")
+    out.close()
+    input_file.close()
+
+
+def clean_chunk(filename):
+    """Run clean-spires-data.sh on filename, writing filename.clean."""
+    stdin = open(filename, "rb")
+    stdout = open(filename + ".clean", "wb")
+    try:
+        return subprocess.call(["sh", "clean-spires-data.sh"], stdin=stdin, stdout=stdout)
+    finally:
+        stdin.close()
+        stdout.close()
+
+
+def write_manifest(manifest_path, manifest):
+    out = open(manifest_path + ".tmp", "w")
+    json.dump(manifest, out, indent=2)
+    out.close()
+    os.rename(manifest_path + ".tmp", manifest_path)
+
+
+def split(input_filename, nb_records, nb_records_in_chunk, max_bytes_in_chunk, clean, jobs):
+    """
+    Split input_filename in chunks, cleaning the finished chunks in a
+    pool of jobs threads while the input is still being scanned.
+    """
+    manifest_path = input_filename + ".manifest"
+    manifest = {'input': input_filename, 'chunks': []}
+    pool = clean and ThreadPool(jobs) or None
+    pending = []
+
+    def close_chunk(start, end, records, last_record, last=False):
+        chunk = {'file': "%s_%09d" % (input_filename, last_record),
+                 'first_record': last_record - records + 1,
+                 'records': records,
+                 'start': start,
+                 'end': end,
+                 'last': last}
+        write_chunk(input_filename, chunk)
+        manifest['chunks'].append(chunk)
+        write_manifest(manifest_path, manifest)
+        if pool is not None:
+            pending.append((chunk['file'], pool.apply_async(clean_chunk, (chunk['file'], ))))
+        print last_record
+
+    input_file = open(input_filename, "rb")
+    start = 0
+    records = 0
+    # A full chunk is only closed once another record comes: if none does,
+    # it is the last chunk and goes on to the end of the file.
+    full_chunk = None
+    for end in iter_records(input_file):
+        if full_chunk:
+            close_chunk(*full_chunk)
+            full_chunk = None
+        nb_records += 1
+        records += 1
+        if records == nb_records_in_chunk or \
+           (max_bytes_in_chunk and end - start >= max_bytes_in_chunk):
+            full_chunk = (start, end, records, nb_records)
+            start = end
+            records = 0
+    input_file.seek(0, os.SEEK_END)
+    if full_chunk:
+        start, dummy, records, nb_records = full_chunk
+    close_chunk(start, input_file.tell(), records, nb_records, last=True)
+    input_file.close()
+
+    if pool is not None:
+        pool.close()
+        for filename, result in pending:
+            if result.get() != 0:
+                print "Cleaning %s failed" % filename
+        pool.join()
+
+
+def recreate_chunk(input_filename, chunk_filename, clean):
+    """Re-create a single chunk from the manifest of a previous split."""
+    manifest = json.load(open(input_filename + ".manifest"))
+    for chunk in manifest['chunks']:
+        if chunk['file'] == chunk_filename or os.path.basename(chunk['file']) == chunk_filename:
+            write_chunk(input_filename, chunk)
+            if clean and clean_chunk(chunk['file']) != 0:
+                print "Cleaning %s failed" % chunk['file']
+            return
+    print "No chunk %s in %s.manifest" % (chunk_filename, input_filename)
+    sys.exit(1)
 
 
 def main(argv):
@@ -41,8 +193,11 @@ def main(argv):
     erase = 0
     input_filename = "large_test.xml"
     nb_records_in_chunk = 1000
+    max_bytes_in_chunk = 0
+    jobs = 4
+    recreate = None
     try:
-        opts, args = getopt.getopt(argv, "f:n:Xc")
+        opts, args = getopt.getopt(argv, "f:n:b:j:r:Xc")
     except getopt.GetoptError, err:
         print str(err)
         usage()
@@ -58,6 +213,16 @@ def main(argv):
             erase = 1
         if opt == '-n':
             nb_records_in_chunk = int(val)
+        if opt == '-b':
+            max_bytes_in_chunk = int(val)
+        if opt == '-j':
+            jobs = int(val)
+        if opt == '-r':
+            recreate = val
+
+    if recreate:
+        recreate_chunk(input_filename, recreate, clean)
+        return
 
     lastnum = 0
     directory = os.path.dirname(input_filename)
@@ -66,35 +231,14 @@ def main(argv):
     if directory == '':
         directory = '.'
     for file_name in os.listdir(directory):
-        match = re.search(input_filename + '_(\d+)$', file_name)
+        match = re.search(re.escape(os.path.basename(input_filename)) + r'_(\d+)$', file_name)
         if match:
             if erase:
-                os.unlink(file_name)
+                os.unlink(os.path.join(directory, file_name))
             else:
-                lastnum = int(match.group(1))
-
-        nb_records = lastnum
-
-    f = open(input_filename, "r")
-    out = open("%s_%09d" %
-               (input_filename, nb_records + nb_records_in_chunk), "w")
-    for line in f:
-        out.write(line)
-        if line.startswith(" </goal_record>"):
-            nb_records += 1
-            if nb_records % nb_records_in_chunk == 0:
-                out.write("\n</records>")
-                out.close()
-                if clean:
-                    os.system(
-                        "sh clean-spires-data.sh<" + out.name + ">" + out.name + ".clean")
-                out = open(
-                    "%s_%09d" % (input_filename, nb_records + nb_records_in_chunk), "w")
-                out.write("<records>")
-                print nb_records
-
-    f.close()
-    out.close()
+                lastnum = max(lastnum, int(match.group(1)))
+
+    split(input_filename, lastnum, nb_records_in_chunk, max_bytes_in_chunk, clean, jobs)
 
 
 def usage():
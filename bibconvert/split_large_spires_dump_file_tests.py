@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2026 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Unit tests for split_large_spires_dump_file (no cleaning)."""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import split_large_spires_dump_file as splitter
+
+
+def make_dump(nb_records):
+    return "<records>\n%s\n</records>\n" % "\n".join(
+        ["<goal_record><a>%d</a></goal_record>" % i for i in range(1, nb_records + 1)])
+
+
+class SplitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.input_filename = os.path.join(self.directory, 'd.xml')
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.directory)
+
+    def split(self, nb_records, nb_records_in_chunk):
+        dump = open(self.input_filename, 'w')
+        dump.write(make_dump(nb_records))
+        dump.close()
+        splitter.split(self.input_filename, 0, nb_records_in_chunk, 0, 0, 1)
+        manifest = json.load(open(self.input_filename + '.manifest'))
+        return manifest['chunks'], [open(chunk['file']).read() for chunk in manifest['chunks']]
+
+    def assertWellFormed(self, contents):
+        for content in contents:
+            self.assertEqual(content.strip()[:9], '<records>')
+            self.assertEqual(content.strip()[-10:], '</records>')
+
+    def test_exact_multiple(self):
+        """the last full chunk is not replaced by an empty one"""
+        chunks, contents = self.split(4, 2)
+        self.assertEqual([(chunk['first_record'], chunk['records']) for chunk in chunks],
+                         [(1, 2), (3, 2)])
+        self.assertEqual(len(set(chunk['file'] for chunk in chunks)), 2)
+        self.failUnless('<a>4</a>' in contents[1])
+        self.failUnless(chunks[1]['last'])
+        self.assertWellFormed(contents)
+
+    def test_remainder(self):
+        """the records after the last full chunk get their own chunk"""
+        chunks, contents = self.split(5, 2)
+        self.assertEqual([chunk['records'] for chunk in chunks], [2, 2, 1])
+        self.failUnless('<a>5</a>' in contents[2])
+        self.assertWellFormed(contents)
+
+
+if __name__ == '__main__':
+    unittest.main()
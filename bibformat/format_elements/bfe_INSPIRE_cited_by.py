@@ -22,7 +22,8 @@
 """
 __revision__ = "$Id$"
 
-from invenio.search_engine import search_pattern
+from invenio.dbquery import run_sql
+from invenio.bibrank_citation_searcher import get_cited_by_count
 try:
     from invenio.config import CFG_BASE_URL
 except ImportError:
@@ -30,35 +31,50 @@ except ImportError:
     CFG_BASE_URL = CFG_SITE_URL
 
 
-def format_element(bfo, separator='; ', nbOnly='no', searchlink='no'):
+def get_citers_page(recid, limit, offset=0):
+    """
+    Return one page of the records citing recid, most recent first.
+
+    Only the requested rows are read from the citation dictionary, so the
+    cost does not depend on how many times the record is cited.
+    """
+    return [row[0] for row in run_sql("SELECT citer FROM rnkCITATIONDICT WHERE citee=%s"
+                                      " ORDER BY citer DESC LIMIT %s OFFSET %s",
+                                      (recid, limit, offset))]
+
+
+def format_element(bfo, separator='; ', nbOnly='no', searchlink='no', limit='25', page='1'):
     """
     Prints the records (or number of records) citing this record
 
-    DO NOT USE > testing, not on cdsweb
+    The citing records are the ones of the citation dictionary built by
+    BibRank (see bibrank/citation.cfg), whatever they cite this record by.
+
     @param nbOnly  only print number
     @param searchlink print number (if nbOnly) as a link to the search to find these items
     @param separator a separator between citations
+    @param limit the maximum number of citing records printed
+    @param page which page of limit citing records to print
     """
-    primary_report_numbers = bfo.fields('037__a')
-    additional_report_numbers = bfo.fields('088__a')
-
-    report_numbers = primary_report_numbers
-    report_numbers.extend(additional_report_numbers)
-    report_numbers = [quote(rep_num) for rep_num in report_numbers]
-
-    res = []
-    for rep_num in report_numbers:
-        res.extend(list(search_pattern(p=rep_num, f='999C5r')))
-
+    recid = bfo.recID
     if nbOnly.lower() == 'yes':
+        nb_citations = get_cited_by_count(recid)
         if searchlink.lower()=='yes':
-            from bfe_server_info import format_element as bfe_server
-            return '<a href="'+CFG_BASE_URL+'/search?p=recid:'+bfo.control_field('001')+'&amp;rm=citation">'+str(len(res))+'</a>'
+            return '<a href="'+CFG_BASE_URL+'/search?p=recid:'+str(recid)+'&amp;rm=citation">'+str(nb_citations)+'</a>'
         else:
-            return str(len(res))
+            return str(nb_citations)
     else:
-        from invenio.bibformat import format_records
-        return '<br/>'.join(format_records(res, 'hs'))
+        from invenio.bibformat_elements.bfe_references import get_hs_snippets
+        limit = int(limit)
+        offset = (max(int(page), 1) - 1) * limit
+        citers = get_citers_page(recid, limit, offset)
+        snippets = get_hs_snippets(citers)
+        out = '<br/>'.join([snippets[citer] for citer in citers])
+        nb_citations = get_cited_by_count(recid)
+        if nb_citations > offset + len(citers):
+            out += '<br/><a href="' + CFG_BASE_URL + '/search?p=refersto:recid:' + str(recid) + '">' + \
+                   'Show all %d citing records</a>' % nb_citations
+        return out
 
 def escape_values(bfo):
     """
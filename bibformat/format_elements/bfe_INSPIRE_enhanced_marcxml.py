@@ -29,26 +29,77 @@ from invenio.dbquery import run_sql
 from invenio.access_control_engine import acc_authorize_action
 from invenio.config import CFG_BIBFORMAT_HIDDEN_TAGS
 from invenio.bibdocfile import BibRecDocs
-
-INSTITUTION_CACHE = {}
+from invenio.recidindexutils import RecidIndex, LRUCache
+from invenio.referenceresolver import get_reference_resolver, resolve_citation_element, \
+    normalize_isbn, normalize_reportnumber
+
+# Authority records are searched for when formatting a single record (e.g.
+# on the web). Batch exporters call load_lookup_indexes() first, so that
+# they are looked up in memory instead; the indexes are then refreshed with
+# the records modified in the meantime at most once every
+# CFG_LOOKUP_REFRESH_INTERVAL seconds.
+CFG_LOOKUP_REFRESH_INTERVAL = 3600
+
+LOOKUP_SEARCHES = {
+    'institution_u': ('110__u:"%s"', 'Institutions'),
+    'institution_t': ('110__t:"%s"', 'Institutions'),
+    'hepname': ('035__a:"%s"', 'HepNames'),
+    'journal': ('711__a:"%s"', 'Journals'),
+    'conference': ('111__g:"%s"', 'Conferences'),
+    'proceedings': ('773__w:"%s" 980:PROCEEDINGS', None),
+    'experiment_a': ('119__a:"%s"', 'Experiments'),
+    'experiment_b': ('119__b:"%s"', 'Experiments'),
+}
+
+LOOKUP_INDEXES = {
+    'institution_u': RecidIndex(['110__u'], collection='Institutions'),
+    'institution_t': RecidIndex(['110__t'], collection='Institutions'),
+    'hepname': RecidIndex(['035__a'], collection='HepNames'),
+    'journal': RecidIndex(['711__a'], collection='Journals'),
+    'conference': RecidIndex(['111__g'], collection='Conferences'),
+    'proceedings': RecidIndex(['773__w'], pattern='980:PROCEEDINGS'),
+    'experiment_a': RecidIndex(['119__a'], collection='Experiments'),
+    'experiment_b': RecidIndex(['119__b'], collection='Experiments'),
+}
+
+def load_lookup_indexes():
+    """Load the lookup indexes, or refresh them if they are outdated."""
+    refreshed = False
+    for index in LOOKUP_INDEXES.values():
+        if index.refresh_if_older_than(CFG_LOOKUP_REFRESH_INTERVAL):
+            refreshed = True
+    if refreshed:
+        INSTITUTION_CACHE.clear()
+        HEPNAME_CACHE.clear()
+
+def lookup_recids(name, value):
+    """Return the list of records matching value, in search results order."""
+    index = LOOKUP_INDEXES[name]
+    if index.last_updated is not None:
+        # Most recent records first, like the search results
+        recids = list(index.get(value))
+        recids.reverse()
+        return recids
+    pattern, collection = LOOKUP_SEARCHES[name]
+    if collection is None:
+        return perform_request_search(p=pattern % value)
+    return perform_request_search(p=pattern % value, cc=collection)
+
+INSTITUTION_CACHE = LRUCache(50000)
 def get_institution_ids(text):
-    # HACK: I know... I am sorry for that. It's for a good cause
-    # FIXME: use redis
-    global INSTITUTION_CACHE
     if text not in INSTITUTION_CACHE:
-        INSTITUTION_CACHE[text] = intbitset(perform_request_search(cc='Institutions', p='110__u:"%s"' % text)) or \
-            intbitset(perform_request_search(cc='Institutions', p='110__t:"%s"' % text))
+        INSTITUTION_CACHE[text] = intbitset(lookup_recids('institution_u', text)) or \
+            intbitset(lookup_recids('institution_t', text))
     return INSTITUTION_CACHE[text]
 
-HEPNAME_CACHE = {}
+HEPNAME_CACHE = LRUCache(50000)
 def get_hepname_id(personid):
-    global HEPNAME_CACHE
     if personid not in HEPNAME_CACHE:
         canonical_name = get_personid_canonical_id().get(personid)
         if canonical_name is None:
             HEPNAME_CACHE[personid] = None
         else:
-            recids = perform_request_search(p='035__a:"%s"' % canonical_name, cc='HepNames')
+            recids = lookup_recids('hepname', canonical_name)
             HEPNAME_CACHE[personid] = recids[0] if recids else None
     return HEPNAME_CACHE[personid]
 
@@ -59,13 +110,31 @@ def get_personid_canonical_id():
         CANONICAL_NAME_CACHE = dict(run_sql("SELECT personid, data FROM aidPERSONIDDATA WHERE tag='canonical_name'"))
     return CANONICAL_NAME_CACHE
 
-RELATED_JOURNAL_CACHE = {}
+PREFETCHED_BIBREC = {}
+PREFETCHED_SIGNATURES = {}
+def prefetch_records(recids):
+    """Load in bulk the bibrec and signature rows of the given records.
+
+    Batch exporters (e.g. bst_prodsync) call this before formatting a chunk
+    of records in 'xme', so that format_element does not need two queries
+    per record. Prefetched rows are consumed by format_element. The lookup
+    indexes are loaded (or refreshed) as well.
+    """
+    load_lookup_indexes()
+    recids = list(recids)
+    if not recids:
+        return
+    placeholders = ','.join(['%s'] * len(recids))
+    for recid, creation_date, modification_date in run_sql("SELECT id, creation_date, modification_date FROM bibrec WHERE id IN (%s)" % placeholders, tuple(recids)):
+        PREFETCHED_BIBREC[recid] = (creation_date, modification_date)
+    for recid in recids:
+        PREFETCHED_SIGNATURES[recid] = {}
+    for recid, name, personid, flag in run_sql("SELECT bibrec, name, personid, flag FROM aidPERSONIDPAPERS WHERE bibrec IN (%s) AND flag>-2" % placeholders, tuple(recids)):
+        PREFETCHED_SIGNATURES[recid][name] = (personid, flag)
+
 def get_related_journal(journal_name):
-    global RELATED_JOURNAL_CACHE
-    if journal_name not in RELATED_JOURNAL_CACHE:
-        recids = perform_request_search(p='711__a:"%s"' % journal_name, cc='Journals')
-        RELATED_JOURNAL_CACHE[journal_name] = recids[0] if recids else None
-    return RELATED_JOURNAL_CACHE[journal_name]
+    recids = lookup_recids('journal', journal_name)
+    return recids[0] if recids else None
 
 def reference2citation_element(subfields):
     citation_element = {}
@@ -97,6 +166,9 @@ def reference2citation_element(subfields):
 
 def get_matched_id(subfields):
     citation_element = reference2citation_element(subfields)
+    resolver = get_reference_resolver()
+    if resolver is not None:
+        return resolve_citation_element(resolver, citation_element)
     if 'doi_string' in citation_element:
         recids = find_doi(citation_element)
         if len(recids) == 1:
@@ -182,9 +254,11 @@ def format_element(bfo, oai=0):
 
     is_institution = 'INSTITUTION' in [collection.upper() for collection in bfo.fields('980__a')]
 
-    signatures = {}
-    if '100' in record or '700' in record:
-        signatures = dict((name, (personid, flag)) for name, personid, flag in run_sql("SELECT name, personid, flag FROM aidPERSONIDPAPERS WHERE bibrec=%s AND flag>-2", (recid, )))
+    signatures = PREFETCHED_SIGNATURES.pop(recid, None)
+    if signatures is None:
+        signatures = {}
+        if '100' in record or '700' in record:
+            signatures = dict((name, (personid, flag)) for name, personid, flag in run_sql("SELECT name, personid, flag FROM aidPERSONIDPAPERS WHERE bibrec=%s AND flag>-2", (recid, )))
 
     # Let's add signatures
     for field in record_get_field_instances(record, '100') + record_get_field_instances(record, '700') + record_get_field_instances(record, '701') + record_get_field_instances(record, '702'):
@@ -310,17 +384,18 @@ def format_element(bfo, oai=0):
                 subfields.append(('w', str(matched_id)))
 
     # Enhance CNUMs and Journals
+    resolver = get_reference_resolver()
     for field in record_get_field_instances(record, '773'):
         subfields = field_get_subfield_instances(field)
         subfield_dict = dict(subfields)
         for code, value in subfields:
             if code == 'w':
                 # Conference CNUMs
-                recids = perform_request_search(p='111__g:"%s"' % value, cc='Conferences')
+                recids = lookup_recids('conference', value)
                 if len(recids) == 1:
                     subfields.append(('2', str(recids.pop())))
                 if '0' not in subfield_dict:
-                    recids = perform_request_search(p='773__w:"%s" 980:PROCEEDINGS' % value)
+                    recids = lookup_recids('proceedings', value)
                     if recid in recids:
                         # We remove this very record, since it can be a proceedings
                         recids.remove(recid)
@@ -328,17 +403,23 @@ def format_element(bfo, oai=0):
                         subfields.append(('0', str(recids.pop())))
             elif code == 'p':
                 # Journal title
-                recids = perform_request_search(p='711__a:"%s"' % value, cc='Journals')
+                recids = lookup_recids('journal', value)
                 if len(recids) == 1:
                     subfields.append(('1', str(recids.pop())))
             elif code == 'z' and '0' not in subfield_dict:
                 # ISBN
-                recids = find_isbn({'ISBN': value})
+                if resolver is not None:
+                    recids = resolver.get('isbn:' + normalize_isbn(value))
+                else:
+                    recids = find_isbn({'ISBN': value})
                 if len(recids) == 1:
                     subfields.append(('0', str(recids.pop())))
             elif code == 'r' and '0' not in subfield_dict:
                 # Report
-                recids = perform_request_search(p='reportnumber:"%s"' % value)
+                if resolver is not None:
+                    recids = resolver.get('repno:' + normalize_reportnumber(value))
+                else:
+                    recids = perform_request_search(p='reportnumber:"%s"' % value)
                 if len(recids) == 1:
                     subfields.append(('0', str(recids.pop())))
 
@@ -347,11 +428,11 @@ def format_element(bfo, oai=0):
         subfields = field_get_subfield_instances(field)
         for code, value in subfields:
             if code == 'e':
-                recids = perform_request_search(p='119__a:"%s"' % value, cc='Experiments')
+                recids = lookup_recids('experiment_a', value)
                 if len(recids) == 1:
                     subfields.append(('0', str(recids.pop())))
             elif code == 'a':
-                recids = perform_request_search(p='119__b:"%s"' % value, cc='Experiments')
+                recids = lookup_recids('experiment_b', value)
                 if len(recids) == 1:
                     subfields.append(('0', str(recids.pop())))
 
@@ -361,14 +442,15 @@ def format_element(bfo, oai=0):
         subfields = field_get_subfield_instances(field)
         for code, value in subfields:
             if code == 'g':
-                recids = perform_request_search(p='119__a:"%s"' % value, cc='Experiments')
+                recids = lookup_recids('experiment_a', value)
                 if len(recids) == 1:
                     subfields.append(('0', str(recids.pop())))
 
     # Add Creation date:
     if '961' in record:
         del record['961']
-    creation_date, modification_date = run_sql("SELECT creation_date, modification_date FROM bibrec WHERE id=%s", (recid,))[0]
+    creation_date, modification_date = PREFETCHED_BIBREC.pop(recid, None) or \
+        run_sql("SELECT creation_date, modification_date FROM bibrec WHERE id=%s", (recid,))[0]
     record_add_field(record, '961', subfields=[('x', creation_date.strftime('%Y-%m-%d')), ('c', modification_date.strftime('%Y-%m-%d'))])
 
     formatted_record = record_xml_output(record)
@@ -21,34 +21,177 @@
 """BibFormat element - Prints references
 """
 
-from invenio.search_engine import search_unit, get_record, search_pattern
+import time
+from zlib import decompress
+
+from invenio.search_engine import search_unit, search_pattern
 from invenio.bibformat import format_record
+from invenio.dbquery import run_sql
+from invenio.intbitset import intbitset
+from invenio.recidindexutils import LRUCache
+from invenio.referenceresolver import get_reference_resolver, normalize_doi, \
+    normalize_pubnote, normalize_reportnumber
+
+# Rendered references of the most recently viewed records, keyed by recid.
+# An entry is dropped when the 005 of the record changes, or after
+# CFG_REFERENCES_CACHE_TIMEOUT seconds so that the snippets of the cited
+# records do not get too old.
+CFG_REFERENCES_CACHE_TIMEOUT = 3600
+RENDERED_REFERENCES_CACHE = LRUCache(1000)
+
+
+def parse_reference(reference):
+    """Return the identifiers of a 999C5 field used to find the cited record."""
+    parsed = {'report': '', 'journal': '', 'doi': '', 'handle': '', 'recid': None}
+    if reference.has_key('s'):
+        parsed['journal'] = reference['s'][0]
+    if reference.has_key('r'):
+        if "[" in reference['r'][0] and "]" in reference['r'][0]:
+            breaknum = reference['r'][0].find('[')
+            parsed['report'] = reference['r'][0][:breaknum].strip()
+        else:
+            parsed['report'] = reference['r'][0]
+    if reference.has_key('a'):
+        doihdl = reference['a'][0]
+        if doihdl.lower().startswith('doi:'):
+            parsed['doi'] = doihdl[4:]
+        elif doihdl.lower().startswith('hdl:'):
+            parsed['handle'] = doihdl[4:]
+        # else not a well formed DOI or handle
+    if reference.has_key('0'):
+        try:
+            parsed['recid'] = int(reference['0'][0])
+        except ValueError:
+            pass
+    return parsed
+
+
+def search_reference_identifier(kind, value):
+    """The search based fallback when there is no resolver index."""
+    if kind == 'report':
+        return search_unit(f='reportnumber', p=value)
+    elif kind == 'journal':
+        return search_pattern(f='journal', p=value, ap=1)
+    else:
+        return search_unit(p=value, f='0247_a', m='a')
+
+
+def resolve_identifier(resolver, kind, value):
+    """Return the only recid matching the identifier, or None."""
+    hits = None
+    if resolver is not None and kind != 'handle':
+        if kind == 'report':
+            hits = resolver.get('repno:' + normalize_reportnumber(value))
+        elif kind == 'doi':
+            hits = resolver.get('doi:' + normalize_doi(value))
+        else:
+            try:
+                journal, volume, page = value.split(',')
+                hits = resolver.get('pubnote:' + normalize_pubnote(journal, volume, page))
+            except ValueError:
+                # Not a pubnote the index knows about, the search decides
+                pass
+    if hits is None:
+        hits = search_reference_identifier(kind, value)
+    if len(hits) == 1:
+        return list(hits)[0]
+    return None
+
 
-def format_element(bfo, reference_prefix, reference_suffix):
+def resolve_references(parsed_references):
+    """
+    Return the recid cited by each reference, or None, in one pass.
+
+    As when resolving the references one by one, the report number is
+    tried first, then the pubnote, the DOI or handle and finally $0 if
+    the record exists. Every distinct identifier is looked up once.
+    """
+    resolver = get_reference_resolver()
+    resolved = {}
+
+    def resolve(kind, value):
+        if (kind, value) not in resolved:
+            resolved[(kind, value)] = resolve_identifier(resolver, kind, value)
+        return resolved[(kind, value)]
+
+    hits = []
+    for parsed in parsed_references:
+        hit = None
+        for kind in ('report', 'journal', 'doi', 'handle'):
+            if parsed[kind]:
+                hit = resolve(kind, parsed[kind])
+                if hit:
+                    break
+        hits.append(hit)
+
+    # $0 only counts if the record exists
+    recids = [parsed['recid'] for parsed, hit in zip(parsed_references, hits)
+              if hit is None and parsed['recid']]
+    if recids:
+        existing = intbitset(run_sql("SELECT id FROM bibrec WHERE id IN (%s)" %
+                                     ','.join(['%s'] * len(recids)), tuple(recids)))
+        for i, parsed in enumerate(parsed_references):
+            if hits[i] is None and parsed['recid'] and parsed['recid'] in existing:
+                hits[i] = parsed['recid']
+    return hits
+
+
+def get_hs_snippets(recids):
+    """
+    Return the 'hs' output of the given records, from the bibfmt cache in
+    one query, formatting only the records which are not cached.
+    """
+    recids = list(set(recids))
+    snippets = {}
+    if recids:
+        for recid, value in run_sql("SELECT id_bibrec, value FROM bibfmt WHERE format='hs' AND id_bibrec IN (%s)" %
+                                    ','.join(['%s'] * len(recids)), tuple(recids)):
+            snippets[recid] = decompress(value)
+    for recid in recids:
+        if recid not in snippets:
+            snippets[recid] = format_record(recid, 'hs')
+    return snippets
+
+
+def format_element(bfo, reference_prefix, reference_suffix, cache='yes'):
     """
     Prints the references of this record
 
     @param reference_prefix a prefix displayed before each reference
     @param reference_suffix a suffix displayed after each reference
+    @param cache if 'yes', reuse the references rendered for the same version of the record
     """
-    references = bfo.fields("999C5", escape=0, repeatable_subfields_p=True)
-
+    revision = bfo.control_field('005')
+    cache_key = (bfo.recID, reference_prefix, reference_suffix)
+    if cache == 'yes' and revision and cache_key in RENDERED_REFERENCES_CACHE:
+        cached_revision, cached_time, out = RENDERED_REFERENCES_CACHE[cache_key]
+        if cached_revision == revision and time.time() - cached_time < CFG_REFERENCES_CACHE_TIMEOUT:
+            return out
+
+    out = render_references(bfo.fields("999C5", escape=0, repeatable_subfields_p=True),
+                            reference_prefix, reference_suffix)
+    if cache == 'yes' and revision:
+        RENDERED_REFERENCES_CACHE[cache_key] = (revision, time.time(), out)
+    return out
+
+
+def render_references(references, reference_prefix, reference_suffix):
+    """Render the given 999C5 fields as a table."""
     out = ""
     last_o = ""
 
     if not references:
         return out
 
+    parsed_references = [parse_reference(reference) for reference in references]
+    hits = resolve_references(parsed_references)
+    snippets = get_hs_snippets([hit for hit in hits if hit])
+
     out += "<table>"
-    for reference in references:
+    for reference, parsed, hit in zip(references, parsed_references, hits):
         ref_out = []
         ref_out.append('<tr><td valign="top">')
 
-        display_journal = ''
-        display_report = ''
-        clean_report = ''
-        clean_journal = ''
-        hits = []
         if reference.has_key('o') and not reference['o'][0] == last_o:
             temp_ref = reference['o'][0].replace('.', '')
             if '[' in temp_ref and ']' in temp_ref:
@@ -62,43 +205,8 @@ def format_element(bfo, reference_prefix, reference_suffix):
         if reference_prefix:
             ref_out.append(reference_prefix)
 
-        if reference.has_key('s'):
-            display_journal = reference['s'][0]
-            clean_journal = reference['s'][0]
-        if reference.has_key('r'):
-            if "[" in reference['r'][0] and "]" in reference['r'][0]:
-                breaknum = reference['r'][0].find('[')
-                newreference = reference['r'][0][:breaknum].strip()
-                display_report = newreference
-                clean_report = newreference
-            else:
-                display_report = reference['r'][0]
-                clean_report = reference['r'][0]
-        if clean_report:
-            hits = search_unit(f='reportnumber', p=clean_report)
-        if clean_journal and len(hits) != 1:
-            hits = search_pattern(f='journal', p=clean_journal, ap=1)
-        if reference.has_key('a') and len(hits) != 1:
-            doihdl = reference['a'][0]
-            if doihdl.lower().startswith('doi:') or \
-               doihdl.lower().startswith('hdl:'):
-                doihdl = doihdl[4:]
-                hits = search_unit(p=doihdl, f='0247_a', m='a')
-            else:
-                # not a well formed DOI or handle
-                pass
-        if reference.has_key('0') and len(hits) != 1:
-            # check if the record exists in the database
-            try:
-                recID = int(reference['0'][0])
-                if get_record(recID):
-                    # since we already have a recID, we can assign it directly
-                    # to the "hits" variable, so it will be handled in the last if statement
-                    hits = [recID]
-            except ValueError:
-                pass
-        if len(hits) == 1:
-            ref_out.append('<small>' + format_record(list(hits)[0], 'hs') + '</small>')
+        if hit:
+            ref_out.append('<small>' + snippets[hit] + '</small>')
         else:
             if reference.has_key('h'):
                 ref_out.append("<small> " + reference['h'][0] + ".</small>")
@@ -121,10 +229,10 @@ def format_element(bfo, reference_prefix, reference_suffix):
                     ref_out.append("<small> <a href=\"/search?ln=en&amp;p=020__a%3A"+r+"\">"+r+"</a></small>")
 
             ref_out.append('<small>')
-            if display_journal:
-                ref_out.append(display_journal)
-            if display_report:
-                ref_out.append(' ' + display_report)
+            if parsed['journal']:
+                ref_out.append(parsed['journal'])
+            if parsed['report']:
+                ref_out.append(' ' + parsed['report'])
             ref_out.append("</small>")
 
         if reference_suffix:
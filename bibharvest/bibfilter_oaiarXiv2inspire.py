@@ -27,10 +27,14 @@
 import os
 import sys
 import getopt
+import marshal
 import re
+import time
+from multiprocessing import Pool
 
 from invenio.bibupload import open_marc_file
-from invenio.config import CFG_ETCDIR
+from invenio.config import CFG_ETCDIR, CFG_CACHEDIR
+from invenio.dbquery import run_sql
 from invenio.bibrecord import (create_records,
                                record_get_field_instances,
                                record_add_field, record_xml_output,
@@ -45,9 +49,21 @@ from invenio.search_engine import get_record
 from invenio.bibmerge_differ import record_diff, match_subfields
 from invenio.bibupload import retrieve_rec_id
 from invenio.textutils import wash_for_xml, wash_for_utf8
-from invenio.search_engine import perform_request_search
 from invenio.refextract_api import extract_journal_reference
+from invenio.refextract_config import CFG_REFEXTRACT_KBS
 from invenio.oai_harvest_daemon import create_authorlist_ticket
+from invenio.recidindexutils import LRUCache, get_tag_values
+
+# Journal references extracted by refextract, kept from one run to the next
+CFG_PUBNOTE_CACHE = os.path.join(CFG_CACHEDIR, 'oaiarXiv_pubnotes.cache')
+CFG_PUBNOTE_CACHE_SIZE = 100000
+CFG_PUBNOTE_PROCESSES = 4
+# The cache is discarded when the refextract knowledge bases change, and in
+# any case once it is that many seconds old.
+CFG_PUBNOTE_CACHE_MAX_AGE = 7 * 24 * 3600
+PUBNOTE_CACHE_VERSION = 1
+
+RE_SPACES = re.compile(r'\s+')
 
 
 def parse_actions(action_line):
@@ -212,6 +228,135 @@ def get_minimal_arxiv_id(record):
             return value.split(':')[-1]
 
 
+def get_recids_from_arxiv_ids(arxiv_ids, chunk_size=1000):
+    """Match many arXiv ids to the records having them as report number.
+
+    Both the new style ids, stored as arXiv:1234.1234, and the old style
+    ones, stored as hep-ex/2134123, are looked up straight from the report
+    number index table, in one query per chunk of ids. Deleted records are
+    left out.
+
+    Returns a dictionary of every given arXiv id to the set of its record
+    ids, which has more than one element for ambiguous matches.
+    """
+    wanted = dict((arxiv_id.lower(), arxiv_id) for arxiv_id in arxiv_ids)
+    recids = dict((arxiv_id, set()) for arxiv_id in wanted.itervalues())
+    values = []
+    for arxiv_id in wanted.itervalues():
+        values.append(arxiv_id)
+        values.append('arXiv:' + arxiv_id)
+    for i in xrange(0, len(values), chunk_size):
+        chunk = values[i:i + chunk_size]
+        sql = "SELECT b.value, bb.id_bibrec FROM bib03x AS b " \
+              "JOIN bibrec_bib03x AS bb ON bb.id_bibxxx=b.id " \
+              "WHERE b.tag='037__a' AND b.value IN (%s)" % (",".join(["%s"] * len(chunk)),)
+        for value, recid in run_sql(sql, tuple(chunk)):
+            arxiv_id = wanted.get(value.split(':')[-1].lower())
+            if arxiv_id:
+                recids[arxiv_id].add(recid)
+
+    deleted = set(recid for recid, value in
+                  get_tag_values('980__c', set().union(*recids.values()))
+                  if value.upper() == 'DELETED')
+    return dict((arxiv_id, matches - deleted)
+                for arxiv_id, matches in recids.iteritems())
+
+
+def get_refextract_kbs_version():
+    """Return the modification times of the refextract knowledge bases."""
+    version = []
+    for name, path in sorted(CFG_REFEXTRACT_KBS.items()):
+        try:
+            version.append((name, os.path.getmtime(path)))
+        except (OSError, TypeError):
+            # Not a file
+            pass
+    return tuple(version)
+
+
+def normalize_pubnote_string(value):
+    """Journal references differing only by spacing are extracted once."""
+    return RE_SPACES.sub(' ', value).strip()
+
+
+class PubnoteExtractor(object):
+    """Extract journal references from 773__x strings.
+
+    Results are memoized in an LRU cache saved to cache_path by close().
+    The saved cache is only reused with the same refextract knowledge bases
+    and for CFG_PUBNOTE_CACHE_MAX_AGE seconds. Strings which are not in the
+    cache can be handed to prefetch, which extracts them in a pool of
+    processes while the records are filtered.
+    """
+
+    def __init__(self, processes=CFG_PUBNOTE_PROCESSES,
+                 cache_path=CFG_PUBNOTE_CACHE, maxsize=CFG_PUBNOTE_CACHE_SIZE):
+        self.processes = processes
+        self.cache_path = cache_path
+        self.cache = LRUCache(maxsize)
+        self.pool = None
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.kbs_version = get_refextract_kbs_version()
+        self.created = time.time()
+        try:
+            cache_file = open(cache_path, 'rb')
+            try:
+                version, kbs_version, created, items = marshal.load(cache_file)
+            finally:
+                cache_file.close()
+            if (version, kbs_version) == (PUBNOTE_CACHE_VERSION, self.kbs_version) and \
+               time.time() - created < CFG_PUBNOTE_CACHE_MAX_AGE:
+                for key, value in items:
+                    self.cache[key] = value
+                self.created = created
+        except (IOError, EOFError, ValueError, TypeError):
+            # No cache yet, or a corrupted one: start from scratch
+            pass
+
+    def prefetch(self, values):
+        """Start extracting the given strings which are not cached yet."""
+        for value in values:
+            key = normalize_pubnote_string(value)
+            if key in self.cache or key in self.pending:
+                continue
+            if self.pool is None:
+                self.pool = Pool(self.processes)
+            self.pending[key] = self.pool.apply_async(extract_journal_reference, (key,))
+
+    def extract(self, value):
+        """Return the journal reference extracted from the given string."""
+        key = normalize_pubnote_string(value)
+        if key in self.pending:
+            self.misses += 1
+            extract = self.pending.pop(key).get()
+        elif key in self.cache:
+            self.hits += 1
+            return self.cache[key]
+        else:
+            self.misses += 1
+            extract = extract_journal_reference(key)
+        self.cache[key] = extract
+        return extract
+
+    def close(self):
+        """Stop the pool and save the cache."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.pending = {}
+        tmp_path = "%s.%d" % (self.cache_path, os.getpid())
+        cache_file = open(tmp_path, 'wb')
+        try:
+            marshal.dump((PUBNOTE_CACHE_VERSION, self.kbs_version, self.created,
+                          self.cache.data.items()), cache_file)
+        finally:
+            cache_file.close()
+        os.rename(tmp_path, self.cache_path)
+
+
 def record_get_value_with_provenence(record, tag, ind1=" ", ind2=" ",
                                      value_code="", provenence_code="9",
                                      provenence_value="arXiv"):
@@ -254,7 +399,7 @@ def main():
                     harvested from external OAI sources, in order to determine
                     which action needs to be taken (insert, holdingpen, etc)
     usage:
-                    bibfilter_oaiarXiv2inspire [-nhc:] MARCXML-FILE
+                    bibfilter_oaiarXiv2inspire [-nhc:j:] MARCXML-FILE
     options:
                     source_id is the optional parameter indicating the
                     Invenio harvesting source identifier. This value is
@@ -265,10 +410,12 @@ def main():
                 -n
                     forces the script not to check if the record exists in the database
                     (useful when re-harvesting existing record)
+                -j PROCESSES
+                    number of processes extracting journal references (default 4)
     """
     usage = __doc__
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "c:nh", [])
+        opts, args = getopt.getopt(sys.argv[1:], "c:nhj:", [])
     except getopt.GetoptError, err_obj:
         sys.stderr.write("Error:" + err_obj + "\n")
         print usage
@@ -276,12 +423,15 @@ def main():
 
     config_path = CFG_ETCDIR + "/bibharvest/" + "oaiarXiv_bibfilter_actions.cfg"
     skip_recid_check = False
+    processes = CFG_PUBNOTE_PROCESSES
 
     for opt, opt_value in opts:
         if opt in ['-c']:
             config_path = opt_value
         if opt in ['-n']:
             skip_recid_check = True
+        if opt in ['-j']:
+            processes = int(opt_value)
         if opt in ['-h']:
             print usage
             sys.exit(0)
@@ -311,35 +461,52 @@ def main():
     append_records = []
     correct_records = []
     holdingpen_records = []
+    ambiguous_records = 0
 
     for rec in records:
-        record = rec[0]
-        if record is None:
+        if rec[0] is None:
             sys.stderr.write("Record is None: %s" % (rec[2],))
             sys.exit(1)
+
+    # All the arXiv ids of the file are matched at once against the report
+    # numbers of existing records
+    arxiv_matches = get_recids_from_arxiv_ids(
+        [arxiv_id for arxiv_id in [get_minimal_arxiv_id(rec[0]) for rec in records] if arxiv_id])
+
+    # Journal references not seen in previous runs are extracted in the
+    # background while the records are being filtered
+    pubnotes = PubnoteExtractor(processes)
+    pubnotes.prefetch([value for rec in records
+                       for field in record_get_field_instances(rec[0], '773')
+                       for value in field_get_subfield_values(field, 'x')])
+
+    for rec in records:
+        record = rec[0]
         # Perform various checks to determine an suitable action to be taken for
         # that particular record. Whether it will be inserted, discarded or replacing
         # existing records
         #
         # Firstly, is the record already in the database?
-        if skip_recid_check:
+        arxiv_id = get_minimal_arxiv_id(record)
+        matches = arxiv_matches.get(arxiv_id, set())
+        ambiguous = False
+        if len(matches) == 1:
+            recid = list(matches)[0]
+        elif skip_recid_check:
             recid = None
         else:
             recid = retrieve_rec_id(record, "")
-
-        if not recid or recid == -1:
-            # Try again with p_r_s
-            arxiv_id = get_minimal_arxiv_id(record)
-            if arxiv_id:
-                results = perform_request_search(p="reportnumber:%s" % (arxiv_id,), of='id')
-                if len(results) > 0:
-                    # FIXME: Ambiguous results may happen. Now just taking first result..
-                    recid = results[0]
+        if (not recid or recid == -1) and len(matches) > 1:
+            # Let a curator decide rather than updating one of them at random
+            sys.stderr.write("Ambiguous match for arXiv:%s: records %s\n"
+                             % (arxiv_id, ", ".join([str(match) for match in sorted(matches)])))
+            ambiguous = True
+            ambiguous_records += 1
 
         # 773 RefExtract PubNote extraction
         for field in record_get_field_instances(record, '773'):
             for value in field_get_subfield_values(field, 'x'):
-                extract = extract_journal_reference(value)
+                extract = pubnotes.extract(value)
                 if extract:
                     subfields = [('x', value)]
                     if extract.get('volume', False):
@@ -362,7 +529,9 @@ def main():
                 record_replace_field(record, '710', new_field, field[4])
                 break
 
-        if not recid or recid == -1:
+        if ambiguous:
+            holdingpen_records.append(record)
+        elif not recid or recid == -1:
             # Record (probably) does not exist, flag for inserting into database
             # FIXME: Add some automatic deny/accept parameters, perhaps also bibmatch call
             # inserts are now done on labs
@@ -517,6 +686,9 @@ def main():
                     del record["FFT"]
                 holdingpen_records.append(record)
 
+    pubnotes.close()
+    sys.stdout.write("Journal references: %d cached, %d extracted\n" % (pubnotes.hits, pubnotes.misses))
+
     # Output results. Create new files, if necessary.
     write_record_to_file("%s.insert.xml" % (input_filename,), insert_records)
     sys.stdout.write("Number of records to insert:  %d\n" % (len(insert_records),))
@@ -529,6 +701,7 @@ def main():
 
     write_record_to_file("%s.holdingpen.xml" % (input_filename,), holdingpen_records)
     sys.stdout.write("Number of records to the holding pen: %d\n" % (len(holdingpen_records),))
+    sys.stdout.write("Number of ambiguous arXiv matches: %d\n" % (ambiguous_records,))
 
     sys.exit(0)
 if __name__ == '__main__':
@@ -28,13 +28,17 @@
 """
 
 from tempfile import mkstemp
+from collections import deque
+from multiprocessing import Pool
 
 import os
 import sys
 import re
 import getopt
-
-from itertools import product
+import hashlib
+import marshal
+import shutil
+import time
 
 try:
     import json
@@ -61,6 +65,8 @@ from invenio.bibrecord import (create_record,
                                create_field,
                                record_strip_controlfields)
 from invenio.search_engine import perform_request_search, get_record
+from invenio.externalidindex import get_external_id_index, refresh_external_id_index, \
+    external_id_key
 from invenio.plotextractor_converter import convert_images
 from invenio.bibtask import write_message
 
@@ -78,6 +84,38 @@ CONF_SERVER = 'localhost'
 CONFIG = {}
 PRINT_OUT = False
 
+# Bump when the layout of the compiled configuration changes
+CONFIG_CACHE_VERSION = 2
+
+# Rule tables of apply_filter, built once instead of for every record
+INTERESTING_FIELDS = frozenset(["024", "041", "035", "037", "088", "100",
+                                "110", "111", "242", "245", "246", "260",
+                                "269", "300", "502", "650", "653", "693",
+                                "700", "710", "773", "856", "520", "500",
+                                "980"])
+# TODO: Move this to a KB
+NOTE_REPORT_PREFIXES = ('ATLAS-CONF-', 'CMS-PAS-', 'ATL-', 'CMS-DP-',
+                        'ALICE-INT-', 'LHCb-PUB-')
+FORBIDDEN_035_VALUES = frozenset(["cercer",
+                                  "inspire",
+                                  "xx",
+                                  "cern annual report",
+                                  "cmscms",
+                                  "wai01"])
+CDS_URLS = ('http://cdsweb.cern.ch', 'http://cms.cern.ch',
+            'http://cmsdoc.cern.ch', 'http://documents.cern.ch',
+            'http://preprints.cern.ch', 'http://cds.cern.ch')
+RE_NOT_PAGE_NUMBER = re.compile(r'[^\d-]+')
+
+# Figures are converted by a pool of processes. Converted files are kept
+# under the SHA1 of the downloaded file, so that the same figure is only
+# converted once, whatever the harvest it comes from.
+CFG_PLOT_CONVERSION_PROCESSES = 4
+CFG_PLOT_CACHE_DIR = os.path.join(CFG_TMPSHAREDDIR, 'oaicds_plots')
+# Number of filtered records kept in memory while their figures are converted
+MAX_RECORDS_WAITING_FOR_PLOTS = 100
+PLOT_PLACEHOLDER_PREFIX = 'plot-conversion:'
+
 
 def main(args):
     usage = """
@@ -85,23 +123,32 @@ def main(args):
     decription:     Program to filter and analyse MARCXML records
                     harvested from external OAI sources, in particular CDS.
     usage:
-                    bibfilter_oaicds2inspire [-nh] MARCXML-FILE
+                    bibfilter_oaicds2inspire [-nhb] [-j N] MARCXML-FILE
     options:
                 -n  forces the script not to check if the record exists in the
                     database (useful when re-harvesting existing record)
-    """
+                -b  only benchmark apply_filter on the records of the file
+                    (no matching, no output files)
+                -j  number of processes converting figures (default %d)
+    """ % (CFG_PLOT_CONVERSION_PROCESSES,)
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "nh", [])
+        opts, args = getopt.getopt(sys.argv[1:], "nhbj:", [])
     except getopt.GetoptError, err_obj:
         sys.stderr.write("Error:" + err_obj + "\n")
         print usage
         sys.exit(1)
 
     skip_recid_check = False
+    benchmark_only = False
+    processes = CFG_PLOT_CONVERSION_PROCESSES
 
     for opt, opt_value in opts:
         if opt in ['-n']:
             skip_recid_check = True
+        if opt in ['-b']:
+            benchmark_only = True
+        if opt in ['-j']:
+            processes = int(opt_value)
         if opt in ['-h']:
             print usage
             sys.exit(0)
@@ -128,55 +175,85 @@ def main(args):
     sys.setdefaultencoding("utf8")
     assert sys.getdefaultencoding() == "utf8"
 
-    record_tree, next_process, header_subs = clean_xml(input_filename)
-    records, deleted_records = next_process(record_tree, header_subs)
-    insert_records = []
-    append_records = []
-    error_records = []
+    if benchmark_only:
+        nb_records, seconds = benchmark_filter(input_filename)
+        print "Filtered %d records in %.2fs: %.1f records/s" % \
+              (nb_records, seconds, nb_records / max(seconds, 1e-6))
+        return
 
-    for record in records:
-        # Step 1: Attempt to match the record to those already in Inspire
-        try:
-            recid = record['001'][0][3]
-            res = attempt_record_match(recid)
-        except (KeyError, IndexError):
-            _print('Error: Cannot process record without 001:recid')
-            error_records.append(record)
-            continue
+    # Records created since the last bst_external_id_index run must be
+    # known before matching
+    refresh_external_id_index()
 
-        if skip_recid_check or not res:
-            _print("Record %s does not exist: inserting" % (recid,))
-            # No record found
-            # Step 2: Appply filter to transform CDS MARC to Inspire MARC
-            insert_records.append(apply_filter(record))
-            # insert_records.append(record)
-        else:
-            _print("Record %s found: %r" % (recid, res))
+    # Output results. Create new files, if necessary.
+    output_prefix = input_filename
+    if output_prefix[-4:].lower() == '.xml':
+        output_prefix = output_prefix[:-4]
+    insert_file = RecordFileWriter("%s.insert.xml" % (output_prefix,))
+    append_file = RecordFileWriter("%s.append.xml" % (output_prefix,))
+    error_file = RecordFileWriter("%s.errors.xml" % (output_prefix,))
+
+    # Filtered records wait for their figures before being written, so
+    # that conversions run while the following records are processed.
+    plot_converter = PlotConverter(processes)
+    waiting_records = deque()
+
+    # The output files are only completed if the whole harvest was
+    # filtered, otherwise they are removed
+    completed = False
+    try:
+        # Records are filtered one by one while the file is being parsed
+        for record, deleted_record in iter_records(input_filename):
+            if deleted_record is not None:
+                recid = record_get_field_values(deleted_record, tag="035", code="a")[0].split(":")[-1]
+                res = attempt_record_match(recid)
+                if res:
+                    # Record exists and we should then delete it
+                    _print("Record %s exists. Delete it" % (recid,))
+                    append_file.write(deleted_record)
+                continue
 
-    for record in deleted_records:
-        recid = record_get_field_values(record, tag="035", code="a")[0].split(":")[-1]
-        res = attempt_record_match(recid)
-        if res:
-            # Record exists and we should then delete it
-            _print("Record %s exists. Delete it" % (recid,))
-            append_records.append(record)
+            # Step 1: Attempt to match the record to those already in Inspire
+            try:
+                recid = record['001'][0][3]
+                res = attempt_record_match(recid)
+            except (KeyError, IndexError):
+                _print('Error: Cannot process record without 001:recid')
+                error_file.write(record)
+                continue
 
-    # Output results. Create new files, if necessary.
-    if input_filename[-4:].lower() == '.xml':
-        input_filename = input_filename[:-4]
+            if skip_recid_check or not res:
+                _print("Record %s does not exist: inserting" % (recid,))
+                # No record found
+                # Step 2: Appply filter to transform CDS MARC to Inspire MARC
+                waiting_records.append(apply_filter(record, plot_converter))
+                if len(waiting_records) > MAX_RECORDS_WAITING_FOR_PLOTS:
+                    insert_file.write(plot_converter.attach(waiting_records.popleft()))
+            else:
+                _print("Record %s found: %r" % (recid, res))
+
+        while waiting_records:
+            insert_file.write(plot_converter.attach(waiting_records.popleft()))
+        completed = True
+    finally:
+        if completed:
+            plot_converter.close()
+            for output in (insert_file, append_file, error_file):
+                output.close()
+        else:
+            plot_converter.terminate()
+            for output in (insert_file, append_file, error_file):
+                output.discard()
 
-    write_record_to_file("%s.insert.xml" % (input_filename,), insert_records)
-    _print("%s.insert.xml" % (input_filename,))
+    _print("%s.insert.xml" % (output_prefix,))
     _print("Number of records to insert:  %d\n"
-           % (len(insert_records),))
-    write_record_to_file("%s.append.xml" % (input_filename,), append_records)
-    _print("%s.append.xml" % (input_filename,))
+           % (insert_file.count,))
+    _print("%s.append.xml" % (output_prefix,))
     _print("Number of records to append:  %d\n"
-           % (len(append_records),))
-    write_record_to_file("%s.errors.xml" % (input_filename,), error_records)
-    _print("%s.errors.xml" % (input_filename,))
+           % (append_file.count,))
+    _print("%s.errors.xml" % (output_prefix,))
     _print("Number of records with errors:  %d\n"
-           % (len(append_records),))
+           % (error_file.count,))
 
 
 # ==============================| Functions |==============================
@@ -199,9 +276,122 @@ def write_record_to_file(filename, record_list):
             file_fd.close()
 
 
+class RecordFileWriter(object):
+    """
+    Writes records to a new MARCXML file as they come. As with
+    write_record_to_file, the file is only created if there is a record
+    to write. Records are written to filename.part, which close() renames
+    to filename and discard() removes.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.part_filename = filename + '.part'
+        self.file_fd = None
+        self.count = 0
+
+    def write(self, record):
+        self.count += 1
+        if record == {}:
+            return
+        if self.file_fd is None:
+            self.file_fd = open(self.part_filename, 'w')
+            self.file_fd.write("<collection>")
+        self.file_fd.write("\n" + record_xml_output(record))
+
+    def close(self):
+        if self.file_fd is not None:
+            self.file_fd.write("\n</collection>")
+            self.file_fd.close()
+            self.file_fd = None
+            os.rename(self.part_filename, self.filename)
+
+    def discard(self):
+        if self.file_fd is not None:
+            self.file_fd.close()
+            self.file_fd = None
+            os.remove(self.part_filename)
+
+
+def normalize_config_value(value):
+    """ Normalizes a CDS value the way the keys of the rule tables are:
+    UTF-8 encoded, with its whitespace collapsed """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return ' '.join(value.split())
+
+
+def experiment_key(accelerator, experiment):
+    """ Returns the key of the experiments table for the 693 subfields """
+    return "%s---%s" % (accelerator.replace(" ", "-"), experiment)
+
+
+def compile_config(conf):
+    """ Turns the JSON configuration into lookup tables
+
+    Besides the cds -> inspire dictionaries, the rule tables used by
+    apply_filter are built here, keyed on normalized CDS values, so that
+    each field of a record costs a single lookup:
+     * languages - language code (lower case) -> Inspire language
+     * journals - journal name -> Inspire journal title
+     * experiments - experiment key -> Inspire experiment
+     * categories - category -> (term source, term) of the 650 field
+    """
+    config = {'config': {}, 'tables': {}}
+    for key, values in conf['config'].iteritems():
+        parse_dict = {}
+        for di in values:
+            try:
+                parse_dict[di['cds']] = di['inspire']
+            except KeyError:
+                _print("ERROR: Could not parse dictionary pair %s" % repr(di))
+        config['config'][key] = parse_dict
+
+        table = {}
+        for cds, inspire in parse_dict.iteritems():
+            cds = normalize_config_value(cds)
+            inspire = inspire.encode('utf-8')
+            if key == 'languages':
+                cds = cds.lower()
+            elif key == 'categories':
+                if inspire != cds:
+                    inspire = ('INSPIRE', inspire)
+                else:
+                    inspire = ('SzGeCERN', inspire)
+            table[cds] = inspire
+        config['tables'][key] = table
+    return config
+
+
+def get_config_cache_path(json_file):
+    return os.path.join(CFG_TMPSHAREDDIR,
+                        os.path.basename(json_file) + '.cache')
+
+
 def load_config(json_file=CONFIG_FILE):
-    """ Loads configuration from JSON file """
+    """ Loads configuration from JSON file
+
+    The compiled configuration is cached next to the other temporary files,
+    and reused as long as the JSON file is not modified.
+    """
     _print('Loading config from %s' % json_file, verbose=5)
+    global CONFIG
+    cache_path = get_config_cache_path(json_file)
+    try:
+        mtime = os.path.getmtime(json_file)
+    except OSError:
+        _print("FATAL ERROR: Could not read config file.")
+        sys.exit(1)
+    try:
+        handle = open(cache_path, 'rb')
+        version, cached_path, cached_mtime, config = marshal.load(handle)
+        handle.close()
+        if (version, cached_path, cached_mtime) == \
+           (CONFIG_CACHE_VERSION, os.path.abspath(json_file), mtime):
+            CONFIG = config
+            return
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+
     try:
         handle = open(json_file, 'r')
         conf = json.load(handle)
@@ -210,16 +400,14 @@ def load_config(json_file=CONFIG_FILE):
         _print("FATAL ERROR: Could not read config file.")
         sys.exit(1)
 
-    global CONFIG
-    CONFIG = {'config': {}}
-    for key, values in conf['config'].iteritems():
-        parse_dict = {}
-        for di in values:
-            try:
-                parse_dict[di['cds']] = di['inspire']
-            except KeyError:
-                _print("ERROR: Could not parse dictionary pair %s" % repr(di))
-        CONFIG['config'][key] = parse_dict
+    CONFIG = compile_config(conf)
+    try:
+        handle = open(cache_path + '.tmp', 'wb')
+        marshal.dump((CONFIG_CACHE_VERSION, os.path.abspath(json_file), mtime, CONFIG), handle)
+        handle.close()
+        os.rename(cache_path + '.tmp', cache_path)
+    except (IOError, OSError):
+        _print("Warning: could not write config cache %s" % (cache_path,))
 
 
 def get_languages():
@@ -238,17 +426,67 @@ def get_categories():
     return CONFIG['config']['categories']
 
 
+def get_tables():
+    return CONFIG['tables']
+
+
 def determine_collection(setspec):
     """ Splits setSpec header attribute for collection """
     return setspec.split(':')[-1:][0].upper()
 
 
-def element_tree_to_record(tree, header_subs=None):
-    marcxml = ET.tostring(tree.getroot(), encoding="utf-8")
+def element_to_record(element):
+    """ Converts a MARCXML <record> element into a BibRecord record """
+    marcxml = ET.tostring(element, encoding="utf-8")
     record, status, errors = create_record(marcxml)
     if errors:
         _print(str(status))
-    return [record], []
+    return record
+
+
+def oai_element_to_record(record_element, header_subs):
+    """ Converts an OAI <record> element into a BibRecord record.
+
+    @return: (record, deleted_record) A tuple where only one is not None,
+             depending on whether the record was deleted. Both are None if
+             the record could not be created.
+    """
+    header = record_element.find('header')
+
+    # Add to OAI subfield
+    datestamp = header.find('datestamp')
+    identifier = header.find('identifier')
+    identifier = identifier.text
+
+    # The record's subfield is based on header information
+    subs = list(header_subs)
+    subs.append(("a", identifier))
+    subs.append(("d", datestamp.text))
+
+    if "status" in header.attrib and header.attrib["status"] == "deleted":
+        # Record was deleted - create delete record
+        recid = identifier.split(":")[-1]
+        deleted_record = {}
+        record_add_field(deleted_record, "035", subfields=[("9", "CDS"), ("a", recid)])
+        record_add_field(deleted_record, "037", subfields=subs)
+        record_add_field(deleted_record, "980", subfields=[("c", "DELETED")])
+        _print("Record has been deleted: %s" % (identifier,))
+        return None, deleted_record
+
+    marc_root = record_element.find('metadata').find('record')
+    marcxml = ET.tostring(marc_root, encoding="utf-8")
+    record, status, errors = create_record(marcxml)
+    if status == 1:
+        # Add OAI request information
+        record_add_field(record, "035", subfields=subs)
+        return record, None
+    _print("ERROR: Could not create record from %s" % (identifier,))
+    _print(" * %r" % (errors,))
+    return None, None
+
+
+def element_tree_to_record(tree, header_subs=None):
+    return [element_to_record(tree.getroot())], []
 
 
 def element_tree_collection_to_records(tree, header_subs=None):
@@ -265,11 +503,7 @@ def element_tree_collection_to_records(tree, header_subs=None):
     records = []
     collection = tree.getroot()
     for record_element in collection.getchildren():
-        marcxml = ET.tostring(record_element, encoding="utf-8")
-        record, status, errors = create_record(marcxml)
-        if errors:
-            _print(str(status))
-        records.append(record)
+        records.append(element_to_record(record_element))
     return records, []
 
 
@@ -308,40 +542,63 @@ def element_tree_oai_to_records(tree, header_subs=None):
 
     oai_records = tree.getroot()
     for record_element in oai_records.getchildren():
-        header = record_element.find('header')
-
-        # Add to OAI subfield
-        datestamp = header.find('datestamp')
-        identifier = header.find('identifier')
-        identifier = identifier.text
-
-        # The record's subfield is based on header information
-        subs = list(header_subs)
-        subs.append(("a", identifier))
-        subs.append(("d", datestamp.text))
-
-        if "status" in header.attrib and header.attrib["status"] == "deleted":
-            # Record was deleted - create delete record
-            recid = identifier.split(":")[-1]
-            deleted_record = {}
-            record_add_field(deleted_record, "035", subfields=[("9", "CDS"), ("a", recid)])
-            record_add_field(deleted_record, "037", subfields=subs)
-            record_add_field(deleted_record, "980", subfields=[("c", "DELETED")])
+        record, deleted_record = oai_element_to_record(record_element, header_subs)
+        if record is not None:
+            records.append(record)
+        elif deleted_record is not None:
             deleted_records.append(deleted_record)
-            _print("Record has been deleted: %s" % (identifier,))
+    return records, deleted_records
+
+
+def iter_records(input_filename):
+    """
+    Streaming counterpart of clean_xml followed by the element_tree_*
+    function it returns: parses the file incrementally and yields a
+    (record, deleted_record) tuple per record, as soon as it is parsed.
+
+    Handles the same inputs as clean_xml (OAI-PMH response, <collection>
+    or single <record>). Converted elements are dropped from the tree, so
+    memory use does not depend on the size of the harvest.
+    """
+    stack = []
+    header_subs = None
+    found_oai_records = False
+    for event, element in ET.iterparse(input_filename, events=('start', 'end')):
+        if event == 'start':
+            stack.append(element)
             continue
+        stack.pop()
+        try:
+            element.tag = element.tag.split('}')[1]
+        except IndexError:
+            pass
 
-        marc_root = record_element.find('metadata').find('record')
-        marcxml = ET.tostring(marc_root, encoding="utf-8")
-        record, status, errors = create_record(marcxml)
-        if status == 1:
-            # Add OAI request information
-            record_add_field(record, "035", subfields=subs)
-            records.append(record)
-        else:
-            _print("ERROR: Could not create record from %s" % (identifier,))
-            _print(" * %r" % (errors,))
-    return records, deleted_records
+        if not stack:
+            # End of the root element
+            if element.tag.lower() == 'record':
+                yield element_to_record(element), None
+            elif element.tag.lower() != 'collection' and not found_oai_records:
+                raise ValueError("Cannot find ListRecords or GetRecord!")
+            return
+
+        parent = stack[-1]
+        root_tag = stack[0].tag.split('}')[-1]
+        if root_tag.lower() == 'collection':
+            if len(stack) == 1 and element.tag.lower() == 'record':
+                yield element_to_record(element), None
+                parent.remove(element)
+        elif len(stack) == 1 and element.tag in ('ListRecords', 'GetRecord'):
+            found_oai_records = True
+        elif len(stack) == 2 and element.tag == 'record' and \
+                parent.tag.split('}')[-1] in ('ListRecords', 'GetRecord'):
+            if header_subs is None:
+                # The request information comes before the records
+                header_subs = tuple(get_request_subfields(stack[0]))
+            strip_xml_namespace(element)
+            record, deleted_record = oai_element_to_record(element, header_subs)
+            if record is not None or deleted_record is not None:
+                yield record, deleted_record
+            parent.remove(element)
 
 
 def get_request_subfields(root):
@@ -419,7 +676,7 @@ def strip_xml_namespace(root):
         strip_xml_namespace(element)
 
 
-def apply_filter(rec):
+def apply_filter(rec, plot_converter=None):
     """ Filters the record to be compatible within Inspire
     Parameters:
      * rec - dictionary: BibRecord structure
@@ -434,13 +691,8 @@ def apply_filter(rec):
     record_strip_controlfields(rec)
 
     # Clear other uninteresting fields
-    interesting_fields = ["024", "041", "035", "037", "088", "100",
-                          "110", "111", "242", "245", "246", "260",
-                          "269", "300", "502", "650", "653", "693",
-                          "700", "710", "773", "856", "520", "500",
-                          "980"]
     for tag in rec.keys():
-        if tag not in interesting_fields:
+        if tag not in INTERESTING_FIELDS:
             record_delete_fields(rec, tag)
 
     # 980 Determine Collections
@@ -459,12 +711,8 @@ def apply_filter(rec):
         collections.add("CITEABLE")
 
     if not 'NOTE' in collections:
-        # TODO: Move this to a KB
-        kb = ['ATLAS-CONF-', 'CMS-PAS-', 'ATL-', 'CMS-DP-',
-              'ALICE-INT-', 'LHCb-PUB-']
-        values = record_get_field_values(rec, "088", code='a')
-        for val, rep in product(values, kb):
-            if val.startswith(rep):
+        for val in record_get_field_values(rec, "088", code='a'):
+            if val.startswith(NOTE_REPORT_PREFIXES):
                 collections.add('NOTE')
                 break
 
@@ -496,34 +744,31 @@ def apply_filter(rec):
                        val.split('CMS', 1)[-1])
                 record_add_field(rec, '856', ind1='4', subfields=[('u', url)])
 
+    tables = get_tables()
+
     # 041 Language
-    languages = get_languages()
+    languages = tables['languages']
     language_fields = record_get_field_instances(rec, '041')
     record_delete_fields(rec, "041")
     for field in language_fields:
         subs = field_get_subfields(field)
         if 'a' in subs:
-            if "eng" in subs['a']:
+            codes = [normalize_config_value(code).lower() for code in subs['a']]
+            if "eng" in codes:
                 continue
-            new_value = translate_config(subs['a'][0], languages)
+            new_value = languages.get(codes[0], subs['a'][0])
             new_subs = [('a', new_value)]
             record_add_field(rec, "041", subfields=new_subs)
 
     # 035 Externals
     scn_035_fields = record_get_field_instances(rec, '035')
-    forbidden_values = ["cercer",
-                        "inspire",
-                        "xx",
-                        "cern annual report",
-                        "cmscms",
-                        "wai01"]
     for field in scn_035_fields:
         subs = field_get_subfields(field)
         if '9' in subs:
             if not 'a' in subs:
                 continue
             for sub in subs['9']:
-                if sub.lower() in forbidden_values:
+                if sub.lower() in FORBIDDEN_035_VALUES:
                     break
             else:
                 # No forbidden values (We did not "break")
@@ -534,7 +779,7 @@ def apply_filter(rec):
                     continue
         if 'a' in subs:
             for sub in subs['a']:
-                if sub.lower() in forbidden_values:
+                if sub.lower() in FORBIDDEN_035_VALUES:
                     record_delete_field(rec, tag="035",
                                         field_position_global=field[4])
 
@@ -591,7 +836,7 @@ def apply_filter(rec):
         for idx, (key, value) in enumerate(field[0]):
             if key == 'a':
                 if "mult." not in value and value != " p":
-                    field[0][idx] = ('a', re.sub(r'[^\d-]+', '', value))
+                    field[0][idx] = ('a', RE_NOT_PAGE_NUMBER.sub('', value))
                 else:
                     record_delete_field(rec, '300',
                                         field_position_global=field[4])
@@ -630,17 +875,15 @@ def apply_filter(rec):
         fields_501[idx] = field_swap_subfields(field, new_subs)
 
     # 650 Translate Categories
-    categories = get_categories()
+    categories = tables['categories']
     category_fields = record_get_field_instances(rec, '650', ind1='1', ind2='7')
     record_delete_fields(rec, "650")
     for field in category_fields:
         for idx, (key, value) in enumerate(field[0]):
             if key == 'a':
-                new_value = translate_config(value, categories)
-                if new_value != value:
-                    new_subs = [('2', 'INSPIRE'), ('a', new_value)]
-                else:
-                    new_subs = [('2', 'SzGeCERN'), ('a', value)]
+                source, term = categories.get(normalize_config_value(value),
+                                              ('SzGeCERN', value))
+                new_subs = [('2', source), ('a', term)]
                 record_add_field(rec, "650", ind1="1", ind2="7",
                                  subfields=new_subs)
                 break
@@ -655,7 +898,7 @@ def apply_filter(rec):
         new_field = create_field(subfields=new_subs, ind1='1')
         record_replace_field(rec, '653', new_field, field_position_global=field[4])
 
-    experiments = get_experiments()
+    experiments = tables['experiments']
     # 693 Remove if 'not applicable'
     for field in record_get_field_instances(rec, '693'):
         subs = field_get_subfields(field)
@@ -672,10 +915,10 @@ def apply_filter(rec):
                 new_subs.append((key, value[0]))
             elif key == 'e':
                 experiment_e = value[0]
-        experiment = "%s---%s" % (experiment_a.replace(" ", "-"),
-                                  experiment_e)
-        translated_experiments = translate_config(experiment,
-                                                  experiments)
+        experiment = experiment_key(normalize_config_value(experiment_a),
+                                    normalize_config_value(experiment_e))
+        translated_experiments = experiments.get(
+            experiment, experiment_key(experiment_a, experiment_e))
         new_subs.append(("e", translated_experiments))
         record_delete_field(rec, tag="693",
                             field_position_global=field[4])
@@ -693,18 +936,12 @@ def apply_filter(rec):
         record_add_field(rec, "710", subfields=new_subs)
 
     # 773 journal translations
-    journals = get_journals()
+    journals = tables['journals']
     for field in record_get_field_instances(rec, '773'):
-        subs = field_get_subfield_instances(field)
-        new_subs = []
-        for idx, (key, value) in enumerate(subs):
+        for idx, (key, value) in enumerate(field[0]):
             if key == 'p':
-                new_subs.append((key, translate_config(value, journals)))
-            else:
-                new_subs.append((key, value))
-        record_delete_field(rec, tag="773",
-                            field_position_global=field[4])
-        record_add_field(rec, "773", subfields=new_subs)
+                field[0][idx] = (key, journals.get(normalize_config_value(value),
+                                                   value))
 
     # FFT (856) Dealing with graphs
     figure_counter = 0
@@ -722,26 +959,11 @@ def apply_filter(rec):
                     url = subs['u'][0]
                     if url.endswith(".pdf"):
                         # We try to convert
-                        fd, local_url = mkstemp(suffix=os.path.basename(url), dir=CFG_TMPSHAREDDIR)
-                        os.close(fd)
-                        _print("Downloading %s into %s" % (url, local_url), verbose=5)
-                        plotfile = ""
-                        try:
-                            plotfile = download_url(url=url,
-                                                    download_to_file=local_url,
-                                                    timeout=30.0)
-                        except InvenioFileDownloadError:
-                            _print("Download failed while attempting to reach %s. Skipping.." % (url,))
-                            remove = True
-                        if plotfile:
-                            converted = convert_images([plotfile])
-                            if converted:
-                                url = converted.pop()
-                                _print("Successfully converted %s to %s" % (local_url, url), verbose=5)
-                            else:
-                                _print("Conversion failed on %s" % (local_url,))
-                                url = None
-                                remove = True
+                        remove = True
+                        if plot_converter is not None:
+                            url = plot_converter.submit(url)
+                        else:
+                            url = convert_plot(url)
                     if url:
                         newsubs.append(('a', url))
                         newsubs.append(('t', 'Plot'))
@@ -791,11 +1013,8 @@ def apply_filter(rec):
                         record_add_field(rec, 'FFT', subfields=plotsubs)
 
         if not remove and not newsubs and 'u' in subs:
-            urls = ('http://cdsweb.cern.ch', 'http://cms.cern.ch',
-                    'http://cmsdoc.cern.ch', 'http://documents.cern.ch',
-                    'http://preprints.cern.ch', 'http://cds.cern.ch')
             for val in subs['u']:
-                if any(url in val for url in urls):
+                if any(url in val for url in CDS_URLS):
                     remove = True
                     break
                 if val.endswith('ps.gz'):
@@ -820,6 +1039,144 @@ def apply_filter(rec):
     return rec
 
 
+def benchmark_filter(input_filename):
+    """
+    Runs apply_filter on every record of the given harvest file.
+
+    Figures are neither downloaded nor converted, so that only the
+    filtering itself is measured.
+
+    @return: (number of records, seconds spent in apply_filter)
+    """
+    nb_records = 0
+    seconds = 0.0
+    plot_converter = SkippedPlotConverter()
+    for record, dummy in iter_records(input_filename):
+        if record is None:
+            continue
+        start = time.time()
+        apply_filter(record, plot_converter)
+        seconds += time.time() - start
+        nb_records += 1
+    return nb_records, seconds
+
+
+def convert_plot(url, cache_dir=CFG_PLOT_CACHE_DIR):
+    """
+    Downloads the figure at the given URL and converts it to PNG.
+
+    The result is stored in cache_dir under the SHA1 of the downloaded
+    file: a figure that was already converted is not converted again.
+
+    @return: the path of the converted figure, the URL itself if it could
+             not be downloaded, or None if the conversion failed.
+    """
+    fd, local_url = mkstemp(suffix=os.path.basename(url), dir=CFG_TMPSHAREDDIR)
+    os.close(fd)
+    _print("Downloading %s into %s" % (url, local_url), verbose=5)
+    try:
+        plotfile = download_url(url=url,
+                                download_to_file=local_url,
+                                timeout=30.0)
+    except InvenioFileDownloadError:
+        _print("Download failed while attempting to reach %s. Skipping.." % (url,))
+        return url
+    if not plotfile:
+        return url
+
+    sha1 = hashlib.sha1()
+    plot_fd = open(plotfile, 'rb')
+    for block in iter(lambda: plot_fd.read(65536), ''):
+        sha1.update(block)
+    plot_fd.close()
+    cached_plot = os.path.join(cache_dir, sha1.hexdigest() + '.png')
+    if os.path.exists(cached_plot):
+        _print("%s was already converted to %s" % (url, cached_plot), verbose=5)
+        os.remove(plotfile)
+        return cached_plot
+
+    converted = convert_images([plotfile])
+    if not converted:
+        _print("Conversion failed on %s" % (local_url,))
+        return None
+    converted = converted.pop()
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Created in the meantime by another process
+            pass
+    # Several processes may convert the same figure: only complete files
+    # are renamed into the cache.
+    fd, tmp_plot = mkstemp(suffix='.png', dir=cache_dir)
+    os.close(fd)
+    shutil.copyfile(converted, tmp_plot)
+    os.rename(tmp_plot, cached_plot)
+    _print("Successfully converted %s to %s" % (local_url, cached_plot), verbose=5)
+    return cached_plot
+
+
+class PlotConverter(object):
+    """
+    Converts the figures of the filtered records in a pool of processes.
+
+    apply_filter submits the figures of a record and leaves placeholders
+    in its FFT fields. attach waits for the conversions and replaces the
+    placeholders with the converted files before the record is written.
+    """
+    def __init__(self, processes=CFG_PLOT_CONVERSION_PROCESSES,
+                 cache_dir=CFG_PLOT_CACHE_DIR):
+        self.pool = Pool(processes)
+        self.cache_dir = cache_dir
+        self.conversions = {}
+
+    def submit(self, url):
+        """Starts converting the figure at url and returns its placeholder."""
+        if url not in self.conversions:
+            self.conversions[url] = self.pool.apply_async(convert_plot,
+                                                          (url, self.cache_dir))
+        return PLOT_PLACEHOLDER_PREFIX + url
+
+    def attach(self, rec):
+        """Replaces the placeholders of rec with the converted figures."""
+        failed_fields = []
+        for field in record_get_field_instances(rec, 'FFT'):
+            subs = field_get_subfield_instances(field)
+            for idx, (key, value) in enumerate(subs):
+                if key == 'a' and value.startswith(PLOT_PLACEHOLDER_PREFIX):
+                    url = value[len(PLOT_PLACEHOLDER_PREFIX):]
+                    converted = self.conversions[url].get()
+                    if converted:
+                        subs[idx] = ('a', converted)
+                    else:
+                        failed_fields.append((field, url))
+        for field, url in failed_fields:
+            record_delete_field(rec, 'FFT', field_position_global=field[4])
+            # Same fallback as in apply_filter for the figures that are
+            # not converted
+            if "subformat=pdfa" not in url:
+                record_add_field(rec, 'FFT', subfields=[('t', 'INSPIRE-PUBLIC'),
+                                                        ('a', url)])
+        return rec
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.conversions = {}
+
+    def terminate(self):
+        """Stops the pool without waiting for the pending conversions."""
+        self.pool.terminate()
+        self.pool.join()
+        self.conversions = {}
+
+
+class SkippedPlotConverter(object):
+    """Leaves the figures as they are, for benchmark_filter."""
+    def submit(self, url):
+        return url
+
+
 def field_get_subfields(field):
     """ Given a field, will place all subfields into a dictionary
     Parameters:
@@ -840,7 +1197,16 @@ def field_swap_subfields(field, subs):
 
 
 def attempt_record_match(recid):
-    """ Tries to find out if the record is already in Inspire """
+    """ Tries to find out if the record is already in Inspire
+
+    Uses the external ID index when it has been built, which costs a
+    lookup instead of two searches per record. main() refreshes the index
+    before filtering, so a record it does not know about is a new one.
+    """
+    index = get_external_id_index()
+    if index is not None:
+        return list(index.get(external_id_key('cds', recid)))
+
     res = perform_request_search(p="595__a:CDS-%s" % (recid,), of="id", ap=-9)
     if res:
         return res
@@ -874,15 +1240,6 @@ def is_published(record):
     return False
 
 
-def translate_config(key, config_dict):
-    """ Given a string, this returns the Inspire equivilant
-    found in the given config dictionary by searching the
-    imported configuration """
-    if key in config_dict:
-        return config_dict[key]
-    return key
-
-
 def punctuate_authorname(an):
     """ Punctuates author names, expects input in the form
     'Bloggs, J K'  and will return 'Bloggs, J. K.'
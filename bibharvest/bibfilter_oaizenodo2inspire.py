@@ -53,6 +53,8 @@ from invenio.bibrecord import (create_record,
                                create_field,
                                record_strip_controlfields)
 from invenio.search_engine import perform_request_search
+from invenio.externalidindex import get_external_id_index, refresh_external_id_index, \
+    match_external_ids
 from invenio.bibtask import write_message
 
 # NB: For future reference, elementtree.ElementTree is depreciated after
@@ -118,17 +120,34 @@ def main(args):
     sys.setdefaultencoding("utf8")
     assert sys.getdefaultencoding() == "utf8"
 
+    # Records created since the last bst_external_id_index run must be
+    # known before matching
+    refresh_external_id_index()
+
     record_tree, next_process, header_subs = clean_xml(input_filename)
     records, deleted_records = next_process(record_tree, header_subs)
     insert_records = []
     append_records = []
     error_records = []
 
+    # Match all the Zenodo IDs of the file at once
+    zenodo_ids = []
+    for record in records:
+        try:
+            zenodo_ids.append(record['001'][0][3])
+        except (KeyError, IndexError):
+            pass
+    zenodo_ids.extend([record_get_field_values(record,
+                                               tag="035",
+                                               code="a")[0].split(":")[-1]
+                       for record in deleted_records])
+    matches = match_records(zenodo_ids)
+
     for record in records:
         # Step 1: Attempt to match the record to those already in Inspire
         try:
             recid = record['001'][0][3]
-            res = attempt_record_match(recid)
+            res = matches[recid]
             print(res)
         except (KeyError, IndexError) as err:
             _print('Error: Cannot process record without 001:recid')
@@ -148,7 +167,7 @@ def main(args):
         recid = record_get_field_values(record,
                                         tag="035",
                                         code="a")[0].split(":")[-1]
-        res = attempt_record_match(recid)
+        res = matches[recid]
         if res:
             # Record exists and we should then delete it
             _print("Record %s exists. Delete it" % (recid,))
@@ -426,20 +445,14 @@ def apply_filter(rec):
         subs = field_get_subfields(field)
         if 'i' in subs and 'isSupplementTo' in subs['i']:
             if 'n' in subs and "doi" in [s.lower() for s in subs['n']]:
-                paper_recid = perform_request_search(
-                    p="0247_a:%s" % subs['a'][0],
-                    of="id"
-                )
+                paper_recid = find_paper('doi', subs['a'][0])
 
                 if paper_recid:
                     record_add_field(rec,
                                      "786",
                                      subfields=[('w', str(paper_recid[0]))])
             if 'n' in subs and "arxiv" in [s.lower() for s in subs['n']]:
-                paper_recid = perform_request_search(
-                    p="037__a:%s" % subs['a'][0],
-                    of="id"
-                )
+                paper_recid = find_paper('arxiv', subs['a'][0])
 
                 if paper_recid:
                     record_add_field(rec,
@@ -470,6 +483,29 @@ def field_get_subfields(field):
     return pairs
 
 
+def match_records(recids):
+    """ Finds out which of the given Zenodo records are already in Inspire
+
+    Returns a dictionary of every Zenodo record ID to its Inspire matches.
+    Uses the external ID index when it has been built, which costs a
+    lookup instead of a search per record. main() refreshes the index
+    before filtering, so a record it does not match is a new one.
+    """
+    if get_external_id_index() is not None:
+        return dict((recid, list(res)) for recid, res
+                    in match_external_ids('zenodo', recids).iteritems())
+    return dict((recid, attempt_record_match(recid)) for recid in recids)
+
+
+def find_paper(kind, identifier):
+    """ Finds the Inspire records of the paper with the given DOI or arXiv ID """
+    if get_external_id_index() is not None:
+        return list(match_external_ids(kind, [identifier])[identifier])
+    if kind == 'doi':
+        return perform_request_search(p="0247_a:%s" % identifier, of="id")
+    return perform_request_search(p="037__a:%s" % identifier, of="id")
+
+
 def attempt_record_match(recid):
     """ Tries to find out if the record is already in Inspire """
     return perform_request_search(
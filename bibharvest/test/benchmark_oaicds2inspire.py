@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of INSPIRE.
+# Copyright (C) 2018 CERN.
+#
+# INSPIRE is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# INSPIRE is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with INSPIRE; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Times apply_filter of bibfilter_oaicds2inspire against a baseline version
+of the filter, on the same records.
+
+Usage: benchmark_oaicds2inspire.py BASELINE [HARVEST_FILE [PASSES]]
+
+ * BASELINE - path to another bibfilter_oaicds2inspire.py, or a git
+   revision of this repository to take it from
+ * HARVEST_FILE - defaults to oaicds_sample.xml, next to this script
+ * PASSES - number of timed passes over the records, the best is kept
+   (default 20)
+
+Both versions use the configuration of this tree. Figures are neither
+downloaded nor converted. The records output by both versions are
+compared, and any difference is reported.
+"""
+
+import copy
+import imp
+import inspect
+import os
+import subprocess
+import sys
+import time
+from tempfile import mkstemp
+
+from invenio.bibrecord import record_xml_output
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+FILTER_DIR = os.path.dirname(TEST_DIR)
+FILTER_FILE = os.path.join(FILTER_DIR, 'bibfilter_oaicds2inspire.py')
+CONFIG_FILE = os.path.join(FILTER_DIR, 'oaicds_bibfilter_config.json')
+SAMPLE_FILE = os.path.join(TEST_DIR, 'oaicds_sample.xml')
+
+
+class SkippedPlotConverter(object):
+    """Leaves the figures as they are."""
+    def submit(self, url):
+        return url
+
+
+def load_filter(name, baseline):
+    """ Loads the filter module from a file, or from a git revision """
+    if os.path.isfile(baseline):
+        return imp.load_source(name, baseline)
+    source = subprocess.check_output(
+        ['git', 'show', '%s:bibharvest/bibfilter_oaicds2inspire.py' % baseline],
+        cwd=FILTER_DIR)
+    fd, filename = mkstemp(suffix='.py')
+    try:
+        os.write(fd, source)
+        os.close(fd)
+        return imp.load_source(name, filename)
+    finally:
+        os.remove(filename)
+        if os.path.exists(filename + 'c'):
+            os.remove(filename + 'c')
+
+
+def run_filter(module, records):
+    """ Runs apply_filter on a copy of the records
+
+    @return: (filtered records, seconds spent in apply_filter)
+    """
+    records = copy.deepcopy(records)
+    args = ()
+    if len(inspect.getargspec(module.apply_filter).args) > 1:
+        # The plot converter argument is missing from older versions
+        args = (SkippedPlotConverter(),)
+    start = time.time()
+    for record in records:
+        module.apply_filter(record, *args)
+    return records, time.time() - start
+
+
+def benchmark(module, records, passes):
+    """ @return: (filtered records, best time of the passes) """
+    module.load_config(CONFIG_FILE)
+    best = None
+    for dummy in range(passes):
+        filtered, seconds = run_filter(module, records)
+        if best is None or seconds < best:
+            best = seconds
+    return filtered, best
+
+
+def main(args):
+    if not 1 <= len(args) <= 3:
+        print __doc__
+        return 1
+    harvest_file = SAMPLE_FILE
+    passes = 20
+    if len(args) > 1:
+        harvest_file = args[1]
+    if len(args) > 2:
+        passes = int(args[2])
+
+    current = imp.load_source('bibfilter_oaicds2inspire', FILTER_FILE)
+    baseline = load_filter('bibfilter_oaicds2inspire_baseline', args[0])
+    records = [record for record, dummy in current.iter_records(harvest_file)
+               if record is not None]
+    if not records:
+        print "No records in %s" % (harvest_file,)
+        return 1
+
+    results = {}
+    for label, module in (('baseline', baseline), ('current', current)):
+        filtered, seconds = benchmark(module, records, passes)
+        results[label] = [record_xml_output(record) for record in filtered]
+        print "%-8s %d records in %.4fs, %.1f records/s" % \
+            (label, len(records), seconds, len(records) / seconds)
+
+    differences = 0
+    for idx, (old, new) in enumerate(zip(results['baseline'],
+                                         results['current'])):
+        if old != new:
+            differences += 1
+            print "Record %d differs:\n%s\n%s" % (idx + 1, old, new)
+    if differences:
+        print "%d of %d records differ" % (differences, len(records))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
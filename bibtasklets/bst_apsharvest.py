@@ -41,17 +41,17 @@ from invenio.apsharvest_dblayer import (fetch_last_updated,
                                         get_all_modified_records,
                                         store_last_updated)
 from invenio.apsharvest_utils import (validate_date,
-                                      get_record_from_doi,
+                                      get_records_from_dois,
                                       )
 from invenio.apsharvest_config import (CFG_APSHARVEST_SEARCH_COLLECTION,
                                        CFG_APSHARVEST_BUNCH_SIZE,
-                                       CFG_APSHARVEST_THRESHOLD_DAYS)
+                                       CFG_APSHARVEST_THRESHOLD_DAYS,
+                                       CFG_APSHARVEST_STAGE_WORKERS)
 from invenio.apsharvest_engine import (APSHarvestJob,
                                        APSRecordList,
                                        APSRecord,
                                        )
-from invenio.apsharvest_errors import (APSHarvesterSearchError,
-                                       APSHarvesterConnectionError,
+from invenio.apsharvest_errors import (APSHarvesterConnectionError,
                                        )
 
 
@@ -65,7 +65,7 @@ def bst_apsharvest(dois="", recids="", query="", records="", new_mode="email",
                    update_mode="email", from_date="", until_date=None,
                    metadata="yes", fulltext="yes", hidden="yes", match="no",
                    reportonly="no", threshold_date=None, devmode="no",
-                   input_file=""):
+                   input_file="", workers=""):
     """
     Task to download APS metadata + fulltext given a list of arguments.
 
@@ -178,6 +178,11 @@ def bst_apsharvest(dois="", recids="", query="", records="", new_mode="email",
 
     @param input_file: harvests articles with given file containing one DOI per line.
     @type input_file: string
+
+    @param workers: number of workers of the harvesting stages (download,
+                    validate and convert), e.g. "download=1,convert=8".
+                    Stages not given keep CFG_APSHARVEST_STAGE_WORKERS.
+    @type workers: string
     """
     task_update_progress("Parsing input parameters")
 
@@ -225,6 +230,16 @@ def bst_apsharvest(dois="", recids="", query="", records="", new_mode="email",
     else:
         reportonly = False
 
+    stage_workers = {}
+    for stage in workers.split(','):
+        if not stage.strip():
+            continue
+        name, number = stage.split('=')
+        if name.strip() not in CFG_APSHARVEST_STAGE_WORKERS:
+            raise Exception("Warning: given stage '%s' is not valid." % (name,))
+        stage_workers[name.strip()] = int(number)
+    workers = stage_workers
+
     if input_file:
         if not os.path.exists(input_file):
             write_message("Input file {0} does not exist!".format(input_file),
@@ -361,14 +376,14 @@ def get_records_to_harvest(parameters):
             write_message("Parsing DOIs...")
 
             # We are doing DOIs, we need to get record ids
-            for doi in parameters.get("dois").split(','):
-                doi = doi.strip()
-                try:
-                    recid = get_record_from_doi(doi)
-                except APSHarvesterSearchError, e:
-                    write_message("Error while getting recid from %s: %s" %
-                                  (doi, str(e)))
+            dois = [doi.strip() for doi in parameters.get("dois").split(',')]
+            recids, mismatches = get_records_from_dois(dois)
+            for doi in dois:
+                if doi in mismatches:
+                    write_message("Error while getting recid from %s: DOI mismatch: %s" %
+                                  (doi, ",".join([str(recid) for recid in mismatches[doi]])))
                     continue
+                recid = recids.get(doi)
                 if not recid:
                     # Record not found on the system, we harvest from APS
                     write_message("No recid found, we get record from APS")
@@ -424,7 +439,8 @@ def process_records(job, parameters, final_record_list):
 
     Process records by using the perform_fulltext_harvest generator which
     downloads the article packages, unzip's them and returns a record
-    object.
+    object. The harvesting stages keep running in the background while
+    a bunch is being submitted.
 
     For every record object, we assign it to a list of new records or,
     if matching is done, to a list of records to update. These records are
@@ -445,9 +461,9 @@ def process_records(job, parameters, final_record_list):
 
         # Depending on the bunch size, we start submitting or just continue
         # to harvest next record.
-        if bunch and len(job.records_harvested) != CFG_APSHARVEST_BUNCH_SIZE:
+        if bunch and len(job.records_harvested) >= CFG_APSHARVEST_BUNCH_SIZE:
             # Go over next bunch and add to totals
-            job.process_record_submission(parameters, bunch=True)
+            job.process_record_submission(parameters)
             job.reset_bunch()
 
     # Are there any remaining records to submit?
@@ -28,7 +28,8 @@ import datetime
 from invenio.bibtaskutils import ChunkedBibUpload
 from invenio.docextract_record import get_record, BibRecord
 from invenio.docextract_convert_journals import normalize_journal_name
-from invenio.search_engine import perform_request_search
+from invenio.dbquery import run_sql
+from invenio.recidindexutils import get_field_values, get_tag_values
 from invenio.config import (CFG_TMPSHAREDDIR,
                             CFG_SITE_ADMIN_EMAIL)
 from invenio.bibtask import (write_message,
@@ -83,7 +84,8 @@ def bst_arxiv_doi_update(input_uri=None,
                          logging=True,
                          asana_key=CFG_ASANA_API_KEY,
                          asana_parent_id=ASANA_PARENT_TASK_ID,
-                         skip_result_types='missing'):
+                         skip_result_types='missing',
+                         batch_size='1000'):
     """Update DOIs on documents harvested from ArXiv.
 
     Parameters:
@@ -99,8 +101,11 @@ def bst_arxiv_doi_update(input_uri=None,
     :param skip_result_types: Error messages to not bother with during
         reporting, input as Comma Seperated Values CSVs
         Possible values: missing, ambigous, incorrect
+    :param batch_size: Number of articles of the feed whose records are
+        looked up together
     """
     skip_results = verify_skip_results(skip_result_types)
+    batch_size = int(batch_size)
 
     if input_uri is None:
         _print("Notice: No URI specified, defaulting to " + URI_DEFAULT)
@@ -111,28 +116,14 @@ def bst_arxiv_doi_update(input_uri=None,
     # Testing builds characters
     bibupload = ChunkedBibUpload(mode='a', user=SCRIPT_NAME, notimechange=False)
 
-    # open url and parse xml
+    # open url, the feed is parsed as it is read
     try:
-        tree = ET.parse(urllib.urlopen(input_uri))
+        feed = urllib.urlopen(input_uri)
         _print('Opened DOI file ' + input_uri)
     except IOError:
         _print("FATAL ERROR: Could not open URL: " + input_uri, 1)
         task_update_progress("Failed retrieving DOI data")
         return False
-    except ExpatError:
-        _print("FATAL ERROR: Could not parse XML from: " + input_uri, 1)
-        task_update_progress("Failed parsing DOI data")
-        return False
-
-    root = tree.getroot()
-
-    try:
-        date_el = root.find('date')
-        date_str = '%s-%s-%s' % (date_el.get('year'), date_el.get('month'),
-                                 date_el.get('day'))
-        _print("Processing DOIs last updated on date %s" % date_str)
-    except AttributeError:
-        _print("Warning: Couldn't get last published date of Arxiv DOI feed.")
 
     doi_count = 0
     new_count = 0
@@ -144,36 +135,24 @@ def bst_arxiv_doi_update(input_uri=None,
     problem_dois = {'missing': [], 'ambiguous': [], 'incorrect': []}
 
     task_update_progress("Processing records...")
-    # NB: Element.getiterator() is deprecated since version 2.7: Use
-    # method Element.iter() instead.
-    for item in root.getiterator('article'):
-        doi_count += 1
-        doi = item.get('doi')
-        arxiv = item.get('preprint_id')
-        published_date = item.get('published')
-        _print("XML entry #%s: %s" % (str(doi_count), arxiv), 6)
-        rec_id = get_record_by_arxiv_id(arxiv)
-        if len(rec_id) == 1:
-            rec_id = rec_id[0]
-            try:
-                record_xml = append_to_record(rec_id, doi, published_date)
-            except DOIError as ex:
-                problem_dois['incorrect'].append((rec_id, ex.message, doi))
-                continue
-            if record_xml:
-                new_count += 1
-                _print("* Now we will run the bibupload for " +
-                       "%s record" % rec_id, 5)
-                _print("** We will upload the following xml code %s" %
-                       repr(record_xml), 9)
-                bibupload.add(record_xml)
-        elif len(rec_id) > 1:
-            _print('ERROR: %d records found with matching arXiv ID %s' %
-                   (len(rec_id), arxiv))
-            problem_dois['ambiguous'].append((doi, arxiv, repr(rec_id)))
-        else:
-            _print('No record found matching arxiv ID: %s' % arxiv, 9)
-            problem_dois['missing'].append((doi, arxiv, published_date))
+    articles = []
+    try:
+        for article in iter_feed_articles(feed):
+            articles.append(article)
+            if len(articles) >= batch_size:
+                new_count += process_articles(articles, doi_count, bibupload,
+                                              problem_dois)
+                doi_count += len(articles)
+                articles = []
+                task_update_progress("Processed %d DOIs" % (doi_count,))
+    except (ExpatError, SyntaxError):
+        # SyntaxError is the base class of ElementTree.ParseError
+        _print("FATAL ERROR: Could not parse XML from: " + input_uri, 1)
+        task_update_progress("Failed parsing DOI data")
+        bibupload.cleanup()
+        return False
+    new_count += process_articles(articles, doi_count, bibupload, problem_dois)
+    doi_count += len(articles)
 
     _print("========================| FINAL SCORE |=======================", 1)
     _print("DOIs found and processed: %d" % doi_count, 1)
@@ -203,6 +182,68 @@ def _print(string, verbose=3):
     write_message(msg, None, verbose)
 
 
+def iter_feed_articles(feed):
+    """Parse the DOI feed incrementally.
+
+    Yields the (doi, preprint_id, published date) of every article, without
+    keeping the parsed articles in memory.
+    """
+    date_found = False
+    for dummy, element in ET.iterparse(feed):
+        if element.tag == 'date':
+            date_found = True
+            _print("Processing DOIs last updated on date %s-%s-%s"
+                   % (element.get('year'), element.get('month'),
+                      element.get('day')))
+        elif element.tag == 'article':
+            yield (element.get('doi'), element.get('preprint_id'),
+                   element.get('published'))
+            element.clear()
+    if not date_found:
+        _print("Warning: Couldn't get last published date of Arxiv DOI feed.")
+
+
+def process_articles(articles, doi_count, bibupload, problem_dois):
+    """Update the records of a batch of articles of the DOI feed.
+
+    The records are looked up and fetched for the whole batch at once.
+    Problems are added to problem_dois.
+
+    Returns the number of records queued for upload.
+    """
+    new_count = 0
+    rec_ids_by_arxiv = get_records_by_arxiv_ids([arxiv for dummy, arxiv, dummy2 in articles])
+    records = get_records_for_doi_update(set(rec_ids[0] for rec_ids in rec_ids_by_arxiv.itervalues()
+                                             if len(rec_ids) == 1))
+    for doi, arxiv, published_date in articles:
+        doi_count += 1
+        _print("XML entry #%s: %s" % (str(doi_count), arxiv), 6)
+        rec_id = rec_ids_by_arxiv[arxiv]
+        if len(rec_id) == 1:
+            rec_id = rec_id[0]
+            try:
+                record_xml = append_to_record(rec_id, doi, published_date,
+                                              records[rec_id])
+            except DOIError as ex:
+                problem_dois['incorrect'].append((rec_id, ex.message, doi))
+                continue
+            if record_xml:
+                new_count += 1
+                _print("* Now we will run the bibupload for " +
+                       "%s record" % rec_id, 5)
+                _print("** We will upload the following xml code %s" %
+                       repr(record_xml), 9)
+                bibupload.add(record_xml)
+        elif len(rec_id) > 1:
+            _print('ERROR: %d records found with matching arXiv ID %s' %
+                   (len(rec_id), arxiv))
+            problem_dois['ambiguous'].append((doi, arxiv, repr(rec_id)))
+        else:
+            _print('No record found matching arxiv ID: %s' % arxiv, 9)
+            problem_dois['missing'].append((doi, arxiv, published_date))
+    return new_count
+
+
 def write_list_to_file(output_dir, name, list_to_write):
     """Take a list of strings and writes them to a file."""
     if list_to_write:
@@ -248,13 +289,17 @@ def is_marked_published(record):
     return False
 
 
-def append_to_record(rec_id, doi, published_date):
+def append_to_record(rec_id, doi, published_date, record=None):
     """Attempt to add a DOI to a record.
 
     Also adds 930 'Published' if not already there and
     adds the extrapolated PubNote data to 773.
+
+    The 0247, 773, 980 and 260 fields of the record are checked: they are
+    taken from the given record, if any, instead of fetching it.
     """
-    record = get_record(recid=rec_id)
+    if record is None:
+        record = get_record(recid=rec_id)
     new_record = BibRecord(rec_id)
     # make sure that there is no DOI for this record
     if not record_has_doi(record, rec_id, doi):
@@ -303,17 +348,61 @@ def append_to_record(rec_id, doi, published_date):
         return None
 
 
-def get_record_by_arxiv_id(arxiv):
-    """Retrieve record corresponding to an arXiv ID.
+def get_records_by_arxiv_ids(arxiv_ids, chunk_size=1000):
+    """Retrieve the records corresponding to many arXiv IDs at once.
 
-    In the format arxiv:xxxx.xxxxx
+    The 037__a values are looked up in one query per chunk of IDs, with
+    and without the arXiv: prefix. Deleted records are left out.
 
-    Returns a list (hopefully with only one item).
+    Returns a dictionary of every arXiv ID to the sorted list of its
+    record IDs (hopefully with only one item).
+    """
+    wanted = {}
+    for arxiv in arxiv_ids:
+        bare = arxiv[6:] if arxiv[:6] == 'arXiv:' else arxiv
+        wanted[bare] = wanted[arxiv] = arxiv
+    found = dict((arxiv, set()) for arxiv in arxiv_ids)
+    values = list(set(wanted.keys() + ['arXiv:' + value for value in wanted.keys()
+                                       if value[:6] != 'arXiv:']))
+    for i in xrange(0, len(values), chunk_size):
+        chunk = values[i:i + chunk_size]
+        sql = "SELECT b.value, bb.id_bibrec FROM bib03x AS b " \
+              "JOIN bibrec_bib03x AS bb ON bb.id_bibxxx=b.id " \
+              "WHERE b.tag='037__a' AND b.value IN (%s)" % (",".join(["%s"] * len(chunk)),)
+        for value, rec_id in run_sql(sql, tuple(chunk)):
+            bare = value[6:] if value[:6] == 'arXiv:' else value
+            if bare in wanted:
+                found[wanted[bare]].add(rec_id)
+
+    deleted = set(rec_id for rec_id, value in
+                  get_tag_values('980__c', set().union(*found.values()))
+                  if value.upper() == 'DELETED')
+    return dict((arxiv, sorted(rec_ids - deleted))
+                for arxiv, rec_ids in found.iteritems())
+
+
+def get_records_for_doi_update(rec_ids):
+    """Fetch the fields checked by append_to_record for many records.
+
+    Only the 0247, 773, 980 and 260 fields are read, in a few queries for
+    all the records.
+
+    Returns a dictionary of record ID to BibRecord.
     """
-    # if arxiv doesn't contain "arXiv:" at the beginning, we add it
-    if arxiv[:6] != 'arXiv:':
-        arxiv = 'arXiv:' + arxiv
-    return perform_request_search(p='037__a:' + arxiv)
+    records = dict((rec_id, BibRecord(rec_id)) for rec_id in rec_ids)
+    if not records:
+        return records
+    for tags in (['0247_2', '0247_a'],
+                 ['773__p', '773__v', '773__c', '773__y'],
+                 ['980__a'],
+                 ['260__c']):
+        fields = {}
+        for rec_id, field_number, tag, value in sorted(get_field_values(tags, records.keys())):
+            key = (rec_id, field_number)
+            if key not in fields:
+                fields[key] = records[rec_id].add_field(tag[:5])
+            fields[key].add_subfield(tag[5], value)
+    return records
 
 
 def create_pubnote(doi, published_date):
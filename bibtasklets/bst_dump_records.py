@@ -19,15 +19,37 @@
 
 """
 Dump all INSPIRE records so that they are available via HTTP.
+
+By default records are formatted one at a time into a single gzip stream.
+When ``processes`` is greater than zero, the reclist of each collection is
+split into recid-range shards which are formatted in a process pool. Each
+shard is written as its own gzip member and the members are then joined
+into the usual ``<collection>-records.xml.gz`` file. Finished shards are
+recorded in a checkpoint manifest so that an interrupted run can be resumed
+with ``resume='yes'``.
+
+With ``mode='delta'`` only the records changed since the previous dump are
+written to a small ``<collection>-records-delta-<date>.xml.gz`` file, and
+``<collection>-records.index.json`` lists the base dump together with its
+deltas and the recids deleted meanwhile. ``mode='merge'`` streams the base
+dump and its deltas into a new full dump without formatting anything.
 """
 
 import os
+import re
 import gzip
 import time
+import json
+import heapq
+import shutil
+from multiprocessing import Pool
 
-from invenio.search_engine import get_collection_reclist
+from invenio.search_engine import get_collection_reclist, search_unit
+from invenio.dbquery import run_sql
+from invenio.intbitset import intbitset
 from invenio.config import CFG_WEBDIR, CFG_SITE_URL
 from invenio.bibformat_engine import format_record
+from invenio.bibformat_elements.bfe_INSPIRE_enhanced_marcxml import load_lookup_indexes
 from invenio.dateutils import get_time_estimator
 from invenio.bibtask import write_message, task_update_progress, task_sleep_now_if_required
 from invenio.bibdocfile import calculate_md5
@@ -35,6 +57,12 @@ from invenio.bibdocfile import calculate_md5
 CFG_EXPORTED_COLLECTIONS = ['HEP', 'HepNames', 'Institutions', 'Conferences',
                             'Experiments', 'Journals', 'Data']
 
+CFG_DUMPS_DIR = os.path.join(CFG_WEBDIR, 'dumps')
+
+RE_RECORD_START = re.compile(r'\s*<record\b')
+RE_RECORD_END = re.compile(r'</record>\s*$')
+RE_RECORD_RECID = re.compile(r'<controlfield tag="001">(\d+)</controlfield>')
+
 
 class run_ro_on_slave_db:
     """
@@ -55,12 +83,58 @@ class run_ro_on_slave_db:
         dbquery.CFG_ACCESS_CONTROL_LEVEL_SITE = self.old_site_level
 
 
-def bst_dump_records():
+def bst_dump_records(processes='0', shard_size='10000', resume='no', mode='full'):
+    """
+    Dump every collection in CFG_EXPORTED_COLLECTIONS as MARCXML.
+
+    processes: number of worker processes formatting shards in parallel.
+        With '0' the records are formatted serially in the task process.
+    shard_size: width of the recid range covered by every shard.
+    resume: yes/no, whether shards completed by a previous interrupted
+        run should be reused instead of being formatted again.
+    mode: 'full' regenerates every dump from scratch; 'delta' only writes
+        the records changed since the previous full or delta dump; 'merge'
+        folds the pending deltas into a new full dump.
+    """
+    processes = int(processes)
+    shard_size = int(shard_size)
+    resume = resume.lower() == 'yes'
+    mode = mode.lower()
+    if mode not in ('full', 'delta', 'merge'):
+        raise ValueError("Unknown dump mode %s" % mode)
     try:
-        os.makedirs(os.path.join(CFG_WEBDIR, 'dumps'))
+        os.makedirs(CFG_DUMPS_DIR)
     except OSError:
         pass
-    html_index = open(os.path.join(CFG_WEBDIR, 'dumps', '.inspire-dump.html'), "w")
+
+    def dumper(collection, reclist, output_path):
+        if processes > 0:
+            dump_collection_sharded(collection, reclist, output_path,
+                                    processes, shard_size, resume)
+        else:
+            dump_collection(collection, reclist, output_path)
+
+    for collection in CFG_EXPORTED_COLLECTIONS:
+        task_update_progress(collection)
+        index = read_index(collection)
+        if mode == 'merge':
+            if index and index['deltas']:
+                merge_deltas(collection, index)
+            else:
+                write_message("No deltas to merge for %s" % collection)
+        elif mode == 'delta' and index:
+            dump_delta(collection, index, dumper)
+        else:
+            if mode == 'delta':
+                write_message("No previous dump of %s: falling back to a full dump" % collection)
+            dump_full(collection, dumper)
+        write_message("DONE")
+    write_html_index()
+
+
+def write_html_index():
+    """Write the HTML page listing the full dumps and their pending deltas."""
+    html_index = open(os.path.join(CFG_DUMPS_DIR, '.inspire-dump.html'), "w")
     print >> html_index, """
 <html>
     <head>
@@ -71,35 +145,366 @@ def bst_dump_records():
         <ul>
 """
     for collection in CFG_EXPORTED_COLLECTIONS:
-        task_update_progress(collection)
+        index = read_index(collection)
+        if not index:
+            continue
         print >> html_index, """
-<li><a href="%(prefix)s/dumps/%(collection)s-records.xml.gz">%(collection)s</a>
-(<a href="%(prefix)s/dumps/%(collection)s-records.xml.gz.md5">MD5</a>): %(date)s</li>""" % {
+<li><a href="%(prefix)s/dumps/%(file)s">%(collection)s</a>
+(<a href="%(prefix)s/dumps/%(file)s.md5">MD5</a>,
+<a href="%(prefix)s/dumps/%(index)s">index</a>): %(date)s""" % {
     'prefix': CFG_SITE_URL,
     'collection': collection,
-    'date': time.ctime()
+    'file': index['base']['file'],
+    'index': get_index_name(collection),
+    'date': index['base']['date'],
 }
-        write_message("Preparing %s-records.xml.gz" % collection)
-        output_path = os.path.join(CFG_WEBDIR, 'dumps', '.%s-records.xml.gz' % collection)
-        output = gzip.open(output_path, "w")
-        print >> output, "<collection>"
-        reclist = get_collection_reclist(collection)
-        tot = len(reclist)
-        time_estimator = get_time_estimator(tot)
-        for i, recid in enumerate(reclist):
-            with run_ro_on_slave_db():
-                print >> output, format_record(recid, 'xme', user_info={})[0]
-            time_estimation = time_estimator()[1]
-            if (i + 1) % 100 == 0:
-                task_update_progress("%s %s (%s%%) -> %s" % (collection, recid, (i + 1) * 100 / tot, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time_estimation))))
-                task_sleep_now_if_required()
-        print >> output, "</collection>"
-        output.close()
-        write_message("Computing checksum")
-        print >> open(output_path + '.md5', "w"), calculate_md5(output_path)
-        os.rename(output_path, os.path.join(CFG_WEBDIR, 'dumps', '%s-records.xml.gz' % collection))
-        os.rename(output_path + '.md5', os.path.join(CFG_WEBDIR, 'dumps', '%s-records.xml.gz.md5' % collection))
-        write_message("DONE")
+        if index['deltas']:
+            print >> html_index, "<ul>"
+            for delta in index['deltas']:
+                print >> html_index, """
+<li><a href="%(prefix)s/dumps/%(file)s">delta</a>
+(<a href="%(prefix)s/dumps/%(file)s.md5">MD5</a>): %(since)s -> %(until)s,
+%(changed)s changed, %(deleted)s deleted</li>""" % {
+    'prefix': CFG_SITE_URL,
+    'file': delta['file'],
+    'since': delta['since'],
+    'until': delta['until'],
+    'changed': delta['changed'],
+    'deleted': len(delta['deleted']),
+}
+            print >> html_index, "</ul>"
+        print >> html_index, "</li>"
     print >> html_index, "</ul></body></html>"
     html_index.close()
-    os.rename(os.path.join(CFG_WEBDIR, 'dumps', '.inspire-dump.html'), os.path.join(CFG_WEBDIR, 'dumps', 'inspire-dump.html'))
+    os.rename(os.path.join(CFG_DUMPS_DIR, '.inspire-dump.html'), os.path.join(CFG_DUMPS_DIR, 'inspire-dump.html'))
+
+
+def dump_full(collection, dumper):
+    """Regenerate the full dump of collection and reset its index."""
+    write_message("Preparing %s-records.xml.gz" % collection)
+    now = time.strftime("%Y-%m-%d %H:%M:%S")
+    output_path = os.path.join(CFG_DUMPS_DIR, '.%s-records.xml.gz' % collection)
+    reclist = get_collection_reclist(collection)
+    dumper(collection, reclist, output_path)
+    publish_dump(output_path, '%s-records.xml.gz' % collection)
+    old_index = read_index(collection)
+    write_dumped_recids(collection, reclist)
+    write_index(collection, {'collection': collection,
+                             'base': {'file': '%s-records.xml.gz' % collection,
+                                      'date': now,
+                                      'records': len(reclist)},
+                             'deltas': []})
+    if old_index:
+        remove_deltas(old_index)
+
+
+def dump_delta(collection, index, dumper):
+    """
+    Write the records of collection changed since the last dump as a delta.
+
+    Records that were part of the previous dump but no longer belong to the
+    collection are listed as deleted in the index.
+    """
+    since = index['deltas'] and index['deltas'][-1]['until'] or index['base']['date']
+    until = time.strftime("%Y-%m-%d %H:%M:%S")
+    write_message("Preparing delta of %s since %s" % (collection, since))
+    reclist = get_collection_reclist(collection)
+    changed = get_modified_records(since) & reclist
+    deleted = read_dumped_recids(collection) - reclist
+    name = '%s-records-delta-%s.xml.gz' % (collection, until.replace('-', '').replace(' ', '').replace(':', ''))
+    output_path = os.path.join(CFG_DUMPS_DIR, '.' + name)
+    write_message("%s changed and %s deleted records" % (len(changed), len(deleted)))
+    dumper(collection, changed, output_path)
+    publish_dump(output_path, name)
+    write_dumped_recids(collection, reclist)
+    index['deltas'].append({'file': name,
+                            'since': since,
+                            'until': until,
+                            'changed': len(changed),
+                            'deleted': list(deleted)})
+    write_index(collection, index)
+
+
+def merge_deltas(collection, index):
+    """
+    Fold the deltas of collection into a new full dump.
+
+    The base dump and all the deltas are sorted by recid, so they are merged
+    as streams: records are copied verbatim from the most recent file that
+    contains them and nothing is formatted again.
+    """
+    write_message("Merging %s deltas into %s" % (len(index['deltas']), index['base']['file']))
+    deleted = {}
+    sources = [iter_dumped_records(os.path.join(CFG_DUMPS_DIR, index['base']['file']), 0)]
+    for position, delta in enumerate(index['deltas']):
+        for recid in delta['deleted']:
+            deleted[recid] = position + 1
+        sources.append(iter_dumped_records(os.path.join(CFG_DUMPS_DIR, delta['file']), position + 1))
+
+    output_path = os.path.join(CFG_DUMPS_DIR, '.%s-records.xml.gz' % collection)
+    output = gzip.open(output_path, "w")
+    print >> output, "<collection>"
+    last_recid = None
+    records = 0
+    for recid, dummy, position, record in heapq.merge(*sources):
+        if recid == last_recid:
+            # An older version of a record already written
+            continue
+        last_recid = recid
+        if deleted.get(recid, -1) >= position:
+            continue
+        output.write(record)
+        records += 1
+    print >> output, "</collection>"
+    output.close()
+    publish_dump(output_path, '%s-records.xml.gz' % collection)
+    write_index(collection, {'collection': collection,
+                             'base': {'file': '%s-records.xml.gz' % collection,
+                                      'date': index['deltas'][-1]['until'],
+                                      'records': records},
+                             'deltas': []})
+    remove_deltas(index)
+
+
+def iter_dumped_records(path, position):
+    """
+    Stream the records of the gzipped MARCXML dump at path.
+
+    @return: generator of (recid, -position, position, record XML), in the
+        order of the dump. The negated position makes the most recent
+        source sort first among equal recids.
+    """
+    dump = gzip.open(path)
+    record = []
+    for line in dump:
+        if not record and not RE_RECORD_START.match(line):
+            continue
+        record.append(line)
+        if RE_RECORD_END.search(line):
+            record = ''.join(record)
+            recid = int(RE_RECORD_RECID.search(record).group(1))
+            yield recid, -position, position, record
+            record = []
+    dump.close()
+
+
+def remove_deltas(index):
+    """Delete the delta files referenced by index."""
+    for delta in index['deltas']:
+        for path in (delta['file'], delta['file'] + '.md5'):
+            try:
+                os.remove(os.path.join(CFG_DUMPS_DIR, path))
+            except OSError:
+                pass
+
+
+def get_modified_records(since):
+    """
+    Return the records that need to be dumped again since the given date.
+
+    This follows the same logic as bst_prodsync: records modified (also
+    with --notimechange), records citing something new and records whose
+    claims changed.
+    """
+    with run_ro_on_slave_db():
+        modified_records = intbitset(run_sql("SELECT id FROM bibrec WHERE modification_date>=%s", (since, )))
+        compacttime = since.replace('-', '').replace(' ', '').replace(':', '')
+        modified_records += search_unit("%s->99991231235959" % compacttime, f='005', m='a')
+        modified_records += intbitset(run_sql("SELECT distinct citer FROM rnkCITATIONLOG WHERE action_date>=%s", (since, )))
+        modified_records |= intbitset(run_sql("SELECT bibrec FROM aidPERSONIDPAPERS WHERE last_updated>=%s", (since, )))
+        modified_records |= intbitset(run_sql('SELECT bibrec FROM aidPERSONIDPAPERS AS p JOIN aidPERSONIDDATA as d'
+                                              ' ON p.personid = d.personid WHERE d.tag = "canonical_name" and d.last_updated>=%s', (since, )))
+    return modified_records
+
+
+def get_index_name(collection):
+    return '%s-records.index.json' % collection
+
+
+def read_index(collection):
+    """Return the index of the dumps of collection or None."""
+    return read_manifest(os.path.join(CFG_DUMPS_DIR, get_index_name(collection)))
+
+
+def write_index(collection, index):
+    write_manifest(os.path.join(CFG_DUMPS_DIR, get_index_name(collection)), index)
+
+
+def read_dumped_recids(collection):
+    """Return the recids that were part of the last dump of collection."""
+    try:
+        return intbitset(open(os.path.join(CFG_DUMPS_DIR, '.%s-records.recids' % collection)).read())
+    except IOError:
+        return intbitset()
+
+
+def write_dumped_recids(collection, reclist):
+    with open(os.path.join(CFG_DUMPS_DIR, '.%s-records.recids' % collection), "w") as out:
+        out.write(reclist.fastdump())
+
+
+def dump_collection(collection, reclist, output_path):
+    """Format every record in reclist serially into output_path."""
+    output = gzip.open(output_path, "w")
+    print >> output, "<collection>"
+    tot = len(reclist)
+    time_estimator = get_time_estimator(tot)
+    for i, recid in enumerate(reclist):
+        with run_ro_on_slave_db():
+            if i % 100 == 0:
+                load_lookup_indexes()
+            print >> output, format_record(recid, 'xme', user_info={})[0]
+        time_estimation = time_estimator()[1]
+        if (i + 1) % 100 == 0:
+            task_update_progress("%s %s (%s%%) -> %s" % (collection, recid, (i + 1) * 100 / tot, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time_estimation))))
+            task_sleep_now_if_required()
+    print >> output, "</collection>"
+    output.close()
+
+
+def publish_dump(output_path, name):
+    """Compute the checksum of output_path and move it to its public name."""
+    write_message("Computing checksum")
+    print >> open(output_path + '.md5', "w"), calculate_md5(output_path)
+    os.rename(output_path, os.path.join(CFG_DUMPS_DIR, name))
+    os.rename(output_path + '.md5', os.path.join(CFG_DUMPS_DIR, name + '.md5'))
+
+
+def split_in_shards(reclist, shard_size):
+    """
+    Split reclist in recid-range shards.
+
+    Shard number k holds the recids in [k * shard_size, (k + 1) * shard_size),
+    so that shard numbers stay stable between two runs even if some records
+    were added or deleted in the meantime. Empty ranges are skipped.
+
+    @return: list of (shard number, list of recids) sorted by shard number.
+    """
+    shards = []
+    for recid in reclist:
+        key = recid // shard_size
+        if not shards or shards[-1][0] != key:
+            shards.append((key, []))
+        shards[-1][1].append(recid)
+    return shards
+
+
+def get_shard_path(shard_dir, key):
+    return os.path.join(shard_dir, 'shard-%06d.xml.gz' % key)
+
+
+def write_gzip_member(output, data):
+    """Append data to the open binary file output as a new gzip member."""
+    member = gzip.GzipFile(fileobj=output, mode="wb")
+    member.write(data)
+    member.close()
+
+
+def read_manifest(manifest_path):
+    """Return the checkpoint manifest stored at manifest_path or None."""
+    try:
+        return json.load(open(manifest_path))
+    except (IOError, ValueError):
+        return None
+
+
+def write_manifest(manifest_path, manifest):
+    """Atomically replace the checkpoint manifest at manifest_path."""
+    tmp_path = manifest_path + '.tmp'
+    out = open(tmp_path, "w")
+    json.dump(manifest, out, indent=2, sort_keys=True)
+    out.close()
+    os.rename(tmp_path, manifest_path)
+
+
+def dump_shard(args):
+    """
+    Format the records of one shard into its own gzip file.
+
+    This runs inside a worker process: the slave DB is selected and the
+    lookup indexes of the 'xme' format are refreshed only once for the
+    whole shard. The shard is written to a temporary file first, so
+    that a half written shard is never mistaken for a finished one.
+
+    @return: (shard number, number of records written)
+    """
+    key, recids, shard_path = args
+    tmp_path = shard_path + '.part'
+    output = gzip.open(tmp_path, "w")
+    written = 0
+    with run_ro_on_slave_db():
+        load_lookup_indexes()
+        for recid in recids:
+            print >> output, format_record(recid, 'xme', user_info={})[0]
+            written += 1
+    output.close()
+    os.rename(tmp_path, shard_path)
+    return key, written
+
+
+def dump_collection_sharded(collection, reclist, output_path, processes, shard_size, resume=False):
+    """
+    Format reclist into output_path using a pool of worker processes.
+
+    Shards are kept next to output_path in a ``.shards`` directory together
+    with a ``.manifest`` JSON file listing the finished ones. Both are
+    removed once the shards have been joined into output_path.
+    """
+    shard_dir = output_path + '.shards'
+    manifest_path = output_path + '.manifest'
+    shards = split_in_shards(reclist, shard_size)
+
+    manifest = resume and read_manifest(manifest_path) or None
+    if manifest and manifest.get('shard_size') != shard_size:
+        write_message("Ignoring checkpoint of %s: it was made with shard size %s" % (collection, manifest.get('shard_size')))
+        manifest = None
+    if manifest is None:
+        if os.path.exists(shard_dir):
+            shutil.rmtree(shard_dir)
+        manifest = {'collection': collection,
+                    'shard_size': shard_size,
+                    'started': time.strftime("%Y-%m-%d %H:%M:%S"),
+                    'done': {}}
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    todo = []
+    for key, recids in shards:
+        shard_path = get_shard_path(shard_dir, key)
+        if str(key) in manifest['done'] and os.path.exists(shard_path):
+            continue
+        manifest['done'].pop(str(key), None)
+        todo.append((key, recids, shard_path))
+    write_manifest(manifest_path, manifest)
+    if len(todo) < len(shards):
+        write_message("Resuming %s: %s of %s shards already done" % (collection, len(shards) - len(todo), len(shards)))
+
+    tot = len(todo)
+    if tot:
+        time_estimator = get_time_estimator(tot)
+        pool = Pool(processes)
+        try:
+            for i, (key, written) in enumerate(pool.imap_unordered(dump_shard, todo)):
+                manifest['done'][str(key)] = written
+                write_manifest(manifest_path, manifest)
+                time_estimation = time_estimator()[1]
+                task_update_progress("%s shard %s/%s (%s%%) -> %s" % (collection, i + 1, tot, (i + 1) * 100 / tot, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time_estimation))))
+                task_sleep_now_if_required()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    write_message("Joining %s shards of %s" % (len(shards), collection))
+    output = open(output_path, "wb")
+    write_gzip_member(output, "<collection>\n")
+    for key, dummy in shards:
+        shard = open(get_shard_path(shard_dir, key), "rb")
+        shutil.copyfileobj(shard, output)
+        shard.close()
+    write_gzip_member(output, "</collection>\n")
+    output.close()
+    shutil.rmtree(shard_dir)
+    os.remove(manifest_path)
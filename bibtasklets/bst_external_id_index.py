@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of INSPIRE.
+## Copyright (C) 2026 CERN.
+##
+## INSPIRE is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## INSPIRE is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with INSPIRE; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Build or update the external ID index used by the harvesting filters.
+"""
+
+import os
+
+from invenio.bibtask import write_message, task_update_progress
+from invenio.externalidindex import CFG_EXTERNAL_ID_INDEX, \
+    build_external_id_index, update_external_id_index
+
+
+def bst_external_id_index(full='no'):
+    """
+    Update the external ID index with the records modified since
+    its last update.
+
+    full: yes/no, whether the index should be rebuilt from scratch.
+        This is always the case if it does not exist yet.
+    """
+    if full.lower() == 'yes' or not os.path.exists(CFG_EXTERNAL_ID_INDEX):
+        task_update_progress("Building %s" % CFG_EXTERNAL_ID_INDEX)
+        keys = build_external_id_index()
+        write_message("Indexed %s identifiers in %s" % (keys, CFG_EXTERNAL_ID_INDEX))
+    else:
+        task_update_progress("Updating %s" % CFG_EXTERNAL_ID_INDEX)
+        modified = update_external_id_index()
+        write_message("Reindexed %s modified records in %s" % (modified, CFG_EXTERNAL_ID_INDEX))
+    write_message("DONE")
@@ -30,7 +30,7 @@ from simplejson import JSONDecodeError
 from invenio.intbitset import intbitset
 from invenio.jsonutils import json_unicode_to_utf8
 from invenio.search_engine import search_pattern
-from invenio.search_engine_utils import get_fieldvalues
+from invenio.recidindexutils import get_tag_values
 from invenio.bibsched_tasklets.bst_inspire_cds_synchro import get_record_ids_to_export
 from invenio.bibrecord import record_add_field, record_xml_output
 from invenio.bibtask import write_message, task_sleep_now_if_required
@@ -73,27 +73,27 @@ def get_hal_records():
     return search_pattern(p='035__9:"HAL"')
 
 
-def get_hal_maps():
-    write_message("Getting HAL records...")
+def normalize_hal_arxiv_id(arxiv_id):
+    if arxiv_id[0].isdigit():
+        # we patch 1234.1234 -> arXiv:1234.1234
+        arxiv_id = 'arXiv:%s' % arxiv_id
+    return arxiv_id
+
+
+def get_local_maps(recids):
+    """
+    Returns the DOI -> recids and arXiv ID -> recids maps of the given
+    INSPIRE records.
+    """
+    write_message("Getting DOIs and arXiv IDs of %s records..." % len(recids))
     doi_map = {}
     arxiv_map = {}
-    recid_map = {}
-    for row in hal_record_iterator():
-        if 'inspireId_s' in row:
-            try:
-                recid = int(row['inspireId_s'][0])
-                recid_map[recid] = row
-            except ValueError:
-                write_message("WARNING: Invalid recid '%s' for HAL record %s" % (row['inspireId_s'][0], row), stream=sys.stderr)
-        if 'arxivId_s' in row:
-            if row['arxivId_s'][0].isdigit():
-                # we patch 1234.1234 -> arXiv:1234.1234
-                row['arxivId_s'] = 'arXiv:%s' % row['arxivId_s']
-            arxiv_map[row['arxivId_s']] = row
-        if 'doiId_s' in row:
-            doi_map[row['doiId_s']] = row
+    for recid, doi in get_tag_values('0247_a', recids):
+        doi_map.setdefault(doi.lower(), []).append(recid)
+    for recid, arxiv in get_tag_values('037__a', recids):
+        arxiv_map.setdefault(arxiv, []).append(recid)
     write_message("... DONE")
-    return doi_map, arxiv_map, recid_map
+    return doi_map, arxiv_map
 
 
 def update_record(recid, hal_id, bibupload):
@@ -107,39 +107,48 @@ def update_record(recid, hal_id, bibupload):
 
 
 def bst_hal():
-    doi_map, arxiv_map, recid_map = get_hal_maps()
     matchable_records = get_record_ids_to_export()
     write_message("Total matchable records: %s" % len(matchable_records))
     hal_records = get_hal_records()
     write_message("Already matched records: %s" % len(hal_records))
-    new_inspire_ids = intbitset(recid_map.keys()) - hal_records
-    write_message("New records pushed from Inspire: %s" % len(new_inspire_ids))
+    doi_map, arxiv_map = get_local_maps(matchable_records - hal_records)
     bibupload = ChunkedBibUpload(mode='a', notimechange=True, user='bst_hal')
-    for recid in new_inspire_ids:
-        hal_id = recid_map[recid]['halId_s']
-        update_record(recid, hal_id, bibupload)
-    write_message('Added HAL ids to all records pushed from Inspire')
-    task_sleep_now_if_required()
-    tot_records = matchable_records - hal_records - new_inspire_ids
-    write_message("Additional records to be checked: %s" % len(tot_records))
-    for i, recid in enumerate(tot_records):
+
+    # Records pushed from Inspire are updated as soon as they come, the
+    # others only once we know that they match a single HAL record
+    new_inspire_ids = intbitset()
+    matched_hal_ids = {}
+    write_message("Getting HAL records...")
+    for i, row in enumerate(hal_record_iterator()):
         if i % 1000 == 0:
-            write_message("%s records done out of %s" % (i, len(tot_records)))
             task_sleep_now_if_required()
-        dois = get_fieldvalues(recid, tag='0247__a', sort=False)
-        arxivs = get_fieldvalues(recid, tag='037__a', sort=False)
-        matched_hal = [doi_map[doi] for doi in dois if doi in doi_map]
-        matched_hal += [arxiv_map[arxiv] for arxiv in arxivs if arxiv in arxiv_map]
+        hal_id = row['halId_s']
+        if 'inspireId_s' in row:
+            try:
+                recid = int(row['inspireId_s'][0])
+            except ValueError:
+                write_message("WARNING: Invalid recid '%s' for HAL record %s" % (row['inspireId_s'][0], row), stream=sys.stderr)
+            else:
+                if recid not in hal_records and recid not in new_inspire_ids:
+                    new_inspire_ids.add(recid)
+                    update_record(recid, hal_id, bibupload)
+        recids = []
+        if 'doiId_s' in row:
+            recids += doi_map.get(row['doiId_s'].lower(), [])
+        if 'arxivId_s' in row:
+            recids += arxiv_map.get(normalize_hal_arxiv_id(row['arxivId_s']), [])
+        for recid in recids:
+            matched_hal_ids.setdefault(recid, set()).add(hal_id)
+    write_message("New records pushed from Inspire: %s" % len(new_inspire_ids))
 
+    tot_records = intbitset(matched_hal_ids.keys()) - new_inspire_ids
+    write_message("Additional records matched by DOI or arXiv ID: %s" % len(tot_records))
+    for recid in tot_records:
+        hal_ids = matched_hal_ids[recid]
         # Let's assert that we matched only one single hal document at most
-        matched_hal_id = set(id(entry) for entry in matched_hal)
-        if len(matched_hal_id) > 1:
-            write_message("WARNING: record %s matches more than 1 HAL record: %s" % (recid, matched_hal), stream=sys.stderr)
+        if len(hal_ids) > 1:
+            write_message("WARNING: record %s matches more than 1 HAL record: %s" % (recid, sorted(hal_ids)), stream=sys.stderr)
             continue
-        elif not matched_hal:
-            continue
-        hal_id = matched_hal[0]['halId_s']
-
-        update_record(recid, hal_id, bibupload)
+        update_record(recid, hal_ids.pop(), bibupload)
 
     return True
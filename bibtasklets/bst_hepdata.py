@@ -17,12 +17,18 @@
 # along with INSPIRE; if not, write to the Free Software Foundation, Inc.,
 # 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
 
+import anydbm
+import json
+import marshal
 import os
 import shelve
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
+from collections import deque
+from hashlib import md5
+from multiprocessing.pool import ThreadPool
 from tempfile import mkstemp
 
 from invenio.config import CFG_TMPSHAREDDIR
@@ -34,12 +40,18 @@ from invenio.intbitset import intbitset
 from invenio.search_engine import perform_request_search
 
 
+# Old shelve of the full HEPData tables, only read to migrate to HEPDATA_HASHES
 HEPDATA_DUMP = os.path.join(CFG_TMPSHAREDDIR, 'hepdata_dump.bin')
+# DOI -> (content hash, inspire_id, position) of every HEPData table
+HEPDATA_HASHES = os.path.join(CFG_TMPSHAREDDIR, 'hepdata_hashes.marshal')
+HEPDATA_PAGE_SIZE = 200
+# Number of search pages requested at the same time
+HEPDATA_WINDOW = 4
 
 
-def bst_hepdata():
+def bst_hepdata(window=HEPDATA_WINDOW):
     uploader = ChunkedHepDataUpload()
-    dumper = HepDataDumper()
+    dumper = HepDataDumper(window=int(window))
     for record in dumper:
         marcxml_record = hepdata2marcxml(record)
         uploader.add(marcxml_record)
@@ -74,32 +86,45 @@ class ChunkedHepDataUpload(ChunkedTask):
 
         return task_low_level_submission(*args)
 
+
+def get_hepdata_session(pool_size=1):
+    retry_strategy = Retry(total=5,
+                           backoff_factor=2,
+                           status_forcelist=[429, 500, 502, 503, 504],
+                           method_whitelist=["GET", "POST"])
+    adapter = HTTPAdapter(max_retries=retry_strategy, pool_maxsize=pool_size)
+    s = requests.Session()
+    s.mount("https://", adapter)
+    s.headers.update({'Accept': 'application/json'})
+    return s
+
+
+def fetch_hepdata_page(session, page, size=HEPDATA_PAGE_SIZE):
+    resp = session.get("https://hepdata.net/search/", params=dict(size=size, page=page), timeout=60)
+    resp.raise_for_status()
+    return resp.json()['results']
+
+
+def hash_hepdata_record(record):
+    return md5(json.dumps(record, sort_keys=True)).hexdigest()
+
+
 class HepDataDumper(object):
-    def __init__(self):
-        self.old_dump = shelve.open(HEPDATA_DUMP, 'c', protocol=-1)
-        self.new_dump = shelve.open(HEPDATA_DUMP + '.new', 'n', protocol=-1)
+    """
+    Iterates over the HEPData tables which are new or were updated since
+    the previous run.
+
+    Search pages are fetched `window` at a time. Only a hash of every table
+    is kept from one run to the next.
+    """
+    def __init__(self, window=HEPDATA_WINDOW):
+        self.window = window
+        self.old_hashes = self._load_hashes()
+        self.new_hashes = {}
         self.inspire_ids = intbitset()
 
     def __iter__(self):
-        chunk_size = 200
-        page = 0
-
-        retry_strategy = Retry(total=5,
-                               backoff_factor=2,
-                               status_forcelist=[429, 500, 502, 503, 504],
-                               method_whitelist=["GET", "POST"])
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        s = requests.Session()
-        s.mount("https://", adapter)
-        s.headers.update({'Accept': 'application/json'})
-
-        while True:
-            page += 1
-            resp = s.get("https://hepdata.net/search/", params=dict(size=chunk_size, page=page), timeout=60)
-            resp.raise_for_status()
-            results = resp.json()['results']
-            if not results:
-                break
+        for results in self._iter_pages():
             for result in results:
                 result = json_unicode_to_utf8(result)
                 paper_title = result['title']
@@ -113,21 +138,68 @@ class HepDataDumper(object):
                         self._store_record_in_dump(data)
                         if self._is_hepdata_record_new_or_updated(data):
                             yield data
-        self._close_hepdata_dump()
-        self._swap_hepdata_dump()
+        self._save_hashes()
+
+    def _iter_pages(self):
+        """Yields the search pages in order, prefetching the next ones."""
+        session = get_hepdata_session(self.window)
+        pool = ThreadPool(self.window)
+        pending = deque()
+        page = 0
+        try:
+            while True:
+                while len(pending) < self.window:
+                    page += 1
+                    pending.append(pool.apply_async(fetch_hepdata_page, (session, page)))
+                results = pending.popleft().get()
+                if not results:
+                    break
+                yield results
+        finally:
+            pool.close()
+            pool.join()
 
     def _store_record_in_dump(self, record):
-        self.new_dump[record['doi']] = record
+        self.new_hashes[record['doi']] = (hash_hepdata_record(record),
+                                          record['inspire_id'],
+                                          record['position'])
 
     def _is_hepdata_record_new_or_updated(self, record):
-        return self.old_dump.get(record['doi'], {}) != record
-
-    def _close_hepdata_dump(self):
-        self.old_dump.close()
-        self.new_dump.close()
-
-    def _swap_hepdata_dump(self):
-        os.rename(HEPDATA_DUMP + '.new', HEPDATA_DUMP)
+        old = self.old_hashes.get(record['doi'])
+        return old is None or old[0] != self.new_hashes[record['doi']][0]
+
+    def _load_hashes(self):
+        try:
+            hashes_file = open(HEPDATA_HASHES, 'rb')
+            try:
+                return marshal.load(hashes_file)
+            finally:
+                hashes_file.close()
+        except IOError:
+            pass
+        # First run since the shelve dump: compute the hashes from it rather
+        # than uploading every table again
+        hashes = {}
+        try:
+            old_dump = shelve.open(HEPDATA_DUMP, 'r', protocol=-1)
+        except anydbm.error:
+            return hashes
+        try:
+            for doi, record in old_dump.iteritems():
+                hashes[doi] = (hash_hepdata_record(record),
+                               record['inspire_id'],
+                               record['position'])
+        finally:
+            old_dump.close()
+        return hashes
+
+    def _save_hashes(self):
+        hashes_file = open(HEPDATA_HASHES + '.new', 'wb')
+        try:
+            marshal.dump(self.new_hashes, hashes_file)
+        finally:
+            hashes_file.close()
+        os.rename(HEPDATA_HASHES + '.new', HEPDATA_HASHES)
 
 
 def hepdata2marcxml(record):
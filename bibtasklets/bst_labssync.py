@@ -24,6 +24,9 @@ import sys
 import redis
 import requests
 
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+
 from invenio.config import CFG_REDIS_HOST_LABS, CFG_LABS_HOSTNAME
 from invenio.bibtaskutils import ChunkedBibUpload
 from invenio.bibtask import write_message, task_sleep_now_if_required
@@ -33,18 +36,39 @@ from invenio.errorlib import register_exception
 
 
 CFG_REDIS_KEY = 'records_to_sync_into_legacy'
+# Records which could not be synced, they are tried again on the next run
+CFG_REDIS_RETRY_KEY = 'records_to_sync_into_legacy_retry'
+# Number of failed attempts in a row of every record in the retry set
+CFG_REDIS_ATTEMPTS_KEY = 'records_to_sync_into_legacy_attempts'
+# Records failing that many times in a row are given up
+CFG_LABSSYNC_MAX_ATTEMPTS = 5
+# Number of records popped from redis at once
+CFG_LABSSYNC_BATCH_SIZE = 100
+# Number of records downloaded from labs at the same time
+CFG_LABSSYNC_WORKERS = 8
+
+
+class LabsSyncError(Exception):
+    pass
 
 
-def bst_labssync():
+def bst_labssync(batch_size=CFG_LABSSYNC_BATCH_SIZE, workers=CFG_LABSSYNC_WORKERS,
+                 max_attempts=CFG_LABSSYNC_MAX_ATTEMPTS):
     """
     Synchronizes from Labs via redis.
 
+    @param batch_size: number of records popped from redis at once.
+    @param workers: number of records downloaded at the same time.
+    @param max_attempts: number of runs in a row a record may fail before
+        it is given up.
     """
     r = redis.StrictRedis.from_url(CFG_REDIS_HOST_LABS)
-    user_agent = make_user_agent_string('labssync')
-    s = requests.Session()
-    s.headers['User-Agent'] = user_agent
-    s.headers['Accept'] = 'application/marcxml+xml'
+    workers = int(workers)
+    s = get_labs_session(workers)
+
+    retried = requeue_failed_records(r)
+    if retried:
+        write_message("%s records which failed last time will be synced again" % retried)
 
     tot = r.scard(CFG_REDIS_KEY)
     if tot == 0:
@@ -53,26 +77,128 @@ def bst_labssync():
     else:
         write_message("At least %s records to synchronize from labs" % tot)
 
-    errors = []
-    final_total = 0
     uploader = ChunkedBibUpload(mode='r', user='labssync')
-    while True:
-        elem = r.spop(CFG_REDIS_KEY)
-        if not elem:
-            break
-        final_total += 1
-        try:
-            record = s.get("https://%s/api/%s" % (CFG_LABS_HOSTNAME, elem)).text
-
-            # Let's strip collection/XML header
-            record = record_xml_output(create_record(record)[0])
-            uploader.add(record)
-            task_sleep_now_if_required()
-        except Exception as err:
-            register_exception()
-            write_message("ERROR: when retrieving %s: %s" % (elem, err), stream=sys.stderr)
-            errors.append(elem)
+    final_total, errors = sync_records(r, s, uploader, "https://%s" % CFG_LABS_HOSTNAME,
+                                       int(batch_size), workers, int(max_attempts))
 
     write_message("Finally synced %s records from labs" % final_total)
     if errors:
-        write_message("All those %s records had errors and might need to be resynced: %s" % (len(errors), ', '.join(errors)))
+        write_message("All those %s records had errors and will be resynced on the next run: %s" % (len(errors), ', '.join(errors)))
+
+
+def get_labs_session(workers=CFG_LABSSYNC_WORKERS):
+    s = requests.Session()
+    s.headers['User-Agent'] = make_user_agent_string('labssync')
+    s.headers['Accept'] = 'application/marcxml+xml'
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+
+def requeue_failed_records(r):
+    """Moves the records which failed in a previous run back to the queue."""
+    pipe = r.pipeline()
+    pipe.scard(CFG_REDIS_RETRY_KEY)
+    pipe.sunionstore(CFG_REDIS_KEY, CFG_REDIS_KEY, CFG_REDIS_RETRY_KEY)
+    pipe.delete(CFG_REDIS_RETRY_KEY)
+    return pipe.execute()[0]
+
+
+def pop_records(r, batch_size):
+    """Pops up to batch_size records to sync in one round trip."""
+    pipe = r.pipeline(transaction=False)
+    for dummy in xrange(batch_size):
+        pipe.spop(CFG_REDIS_KEY)
+    return [elem for elem in pipe.execute() if elem]
+
+
+def strip_record(record):
+    """Returns the bare MARCXML record, without collection or XML header."""
+    if record.lstrip().startswith('<record'):
+        return record
+    return record_xml_output(create_record(record)[0])
+
+
+def fetch_record(s, labs_url, elem):
+    """
+    Returns the (elem, record) of the given record from labs, with record
+    None if it could not be retrieved.
+    """
+    try:
+        response = s.get("%s/api/%s" % (labs_url, elem))
+        response.raise_for_status()
+        return elem, strip_record(response.content)
+    except Exception as err:
+        register_exception()
+        write_message("ERROR: when retrieving %s: %s" % (elem, err), stream=sys.stderr)
+        return elem, None
+
+
+def count_failures(r, failed, synced, max_attempts=CFG_LABSSYNC_MAX_ATTEMPTS):
+    """
+    Adds the records which could not be retrieved to the retry set, unless
+    they already failed max_attempts times in a row. The count of the
+    records retrieved this time is reset.
+
+    @return: the list of records given up.
+    """
+    pipe = r.pipeline()
+    for elem in failed:
+        pipe.hincrby(CFG_REDIS_ATTEMPTS_KEY, elem, 1)
+    if synced:
+        pipe.hdel(CFG_REDIS_ATTEMPTS_KEY, *synced)
+    attempts = pipe.execute()[:len(failed)]
+    retry = [elem for elem, count in zip(failed, attempts) if count < max_attempts]
+    given_up = [elem for elem, count in zip(failed, attempts) if count >= max_attempts]
+    pipe = r.pipeline()
+    if retry:
+        pipe.sadd(CFG_REDIS_RETRY_KEY, *retry)
+    if given_up:
+        pipe.hdel(CFG_REDIS_ATTEMPTS_KEY, *given_up)
+    pipe.execute()
+    return given_up
+
+
+def sync_records(r, s, uploader, labs_url, batch_size=CFG_LABSSYNC_BATCH_SIZE,
+                 workers=CFG_LABSSYNC_WORKERS, max_attempts=CFG_LABSSYNC_MAX_ATTEMPTS):
+    """
+    Uploads the records to sync from labs, until there are none left.
+
+    Records which could not be retrieved are added to the retry set, or
+    reported and dropped after max_attempts failed runs in a row.
+
+    @return: the number of records popped and the list of the failed ones
+        which will be retried.
+    """
+    errors = []
+    final_total = 0
+    pool = ThreadPool(workers)
+    try:
+        while True:
+            elems = pop_records(r, batch_size)
+            if not elems:
+                break
+            final_total += len(elems)
+            failed = []
+            synced = []
+            for elem, record in pool.imap_unordered(lambda elem: fetch_record(s, labs_url, elem), elems):
+                if record is None:
+                    failed.append(elem)
+                else:
+                    uploader.add(record)
+                    synced.append(elem)
+            given_up = count_failures(r, failed, synced, max_attempts)
+            if given_up:
+                try:
+                    raise LabsSyncError("Giving up on %s records which failed %s times in a row: %s"
+                                        % (len(given_up), max_attempts, ', '.join(given_up)))
+                except LabsSyncError as err:
+                    register_exception(alert_admin=True)
+                    write_message("ERROR: %s" % (err,), stream=sys.stderr)
+            errors.extend([elem for elem in failed if elem not in given_up])
+            task_sleep_now_if_required()
+    finally:
+        pool.close()
+        pool.join()
+    return final_total, errors
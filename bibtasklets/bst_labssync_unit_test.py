@@ -0,0 +1,190 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##
+## This file is part of INSPIRE.
+## Copyright (C) 2026 CERN.
+##
+## INSPIRE is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## INSPIRE is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with INSPIRE; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Unit tests for bst_labssync.
+
+Redis is replaced by an in-memory fake and Labs by a local HTTP stub,
+nothing is uploaded.
+"""
+
+import re
+import unittest
+
+from invenio.httpstubutils import HTTPStubServer
+from invenio.bibsched_tasklets import bst_labssync as labssync
+
+LABS_RECORDS = {
+    '1': '<record><controlfield tag="001">1</controlfield></record>',
+    '2': '<record><controlfield tag="001">2</controlfield></record>',
+    '3': '<?xml version="1.0" encoding="UTF-8"?>\n<collection><record><controlfield tag="001">3</controlfield></record></collection>',
+}
+
+
+class FakeRedis(object):
+    """The set and hash commands used by bst_labssync, counting round trips."""
+    def __init__(self, **sets):
+        self.sets = dict((key, set(values)) for key, values in sets.items())
+        self.hashes = {}
+        self.round_trips = 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def _call(self, command, *args):
+        return getattr(self, '_' + command)(*args)
+
+    def _spop(self, key):
+        try:
+            return self.sets.get(key, set()).pop()
+        except KeyError:
+            return None
+
+    def _sadd(self, key, *values):
+        self.sets.setdefault(key, set()).update(values)
+        return len(values)
+
+    def _scard(self, key):
+        return len(self.sets.get(key, ()))
+
+    def _sunionstore(self, dest, *keys):
+        self.sets[dest] = set().union(*[self.sets.get(key, set()) for key in keys])
+        return len(self.sets[dest])
+
+    def _delete(self, key):
+        return int(self.sets.pop(key, None) is not None)
+
+    def _hincrby(self, key, field, amount):
+        values = self.hashes.setdefault(key, {})
+        values[field] = values.get(field, 0) + amount
+        return values[field]
+
+    def _hdel(self, key, *fields):
+        values = self.hashes.get(key, {})
+        return len([values.pop(field) for field in fields if field in values])
+
+    def __getattr__(self, command):
+        def call(*args):
+            self.round_trips += 1
+            return self._call(command, *args)
+        return call
+
+
+class FakePipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, command):
+        def call(*args):
+            self.commands.append((command, args))
+            return self
+        return call
+
+    def execute(self):
+        self.redis.round_trips += 1
+        return [self.redis._call(command, *args) for command, args in self.commands]
+
+
+class FakeUploader(object):
+    def __init__(self):
+        self.records = []
+
+    def add(self, record):
+        self.records.append(record)
+
+
+def respond(path):
+    """Serves LABS_RECORDS."""
+    match = re.match(r'^/api/(\w+)$', path)
+    if not match or match.group(1) not in LABS_RECORDS:
+        return 500, 'text/plain', ''
+    return 200, 'application/marcxml+xml', LABS_RECORDS[match.group(1)]
+
+
+class LabsSyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPStubServer(respond)
+        self.server.start()
+        self.url = self.server.url
+        self.register_exception = labssync.register_exception
+        self.exceptions = []
+        labssync.register_exception = lambda **kwargs: self.exceptions.append(kwargs)
+
+    def tearDown(self):
+        self.server.stop()
+        labssync.register_exception = self.register_exception
+
+    def test_pop_records(self):
+        """records are popped by batches in one round trip"""
+        r = FakeRedis(**{labssync.CFG_REDIS_KEY: ['1', '2', '3']})
+        self.assertEqual(sorted(labssync.pop_records(r, 2) + labssync.pop_records(r, 2)),
+                         ['1', '2', '3'])
+        self.assertEqual(labssync.pop_records(r, 2), [])
+        self.assertEqual(r.round_trips, 3)
+
+    def test_strip_record(self):
+        """bare records are kept as they are"""
+        self.assertEqual(labssync.strip_record(LABS_RECORDS['1']), LABS_RECORDS['1'])
+        self.failIf('collection' in labssync.strip_record(LABS_RECORDS['3']))
+
+    def test_sync_records(self):
+        """records are fetched in parallel and failures kept for a retry"""
+        r = FakeRedis(**{labssync.CFG_REDIS_KEY: ['1', '2', '3', '404']})
+        uploader = FakeUploader()
+        total, errors = labssync.sync_records(r, labssync.get_labs_session(2),
+                                              uploader, self.url,
+                                              batch_size=4, workers=2)
+        self.assertEqual(total, 4)
+        self.assertEqual(errors, ['404'])
+        self.assertEqual(len(uploader.records), 3)
+        self.assertEqual(self.server.max_in_flight, 2)
+        self.assertEqual(r.sets[labssync.CFG_REDIS_RETRY_KEY], set(['404']))
+
+        self.assertEqual(labssync.requeue_failed_records(r), 1)
+        self.assertEqual(r.sets[labssync.CFG_REDIS_KEY], set(['404']))
+        self.failIf(labssync.CFG_REDIS_RETRY_KEY in r.sets)
+
+    def test_give_up(self):
+        """records failing max_attempts runs in a row are dropped"""
+        r = FakeRedis(**{labssync.CFG_REDIS_KEY: ['1', '404']})
+        session = labssync.get_labs_session(2)
+        for dummy in range(2):
+            labssync.requeue_failed_records(r)
+            total, errors = labssync.sync_records(r, session, FakeUploader(), self.url,
+                                                  batch_size=2, workers=2,
+                                                  max_attempts=3)
+            self.assertEqual(errors, ['404'])
+        self.assertEqual(r.hashes[labssync.CFG_REDIS_ATTEMPTS_KEY], {'404': 2})
+
+        labssync.requeue_failed_records(r)
+        total, errors = labssync.sync_records(r, session, FakeUploader(), self.url,
+                                              batch_size=2, workers=2,
+                                              max_attempts=3)
+        self.assertEqual(total, 1)
+        self.assertEqual(errors, [])
+        self.failIf(r.sets.get(labssync.CFG_REDIS_RETRY_KEY))
+        self.assertEqual(r.hashes[labssync.CFG_REDIS_ATTEMPTS_KEY], {})
+        self.assertEqual(len([kwargs for kwargs in self.exceptions
+                              if kwargs.get('alert_admin')]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
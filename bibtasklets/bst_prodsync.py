@@ -24,6 +24,9 @@ import datetime
 import time
 import tarfile
 import os
+from collections import deque
+from itertools import imap, islice
+from multiprocessing import Pool
 
 from invenio.config import CFG_TMPSHAREDDIR
 
@@ -37,6 +40,7 @@ from invenio.dbquery import run_sql
 from invenio.dateutils import get_time_estimator
 
 from invenio.bibformat_engine import format_record
+from invenio.bibformat_elements.bfe_INSPIRE_enhanced_marcxml import prefetch_records
 
 from invenio.bibtask import task_update_progress, write_message, task_sleep_now_if_required
 
@@ -72,7 +76,7 @@ class run_ro_on_slave_db:
         dbquery.CFG_ACCESS_CONTROL_LEVEL_SITE = self.old_site_level
 
 
-def bst_prodsync(method='afs', with_citations='yes', with_claims='yes', skip_collections='', use_end_marker='no'):
+def bst_prodsync(method='afs', with_citations='yes', with_claims='yes', skip_collections='', use_end_marker='no', processes='0', chunk_size='100'):
     """
     Synchronize to either 'afs' or 'redis'
 
@@ -82,6 +86,9 @@ def bst_prodsync(method='afs', with_citations='yes', with_claims='yes', skip_col
         e.g. skip_collections='HEP,HEPNAMES,HEPHIDDEN'
     use_end_marker: yes/no, whether an explicit end marker should be used to allow atomic migration of the batch.
         This has an effect only if 'method' is 'redis'.
+    processes: number of worker processes formatting chunks of records in parallel.
+        With '0' the chunks are formatted in the task process.
+    chunk_size: number of records prefetched, formatted and pushed together.
     """
     if not CFG_REDIS_HOST_LABS:
         method = 'afs'
@@ -122,58 +129,57 @@ def bst_prodsync(method='afs', with_citations='yes', with_claims='yes', skip_col
     tot = len(modified_records)
     time_estimator = get_time_estimator(tot)
     write_message("Adding %s new or modified records" % tot)
+    processes = int(processes)
+    chunk_size = int(chunk_size)
     if method == 'afs':
-        afs_sync(reversed(modified_records), time_estimator, tot, now)
+        afs_sync(reversed(modified_records), time_estimator, tot, now, processes, chunk_size)
         open(lastrun_path, "w").write(future_lastrun)
         write_message("DONE!")
     else:
         end_marker = "END" if use_end_marker.lower() == "yes" else None
-        if redis_sync(reversed(modified_records), time_estimator, tot, end_marker):
+        if redis_sync(reversed(modified_records), time_estimator, tot, end_marker, processes, chunk_size):
             open(lastrun_path, "w").write(future_lastrun)
             write_message("DONE!")
         else:
             write_message("Skipping prodsync: Redis queue is not yet empty")
 
 
-def redis_sync(modified_records, time_estimator, tot, end_marker=None):
+def redis_sync(modified_records, time_estimator, tot, end_marker=None, processes=0, chunk_size=100):
     """Sync to redis."""
     r = redis.StrictRedis.from_url(CFG_REDIS_HOST_LABS)
     if r.llen('legacy_records') != 0:
         return False
-    for i, recid in enumerate(modified_records):
-        with run_ro_on_slave_db():
-            record = format_record(recid, 'xme', user_info=ADMIN_USER_INFO)[0]
-        if not record:
-            write_message("Error formatting record {0} as 'xme': {1}".format(
-                recid, record
-            ))
-        else:
-            r.rpush('legacy_records', zlib.compress(record))
-        if shall_sleep(recid, i, tot, time_estimator):
-            task_sleep_now_if_required()
+    i = 0
+    for chunk in format_chunks(modified_records, processes, chunk_size, compress=True):
+        payloads = []
+        for recid, record in chunk:
+            if record:
+                payloads.append(record)
+            if shall_sleep(recid, i, tot, time_estimator):
+                task_sleep_now_if_required()
+            i += 1
+        if payloads:
+            r.rpush('legacy_records', *payloads)
     if end_marker:
         r.rpush('legacy_records', end_marker)
     return True
 
 
-def afs_sync(modified_records, time_estimator, tot, now):
+def afs_sync(modified_records, time_estimator, tot, now, processes=0, chunk_size=100):
     """Sync to AFS."""
     write_message("Appending output to %s" % CFG_OUTPUT_PATH)
     prodsyncname = CFG_OUTPUT_PATH + now.strftime("%Y%m%d%H%M%S") + '.xml.gz'
     r = gzip.open(prodsyncname, "w")
     print >> r, '<collection xmlns="http://www.loc.gov/MARC21/slim">'
-    for i, recid in enumerate(modified_records):
-        with run_ro_on_slave_db():
-            record = format_record(recid, 'xme', user_info=ADMIN_USER_INFO)[0]
-        if not record:
-            write_message("Error formatting record {0} as 'xme': {1}".format(
-                recid, record
-            ))
-        else:
-            print >> r, record
-        if shall_sleep(recid, i, tot, time_estimator):
-            r.flush()
-            task_sleep_now_if_required()
+    i = 0
+    for chunk in format_chunks(modified_records, processes, chunk_size):
+        for recid, record in chunk:
+            if record:
+                print >> r, record
+            if shall_sleep(recid, i, tot, time_estimator):
+                r.flush()
+                task_sleep_now_if_required()
+            i += 1
     print >> r, '</collection>'
     r.close()
     prodsync_tarname = CFG_OUTPUT_PATH + '.tar'
@@ -184,6 +190,72 @@ def afs_sync(modified_records, time_estimator, tot, now):
     os.remove(prodsyncname)
 
 
+def format_chunks(modified_records, processes, chunk_size, compress=False):
+    """
+    Format modified_records in 'xme', chunk_size records at a time.
+
+    With processes > 0 the chunks are formatted by a pool of worker
+    processes, otherwise in the task process itself. The order of the
+    records is preserved and at most 2 * processes chunks are formatted
+    ahead of the consumer, so that a sleeping task does not pile up
+    formatted records in memory.
+
+    @return: generator of lists of (recid, formatted record)
+    """
+    def get_chunks():
+        iterator = iter(modified_records)
+        while True:
+            chunk = list(islice(iterator, chunk_size))
+            if not chunk:
+                return
+            yield chunk, compress
+
+    if processes > 0:
+        pool = Pool(processes)
+        pending = deque()
+        try:
+            for args in get_chunks():
+                pending.append(pool.apply_async(format_chunk, (args, )))
+                if len(pending) >= 2 * processes:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for chunk in imap(format_chunk, get_chunks()):
+            yield chunk
+
+
+def format_chunk(args):
+    """
+    Format a chunk of records in 'xme' using the slave DB.
+
+    The bibrec and signature rows needed by the 'xme' format element are
+    prefetched for the whole chunk. Records that cannot be formatted are
+    reported and returned as None.
+    """
+    recids, compress = args
+    ret = []
+    with run_ro_on_slave_db():
+        prefetch_records(recids)
+        for recid in recids:
+            record = format_record(recid, 'xme', user_info=ADMIN_USER_INFO)[0]
+            if not record:
+                write_message("Error formatting record {0} as 'xme': {1}".format(
+                    recid, record
+                ))
+                record = None
+            elif compress:
+                record = zlib.compress(record)
+            ret.append((recid, record))
+    return ret
+
+
 def shall_sleep(recid, i, tot, time_estimator):
     """Check if we shall sleep"""
     time_estimation = time_estimator()[1]
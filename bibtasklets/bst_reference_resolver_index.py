@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of INSPIRE.
+## Copyright (C) 2026 CERN.
+##
+## INSPIRE is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## INSPIRE is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with INSPIRE; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Build or update the reference resolver index used by the 'xme' format.
+"""
+
+import os
+
+from invenio.bibtask import write_message, task_update_progress
+from invenio.referenceresolver import CFG_REFERENCE_RESOLVER_INDEX, \
+    build_reference_resolver_index, update_reference_resolver_index
+
+
+def bst_reference_resolver_index(full='no'):
+    """
+    Update the reference resolver index with the records modified since
+    its last update.
+
+    full: yes/no, whether the index should be rebuilt from scratch.
+        This is always the case if it does not exist yet.
+    """
+    if full.lower() == 'yes' or not os.path.exists(CFG_REFERENCE_RESOLVER_INDEX):
+        task_update_progress("Building %s" % CFG_REFERENCE_RESOLVER_INDEX)
+        keys = build_reference_resolver_index()
+        write_message("Indexed %s identifiers in %s" % (keys, CFG_REFERENCE_RESOLVER_INDEX))
+    else:
+        task_update_progress("Updating %s" % CFG_REFERENCE_RESOLVER_INDEX)
+        modified = update_reference_resolver_index()
+        write_message("Reindexed %s modified records in %s" % (modified, CFG_REFERENCE_RESOLVER_INDEX))
+    write_message("DONE")
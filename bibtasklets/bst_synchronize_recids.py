@@ -32,6 +32,9 @@ Methodology:
  3b. If not, get the remote record and extract other identifiers. Do local
      searches by eprint, doi.
      -> If they can be found, append the remote ID to local record.
+
+The local 035 IDs are read once from the database, and the remote records
+are fetched by a few threads sharing one HTTP session.
 """
 
 import os
@@ -39,11 +42,18 @@ import time
 import traceback
 
 from cStringIO import StringIO
-from urllib2 import HTTPError
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from requests.packages.urllib3.util.retry import Retry
 
 from invenio.config import (CFG_TMPSHAREDDIR,
                             CFG_CERN_SITE, CFG_INSPIRE_SITE)
-from invenio.search_engine import perform_request_search
+from invenio.dbquery import run_sql
+from invenio.intbitset import intbitset
+from invenio.recidindexutils import get_tag_values
 from invenio.bibtask import (write_message,
                              task_update_progress,
                              task_sleep_now_if_required)
@@ -51,7 +61,6 @@ from invenio.bibrecord import (record_add_field, record_add_subfield_into,
                                record_xml_output, create_record,
                                record_get_field_values)
 from invenio.invenio_connector import InvenioConnector
-from invenio.filedownloadutils import download_url, InvenioFileDownloadError
 from invenio.bibtaskutils import ChunkedBibUpload
 
 # LOOK AT ALL THE LOVELY VARIABLES!
@@ -60,6 +69,10 @@ NOW = time.strftime('%Y-%m-%d_%Hh%Mm%Ss')
 LOG_DIR = CFG_TMPSHAREDDIR
 LOG_FILE = "%s_%s.log" % (SCRIPT_NAME, NOW)
 BATCH_SIZE = 400
+# Number of remote records downloaded at the same time
+REMOTE_WORKERS = 4
+# Here we are taking a rest, in seconds, after each download
+REMOTE_REST = 0.5
 
 if CFG_INSPIRE_SITE:
     LOCAL_INSTANCE = "Inspire"
@@ -82,7 +95,7 @@ elif CFG_CERN_SITE:
 # Begin!
 def bst_synchronize_recids(search_terms=SEARCH_TERMS, log_dir=None,
                            collection=COLLECTION, batch_size=BATCH_SIZE,
-                           debug=False, remote_ids=None):
+                           debug=False, remote_ids=None, workers=REMOTE_WORKERS):
     """Synchronize record IDs between the CERN Document Server (CDS) and Inspire
 
 This BibTasklet is intended to be a general purpose replacement for
@@ -108,7 +121,11 @@ Parameters:
          (Default false)
  remote_ids - Comma seperated values of remote IDs, if this is
               specified, remote IDs will not be searched for.
+ workers - How many remote records to download at the same time
+           (Default 4)
     """
+    batch_size = int(batch_size)
+    workers = int(workers)
     configure_globals(search_terms, log_dir, debug)
     _print("All messages will be logged to %s/%s" % (LOG_DIR, LOG_FILE))
 
@@ -120,10 +137,15 @@ Parameters:
         remote_ids = [int(rid) for rid in remote_ids.split(',')]
 
     task_sleep_now_if_required(can_stop_too=True)
+    task_update_progress("Reading local %s IDs" % (REMOTE_INSTANCE,))
+    local_recids = get_local_recids()
+    id_map = get_local_id_map(local_recids)
+
     task_update_progress("Matching remote IDs to local records")
-    missing_ids = match_remote_ids(remote_ids)
+    missing_ids = match_remote_ids(remote_ids, id_map)
 
-    count_appends, count_problems = match_missing_ids(missing_ids, batch_size)
+    count_appends, count_problems = match_missing_ids(missing_ids, batch_size,
+                                                      local_recids, workers)
 
     _print("======================== FINAL SCORE ========================", 1)
     _print(" Records matched: %d" % (len(remote_ids)-len(missing_ids)), 1)
@@ -230,32 +252,66 @@ def generate_marc_to_append(local, remote):
 
 # =========================| Minor Functions |=========================
 
-def get_remote_record(recid):
+def get_remote_session(workers=REMOTE_WORKERS):
+    """ Returns an HTTP session keeping up to `workers` connections to the
+    remote instance open, retrying failed downloads """
+    session = requests.Session()
+    retry_strategy = Retry(total=10,
+                           backoff_factor=1,
+                           status_forcelist=[500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers,
+                          max_retries=retry_strategy)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_remote_record(recid, session=None, remote_url=None):
     """ For a given remote record ID, we download the record XML and return
     the record in a BibRecord structure
     Parameter:
     (int) recid - record ID for remote record
+    (Session) session - the HTTP session to use
+    (string) remote_url - the remote instance, defaults to REMOTE_URL
     Returns: BibRecord
     """
-    url = "%s/record/%d/export/xm?ot=001,035" % (REMOTE_URL, recid)
-    tmp_file = ''
+    url = "%s/record/%d/export/xm?ot=001,035" % (remote_url or REMOTE_URL,
+                                                recid)
+    if session is None:
+        session = get_remote_session(1)
     try:
-        bibrec = None
-        tmp_file = download_url(url, retry_count=10, timeout=61.0)
-        with open(tmp_file, 'r') as temp:
-            content = temp.read()
-            bibrec, code, errors = create_record(content)
-            if code != 1 or errors:
-                _print("Warning: There were errors creating BibRec structure " +
-                       "from remote record #%d" % recid, 4)
-        os.remove(tmp_file)
+        response = session.get(url, timeout=61.0)
+        response.raise_for_status()
+        bibrec, code, errors = create_record(response.content)
+        if code != 1 or errors:
+            _print("Warning: There were errors creating BibRec structure " +
+                   "from remote record #%d" % recid, 4)
         return bibrec
-    except (StandardError, InvenioFileDownloadError, HTTPError) as err:
+    except (StandardError, RequestException) as err:
         _print("Error: Could not download remote record #%d" % recid, 4)
         _print(str(err), 4)
         _print(traceback.format_exc(), 4)
 
 
+def get_remote_records(recids, session, workers=REMOTE_WORKERS,
+                       remote_url=None):
+    """ Downloads the given remote records, at most `workers` at a time
+    Returns: {remote recid: BibRecord or None if it could not be fetched}
+    """
+    def fetch(recid):
+        _print("Processing recid %d" % recid, 9)
+        record = get_remote_record(recid, session, remote_url)
+        time.sleep(REMOTE_REST)
+        return record
+
+    pool = ThreadPool(workers)
+    try:
+        return dict(zip(recids, pool.map(fetch, recids)))
+    finally:
+        pool.close()
+        pool.join()
+
+
 def extract_035_id(record):
     """ Gets the value of the 035__a field
     Parameters:
@@ -279,13 +335,33 @@ def extract_035_id(record):
         _print(exc.message, 5)
 
 
-def local_record_exists(recid):
-    """ Checks if the given record exists locally """
-    query = "001:%s" % (recid,)
-    _print("Querying local server: %s" % (query,), 5)
-    result = perform_request_search(p=query, of='id')
-    _print("Result: %s" % (result,), 5)
-    return bool(result)
+def get_local_recids():
+    """ Returns the intbitset of the local records, deleted ones excluded """
+    deleted = intbitset([recid for recid, value in get_tag_values('980__c')
+                         if value.upper() == 'DELETED'])
+    return intbitset(run_sql("SELECT id FROM bibrec")) - deleted
+
+
+def get_local_id_map(local_recids):
+    """ Reads all the local 035 fields pointing to the remote instance
+    Parameters:
+     (intbitset) local_recids - the records to consider
+    Returns: {remote recid: intbitset of local recids}
+    """
+    query = """SELECT bb9.id_bibrec, ba.value
+        FROM bibrec_bib03x AS bb9
+        JOIN bib03x AS b9 ON bb9.id_bibxxx=b9.id
+        JOIN bibrec_bib03x AS bba ON bba.id_bibrec=bb9.id_bibrec
+                                 AND bba.field_number=bb9.field_number
+        JOIN bib03x AS ba ON bba.id_bibxxx=ba.id
+        WHERE b9.tag='035__9' AND b9.value=%s AND ba.tag='035__a'"""
+    id_map = {}
+    for recid, value in run_sql(query, (REMOTE_INSTANCE,)):
+        if value.isdigit() and recid in local_recids:
+            id_map.setdefault(int(value), intbitset()).add(recid)
+    _print("Found %d local records with %s IDs"
+           % (len(intbitset().union(*id_map.values())), REMOTE_INSTANCE))
+    return id_map
 
 
 # =========================| Major Functions |=========================
@@ -307,34 +383,19 @@ def get_remote_ids(search_terms, collection=''):
     return recids
 
 
-def match_remote_ids(remote_ids):
+def match_remote_ids(remote_ids, id_map=None):
     """ Matches remote IDs to local records, IDs that cannot be matched
     are returned as a list."""
-    per_last = -1
-
-    def percent_update(index, percent_last):
-        """ Calculates completion percentage, updates task progress """
-        per = 100 * float(index)/float(len(remote_ids))
-        if per > (percent_last + 0.5):
-            percent_last = per
-            task_update_progress("Local matching %.1f%% (%d/%d)"
-                                 % (per, index, len(remote_ids)))
-        return percent_last
-
-    missing = []
-    for i, recid in enumerate(remote_ids):
-        task_sleep_now_if_required(can_stop_too=True)
-        per_last = percent_update(i, per_last)
-        term = "035__9:%s and 035__a:%d" % (REMOTE_INSTANCE, recid)
-        result = perform_request_search(p=term)
-        if not result:
-            missing.append(recid)
+    if id_map is None:
+        id_map = get_local_id_map(get_local_recids())
+    missing = sorted(set(remote_ids) - set(id_map))
     _print("Of %d record IDs, %d were matched, %d are missing"
            % (len(remote_ids), (len(remote_ids) - len(missing)), len(missing)))
     return missing
 
 
-def match_missing_ids(remote_ids, batch_size):
+def match_missing_ids(remote_ids, batch_size, local_recids=None,
+                      workers=REMOTE_WORKERS):
     """ For ID pairings that are missing, this function splits the missing
     IDs into batches. The records are pulled from remote, the 035 field read
     and then the remote ID appended to the local record.
@@ -342,12 +403,17 @@ def match_missing_ids(remote_ids, batch_size):
     Parameters:
      remote_ids - a list of missing remote rec-ids
      batch_size - How many records to match at a time
+     local_recids - intbitset of the existing local records
+     workers - How many remote records to download at the same time
     Returns:
      count_appends - number of records being appended
      count_problems - number of records which could not be matched at all
     """
     count_appends = 0
     count_problems = 0
+    if local_recids is None:
+        local_recids = get_local_recids()
+    session = get_remote_session(workers)
 
     batches = [remote_ids[x:x+batch_size] for x in
                xrange(0, len(remote_ids), batch_size)]
@@ -359,7 +425,8 @@ def match_missing_ids(remote_ids, batch_size):
         task_update_progress("Batch %d of %d" % (i, len(batches)))
         _print("Batch %d of %d" % (i, len(batches)))
         try:
-            appends, problems = process_record_batch(batch)
+            appends, problems = process_record_batch(batch, local_recids,
+                                                     session, workers)
             count_appends += len(appends)
             count_problems += len(problems)
             write_to_file('missing_ids.txt', problems, append=True)
@@ -371,34 +438,40 @@ def match_missing_ids(remote_ids, batch_size):
     return count_appends, count_problems
 
 
-def process_record_batch(batch):
+def process_record_batch(batch, local_recids, session=None,
+                         workers=REMOTE_WORKERS):
     """ Splitting the matching remotely job into parts, function does the
     matching of remote records to local IDs """
     _print("Processing batch, recid #%d to #%d" % (batch[0], batch[-1]), 4)
+    task_sleep_now_if_required(can_stop_too=True)
+    if session is None:
+        session = get_remote_session(workers)
+    records = get_remote_records(batch, session, workers)
+
+    # Remote ID: Local ID, for the remote records we could fetch
+    local_ids = {}
+    for recid in batch:
+        if records[recid] is None:
+            _print("Error: Could not fetch remote record %s" % (str(recid),), 5)
+            continue
+        local_ids[recid] = extract_035_id(records[recid])
+    found = intbitset([int(local_id) for local_id in local_ids.values()
+                       if local_id]) & local_recids
+
     # Local ID: Remote ID
     appends = {}
     problems = []
     for recid in batch:
-        task_sleep_now_if_required(can_stop_too=True)
-
-        # Here we are taking a rest
-        time.sleep(0.5)
-
-        _print("Processing recid %d" % recid, 9)
-        record = get_remote_record(recid)
-        if record is None:
-            _print("Error: Could not fetch remote record %s" % (str(recid),), 5)
+        if recid not in local_ids:
             continue
+        local_id = local_ids[recid]
+        if not local_id or int(local_id) not in found:
+            _print("Local record does not exist", 5)
+            problems.append(recid)
         else:
-            local_id = extract_035_id(record)
-            if not local_record_exists(local_id):
-                _print("Local record does not exist", 5)
-                problems.append(recid)
-                continue
-            else:
-                _print("Matching remote id %d to local record %s"
-                       % (recid, local_id), 5)
-                appends[local_id] = recid
+            _print("Matching remote id %d to local record %s"
+                   % (recid, local_id), 5)
+            appends[local_id] = recid
     _print("Batch matching done: %d IDs matched, %d IDs not matched"
            % (len(appends), len(problems)), 4)
     return appends, problems
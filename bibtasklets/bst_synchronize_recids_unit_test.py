@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##
+## This file is part of INSPIRE.
+## Copyright (C) 2026 CERN.
+##
+## INSPIRE is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## INSPIRE is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with INSPIRE; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Unit tests for bst_synchronize_recids.
+
+Remote records are served by a local HTTP stub, nothing is uploaded.
+"""
+
+import re
+import unittest
+
+from invenio.httpstubutils import HTTPStubServer
+from invenio.intbitset import intbitset
+from invenio.bibsched_tasklets import bst_synchronize_recids as sync
+
+REMOTE_RECORDS = {
+    1: 101,
+    2: 102,
+    3: 999999,
+}
+
+RECORD_XML = """<record>
+  <controlfield tag="001">%d</controlfield>
+  <datafield tag="035" ind1=" " ind2=" ">
+    <subfield code="9">%s</subfield>
+    <subfield code="a">%d</subfield>
+  </datafield>
+</record>"""
+
+
+def respond(path):
+    """Serves REMOTE_RECORDS."""
+    match = re.match(r'^/record/(\d+)/export/xm', path)
+    recid = match and int(match.group(1))
+    if recid not in REMOTE_RECORDS:
+        return 404, 'text/plain', ''
+    return 200, 'text/xml', RECORD_XML % (recid, sync.LOCAL_INSTANCE,
+                                          REMOTE_RECORDS[recid])
+
+
+class SynchronizeRecidsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPStubServer(respond)
+        self.server.start()
+        self.url = self.server.url
+        self.rest = sync.REMOTE_REST
+        sync.REMOTE_REST = 0
+        self.remote_url = sync.REMOTE_URL
+        sync.REMOTE_URL = self.url
+
+    def tearDown(self):
+        self.server.stop()
+        sync.REMOTE_REST = self.rest
+        sync.REMOTE_URL = self.remote_url
+
+    def test_get_remote_records(self):
+        """remote records are downloaded in parallel, within the limit"""
+        session = sync.get_remote_session(2)
+        records = sync.get_remote_records([1, 2, 3, 4], session, workers=2,
+                                          remote_url=self.url)
+        self.assertEqual(sorted(records.keys()), [1, 2, 3, 4])
+        self.assertEqual(records[4], None)
+        self.assertEqual(sync.extract_035_id(records[1]), '101')
+        self.assertEqual(self.server.max_in_flight, 2)
+
+    def test_match_remote_ids(self):
+        """remote IDs without a local 035 are missing"""
+        id_map = {1: intbitset([101]), 5: intbitset([105])}
+        self.assertEqual(sync.match_remote_ids([3, 1, 2], id_map), [2, 3])
+
+    def test_process_record_batch(self):
+        """remote IDs are appended to the existing local records only"""
+        appends, problems = sync.process_record_batch(
+            [1, 2, 3, 4], intbitset([101, 102]),
+            sync.get_remote_session(2), workers=2)
+        self.assertEqual(appends, {'101': 1, '102': 2})
+        self.assertEqual(problems, [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
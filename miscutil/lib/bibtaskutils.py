@@ -1,10 +1,12 @@
 import os
+import json
 import time
+import datetime
 
 from tempfile import mkstemp
 
 from invenio.dbquery import run_sql
-from invenio.config import CFG_TMPSHAREDDIR
+from invenio.config import CFG_TMPSHAREDDIR, CFG_LOGDIR
 from invenio.bibtask import (task_low_level_submission,
                              task_sleep_now_if_required)
 
@@ -81,25 +83,154 @@ def submit_refextract_task(to_update, user, priority=3):
                                      '--id', ','.join(recids))
 
 
+def bibsched_task_finished(task_id):
+    from invenio.bibsched import bibsched_task_finished as task_finished
+    return task_finished(task_id)
+
+
+def bibsched_task_started(task_id):
+    """Tell whether bibsched has started running the given task."""
+    res = run_sql("SELECT status FROM schTASK WHERE id=%s", (task_id, ))
+    # Tasks which are not in schTASK any more have been archived
+    return not res or res[0][0] not in ('WAITING', 'SCHEDULED')
+
+
 class ChunkedTask(object):
-    """Groups elements in chunks before submitting them to bibsched"""
+    """
+    Groups elements in chunks before submitting them to bibsched
+
+    Up to max_in_flight chunks are left running in bibsched while the next
+    ones are being built: add() only waits for a task to finish when that
+    limit is hit, and cleanup() waits for all of them. The stats attribute
+    counts the chunks queued (submitted), in flight and completed, and the
+    seconds spent waiting for them.
+
+    A chunk is closed when it has chunk_size elements or, if
+    max_chunk_bytes is set, when its elements add up to that many bytes.
+    If target_duration is set, chunk_size is adapted after every task so
+    that a task lasts about target_duration seconds, from the observed
+    time per record. The tasks in flight are polled at most every
+    poll_interval seconds, also while elements are added, and a task runs
+    from the poll before the one that sees it started to the poll that
+    sees it finished: the time spent queued in bibsched does not count.
+    Every completed chunk is logged as one JSON line to telemetry_log,
+    which is rotated to telemetry_log.1 when it exceeds
+    telemetry_max_bytes.
+
+    All these class attributes can be overridden by keyword arguments.
+    """
     chunk_size = 500
     submitter = None
+    max_in_flight = 1
+    max_chunk_bytes = None
+    target_duration = None
+    min_chunk_size = 10
+    max_chunk_size = 10000
+    telemetry_log = os.path.join(CFG_LOGDIR, 'chunkedtask_telemetry.jsonl')
+    telemetry_max_bytes = 10 * 1024 * 1024
+    poll_interval = 5
+    task_started = staticmethod(bibsched_task_started)
+    task_finished = staticmethod(bibsched_task_finished)
+    clock = staticmethod(time.time)
 
     def __init__(self, *args, **kwargs):
+        for name in ('chunk_size', 'max_in_flight', 'max_chunk_bytes',
+                     'target_duration', 'min_chunk_size', 'max_chunk_size',
+                     'telemetry_log', 'telemetry_max_bytes', 'poll_interval'):
+            if name in kwargs:
+                setattr(self, name, kwargs.pop(name))
         self.args = args
         self.kwargs = kwargs
         self.to_submit = []
+        self.to_submit_bytes = 0
+        self.in_flight = []
+        self.last_poll = self.clock()
+        self.stats = {'queued': 0,
+                      'in_flight': 0,
+                      'completed': 0,
+                      'wait_time': 0.0}
+
+    def sleep(self):
+        task_sleep_now_if_required()
+        time.sleep(self.poll_interval)
+
+    def poll_tasks(self):
+        """Check which tasks in flight have started and finished."""
+        now = self.clock()
+        running = []
+        for chunk in self.in_flight:
+            if chunk['started'] is None and self.task_started(chunk['task_id']):
+                # It started since the previous poll
+                chunk['started'] = max(chunk['submitted'], self.last_poll)
+            if chunk['started'] is not None and self.task_finished(chunk['task_id']):
+                self.chunk_done(chunk, now - chunk['started'])
+            else:
+                running.append(chunk)
+        self.last_poll = now
+        self.stats['completed'] += len(self.in_flight) - len(running)
+        self.in_flight = running
+        self.stats['in_flight'] = len(running)
+
+    def wait_for_tasks(self, max_in_flight):
+        """Wait until at most max_in_flight submitted tasks are running."""
+        start = self.clock()
+        while len(self.in_flight) > max_in_flight:
+            self.poll_tasks()
+            if len(self.in_flight) > max_in_flight:
+                self.sleep()
+        self.stats['wait_time'] += self.clock() - start
+
+    def chunk_done(self, chunk, run_time):
+        """Adapt the chunk size to the task that just finished, and log it."""
+        records_per_second = run_time and chunk['size'] / run_time or 0.0
+        if self.target_duration and records_per_second:
+            wanted = int(self.target_duration * records_per_second)
+            # Move half way only, one odd task should not decide alone
+            self.chunk_size = max(self.min_chunk_size,
+                                  min(self.max_chunk_size,
+                                      (self.chunk_size + wanted) // 2))
+        if self.telemetry_log:
+            line = json.dumps({'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                               'task': self.__class__.__name__,
+                               'task_id': chunk['task_id'],
+                               'size': chunk['size'],
+                               'bytes': chunk['bytes'],
+                               'run_time': round(run_time, 1),
+                               'records_per_second': round(records_per_second, 2),
+                               'next_chunk_size': self.chunk_size})
+            try:
+                if os.path.exists(self.telemetry_log) and \
+                   os.path.getsize(self.telemetry_log) > self.telemetry_max_bytes:
+                    os.rename(self.telemetry_log, self.telemetry_log + '.1')
+                telemetry = open(self.telemetry_log, 'a')
+                telemetry.write(line + '\n')
+                telemetry.close()
+            except (IOError, OSError):
+                # Telemetry must never stop the task
+                pass
 
     def submit_task(self, to_submit):
         if self.submitter is None:
             raise Exception('Task submitter not defined')
+        self.wait_for_tasks(self.max_in_flight - 1)
         task_id = self.submitter(to_submit, *self.args, **self.kwargs)
-        wait_for_task(task_id)
+        self.in_flight.append({'task_id': task_id,
+                               'size': len(to_submit),
+                               'bytes': self.to_submit_bytes,
+                               'submitted': self.clock(),
+                               'started': None})
+        self.to_submit_bytes = 0
+        self.stats['queued'] += 1
+        self.stats['in_flight'] = len(self.in_flight)
 
     def add(self, el):
+        if self.in_flight and self.clock() - self.last_poll >= self.poll_interval:
+            self.poll_tasks()
         self.to_submit.append(el)
-        if len(self.to_submit) == self.chunk_size:
+        if isinstance(el, basestring):
+            self.to_submit_bytes += len(el)
+        if len(self.to_submit) >= self.chunk_size or \
+           (self.max_chunk_bytes and self.to_submit_bytes >= self.max_chunk_bytes):
             to_submit = self.to_submit
             self.to_submit = []
             self.submit_task(to_submit)
@@ -109,6 +240,7 @@ class ChunkedTask(object):
             to_submit = self.to_submit
             self.to_submit = []
             self.submit_task(to_submit)
+        self.wait_for_tasks(0)
 
     def __del__(self):
         self.cleanup()
@@ -116,6 +248,8 @@ class ChunkedTask(object):
 
 class ChunkedBibUpload(ChunkedTask):
     submitter = staticmethod(submit_bibupload_task)
+    # Big records (thousands of authors) make for big uploads
+    max_chunk_bytes = 50 * 1024 * 1024
 
 
 class ChunkedBibIndex(ChunkedTask):
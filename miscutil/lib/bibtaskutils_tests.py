@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of INSPIRE.
+## Copyright (C) 2026 CERN.
+##
+## INSPIRE is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## INSPIRE is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with INSPIRE; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+The bibtaskutils unit test suite
+
+The tests do not submit anything to bibsched.
+"""
+
+import json
+import os
+import unittest
+from tempfile import mkstemp
+from invenio.testutils import make_test_suite, run_test_suite
+from invenio.bibtaskutils import ChunkedTask
+
+
+class FakeBibsched(object):
+    """
+    Tasks start after being polled `queued` times, and then finish after
+    being polled `duration` more times.
+    """
+    def __init__(self, duration, queued=0):
+        self.duration = duration
+        self.queued = queued
+        self.polls = {}
+        self.submitted = []
+
+    def submit(self, to_submit):
+        self.submitted.append(list(to_submit))
+        task_id = len(self.submitted)
+        self.polls[task_id] = 0
+        return task_id
+
+    def started(self, task_id):
+        self.polls[task_id] += 1
+        return self.polls[task_id] > self.queued
+
+    def finished(self, task_id):
+        self.polls[task_id] += 1
+        return self.polls[task_id] > self.queued + self.duration
+
+    def running(self):
+        return len([task_id for task_id, polls in self.polls.items()
+                    if polls <= self.queued + self.duration])
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_chunked_task(bibsched, clock=None, **kwargs):
+    class FakeChunkedTask(ChunkedTask):
+        chunk_size = 2
+        submitter = staticmethod(bibsched.submit)
+        task_started = staticmethod(bibsched.started)
+        task_finished = staticmethod(bibsched.finished)
+        telemetry_log = None
+
+        def sleep(self):
+            if clock is not None:
+                clock.now += self.poll_interval
+    if clock is not None:
+        FakeChunkedTask.clock = staticmethod(clock)
+    return FakeChunkedTask(**kwargs)
+
+
+class ChunkedTaskTest(unittest.TestCase):
+    def test_waits_for_each_chunk_by_default(self):
+        bibsched = FakeBibsched(duration=3)
+        task = make_chunked_task(bibsched)
+        for el in range(5):
+            task.add(el)
+            self.assertTrue(bibsched.running() <= 1)
+        task.cleanup()
+        self.assertEqual([[0, 1], [2, 3], [4]], bibsched.submitted)
+        self.assertEqual(3, task.stats['completed'])
+
+    def test_chunks_in_flight(self):
+        bibsched = FakeBibsched(duration=3)
+        task = make_chunked_task(bibsched, max_in_flight=3)
+        for el in range(6):
+            task.add(el)
+        self.assertEqual(3, bibsched.running())
+        self.assertEqual(3, task.stats['in_flight'])
+        self.assertEqual(0, task.stats['completed'])
+        # The fourth chunk waits for a slot, all three tasks end together
+        task.add(6)
+        task.add(7)
+        self.assertEqual(1, task.stats['in_flight'])
+        self.assertEqual(3, task.stats['completed'])
+        self.assertEqual(4, task.stats['queued'])
+        task.cleanup()
+        self.assertEqual(0, bibsched.running())
+        self.assertEqual(0, task.stats['in_flight'])
+        self.assertEqual(4, task.stats['completed'])
+
+
+class AdaptiveChunkedTaskTest(unittest.TestCase):
+    def test_chunk_bytes(self):
+        bibsched = FakeBibsched(duration=0)
+        task = make_chunked_task(bibsched, chunk_size=100, max_chunk_bytes=10)
+        for el in ['abcd', 'efgh', 'ijkl', 'mn', 'op']:
+            task.add(el)
+        task.cleanup()
+        self.assertEqual([['abcd', 'efgh', 'ijkl'], ['mn', 'op']], bibsched.submitted)
+
+    def test_chunk_size_follows_target_duration(self):
+        task = make_chunked_task(FakeBibsched(duration=0), chunk_size=100,
+                                 target_duration=60)
+        # 10 records per second: 600 records would take a minute
+        task.chunk_done({'task_id': 1, 'size': 100, 'bytes': 0}, 10.0)
+        self.assertEqual(350, task.chunk_size)
+        task.chunk_done({'task_id': 2, 'size': 350, 'bytes': 0}, 35.0)
+        self.assertEqual(475, task.chunk_size)
+        # Very slow tasks do not shrink chunks below min_chunk_size
+        task.chunk_done({'task_id': 3, 'size': 475, 'bytes': 0}, 100000.0)
+        task.chunk_done({'task_id': 4, 'size': 238, 'bytes': 0}, 100000.0)
+        self.assertTrue(task.chunk_size >= task.min_chunk_size)
+
+    def test_chunk_size_bounds(self):
+        bibsched = FakeBibsched(duration=0)
+        task = make_chunked_task(bibsched, chunk_size=100, target_duration=60,
+                                 max_chunk_size=200)
+        # Very fast tasks do not grow chunks beyond max_chunk_size
+        task.chunk_done({'task_id': 1, 'size': 100, 'bytes': 0}, 1.0)
+        self.assertEqual(200, task.chunk_size)
+        # The bounds are not passed on to the submitter
+        task.add(0)
+        task.cleanup()
+        self.assertEqual([[0]], bibsched.submitted)
+
+    def test_run_time(self):
+        """the time spent queued in bibsched does not count"""
+        clock = FakeClock()
+        task = make_chunked_task(FakeBibsched(duration=3, queued=5), clock,
+                                 poll_interval=10)
+        run_times = []
+        task.chunk_done = lambda chunk, run_time: run_times.append(run_time)
+        task.add(0)
+        task.add(1)
+        task.cleanup()
+        # Seen started at the 6th poll, so it started after the 5th, and
+        # finished two polls later; the five polls in the queue do not count
+        self.assertEqual([30.0], run_times)
+
+    def test_polls_while_adding(self):
+        """finished tasks are noticed by add() as well"""
+        clock = FakeClock()
+        bibsched = FakeBibsched(duration=0)
+        task = make_chunked_task(bibsched, clock, max_in_flight=2, poll_interval=10)
+        task.add(0)
+        task.add(1)
+        self.assertEqual(1, task.stats['in_flight'])
+        clock.now += 10
+        task.add(2)
+        self.assertEqual(0, task.stats['in_flight'])
+        self.assertEqual(1, task.stats['completed'])
+
+    def test_telemetry_rotation(self):
+        temp_fd, telemetry_log = mkstemp()
+        os.close(temp_fd)
+        task = make_chunked_task(FakeBibsched(duration=0), telemetry_log=telemetry_log,
+                                 telemetry_max_bytes=300)
+        for task_id in range(3):
+            task.chunk_done({'task_id': task_id, 'size': 50, 'bytes': 1000}, 5.0)
+        lines = open(telemetry_log).readlines()
+        rotated = open(telemetry_log + '.1').readlines()
+        os.unlink(telemetry_log)
+        os.unlink(telemetry_log + '.1')
+        self.assertEqual(1, len(lines))
+        self.assertEqual(2, len(rotated))
+
+    def test_telemetry(self):
+        temp_fd, telemetry_log = mkstemp()
+        os.close(temp_fd)
+        task = make_chunked_task(FakeBibsched(duration=0), telemetry_log=telemetry_log)
+        task.chunk_done({'task_id': 7, 'size': 50, 'bytes': 1000}, 5.0)
+        lines = open(telemetry_log).readlines()
+        os.unlink(telemetry_log)
+        self.assertEqual(1, len(lines))
+        entry = json.loads(lines[0])
+        self.assertEqual(7, entry['task_id'])
+        self.assertEqual(1000, entry['bytes'])
+        self.assertEqual(10.0, entry['records_per_second'])
+
+
+TEST_SUITE = make_test_suite(ChunkedTaskTest, AdaptiveChunkedTaskTest)
+
+if __name__ == '__main__':
+    run_test_suite(TEST_SUITE)
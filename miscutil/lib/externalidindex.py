@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of INSPIRE.
+## Copyright (C) 2026 CERN.
+##
+## INSPIRE is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## INSPIRE is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with INSPIRE; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Match identifiers of external systems to INSPIRE records.
+
+The external ID index maps CDS record IDs (035 with $9 CDS, 595 CDS-<id>),
+Zenodo record IDs (035 with $9 Zenodo, Data collection only), DOIs (0247)
+and arXiv identifiers (037) to the recids carrying them, deleted records
+excepted. It is written to CFG_EXTERNAL_ID_INDEX by bst_external_id_index
+and used by the harvesting filters to tell new records from known ones
+without searching. The filters bring it up to date with
+refresh_external_id_index() when they start, so that a record missing from
+the index is really not in INSPIRE.
+"""
+
+import datetime
+import os
+
+from invenio.config import CFG_CACHEDIR
+from invenio.intbitset import intbitset
+from invenio.search_engine import get_collection_reclist
+from invenio.recidindexutils import get_field_values, get_tag_values, \
+    get_modified_recids, build_hashed_index, update_hashed_index, HashedIndexFile
+from invenio.referenceresolver import normalize_doi
+
+CFG_EXTERNAL_ID_INDEX = os.path.join(CFG_CACHEDIR, 'external_ids.idx')
+
+EXTERNAL_ID_KINDS = ('cds', 'zenodo', 'doi', 'arxiv')
+
+
+def normalize_arxiv_id(arxiv_id):
+    arxiv_id = arxiv_id.strip().lower()
+    if arxiv_id.startswith('arxiv:'):
+        arxiv_id = arxiv_id[len('arxiv:'):]
+    return arxiv_id
+
+
+def external_id_key(kind, value):
+    """Return the index key of an external identifier of the given kind."""
+    value = str(value).strip()
+    if kind == 'doi':
+        value = normalize_doi(value)
+    elif kind == 'arxiv':
+        value = normalize_arxiv_id(value)
+    return '%s:%s' % (kind, value)
+
+
+def get_external_id_keys(recids=None):
+    """
+    Return the (key, recid) pairs of the external ID index for the given
+    records, or for all the records if recids is None. Deleted records are
+    left out, as by the searches the index replaces.
+    """
+    keys = []
+    data = intbitset(get_collection_reclist('Data'))
+    fields = {}
+    for recid, field_number, tag, value in get_field_values(['035__9', '035__a'], recids):
+        fields.setdefault((recid, field_number), {})[tag[-1]] = value
+    for (recid, dummy), subfields in fields.iteritems():
+        if 'a' not in subfields:
+            continue
+        source = subfields.get('9', '').lower()
+        if source == 'cds':
+            keys.append((external_id_key('cds', subfields['a']), recid))
+        elif source == 'zenodo' and recid in data:
+            keys.append((external_id_key('zenodo', subfields['a']), recid))
+
+    for recid, value in get_tag_values('595__a', recids):
+        if value.startswith('CDS-'):
+            keys.append((external_id_key('cds', value[len('CDS-'):]), recid))
+
+    for recid, value in get_tag_values('0247_a', recids):
+        keys.append((external_id_key('doi', value), recid))
+
+    for recid, value in get_tag_values('037__a', recids):
+        keys.append((external_id_key('arxiv', value), recid))
+
+    deleted = set(recid for recid, value in get_tag_values('980__c', recids)
+                  if value.upper() == 'DELETED')
+    return [(key, recid) for key, recid in keys if recid not in deleted]
+
+
+def build_external_id_index(path=CFG_EXTERNAL_ID_INDEX):
+    """Build the external ID index from scratch."""
+    now = datetime.datetime.now()
+    pairs = get_external_id_keys()
+    build_hashed_index(path, pairs, now)
+    return len(pairs)
+
+
+def update_external_id_index(path=CFG_EXTERNAL_ID_INDEX):
+    """
+    Update the external ID index with the records modified since it was built.
+
+    @return: the number of modified records.
+    """
+    now = datetime.datetime.now()
+    index = HashedIndexFile(path)
+    modified = get_modified_recids(index.last_updated)
+    index.close()
+    update_hashed_index(path, modified, get_external_id_keys(modified), now)
+    return len(modified)
+
+
+def refresh_external_id_index(path=CFG_EXTERNAL_ID_INDEX):
+    """
+    Update the external ID index with the records modified since its last
+    update and return it, or None if it was never built.
+    """
+    if not os.path.exists(path):
+        return None
+    update_external_id_index(path)
+    return get_external_id_index()
+
+
+_INDEX = []
+def get_external_id_index():
+    """Return the shared external ID index, or None if it was never built."""
+    if not _INDEX:
+        if not os.path.exists(CFG_EXTERNAL_ID_INDEX):
+            return None
+        _INDEX.append(HashedIndexFile(CFG_EXTERNAL_ID_INDEX))
+    index = _INDEX[0]
+    index.reopen_if_changed()
+    return index
+
+
+def match_external_ids(kind, values, index=None):
+    """
+    Match many external identifiers of the same kind in one go.
+
+    @return: dictionary of every given value to the intbitset of the
+             records carrying it (empty if none).
+    """
+    if index is None:
+        index = get_external_id_index()
+    return dict((value, index.get(external_id_key(kind, value))) for value in values)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of INSPIRE.
+## Copyright (C) 2026 CERN.
+##
+## INSPIRE is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## INSPIRE is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with INSPIRE; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Local HTTP server standing in for remote services in unit tests.
+
+    def respond(path):
+        return 200, 'text/xml', '<record/>'
+
+    server = HTTPStubServer(respond, delay=0.05)
+    server.start()
+    ... requests to server.url ...
+    server.stop()
+
+The server answers requests in parallel and records when each of them was
+served, so that tests can check how many were sent at the same time.
+"""
+
+import threading
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+
+class HTTPStubServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves what respond(path) returns, a (status, content type, body)
+    tuple, after waiting `delay` seconds.
+    """
+    daemon_threads = True
+
+    def __init__(self, respond, delay=0.05):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _StubHandler)
+        self.respond = respond
+        self.delay = delay
+        self.url = 'http://127.0.0.1:%d' % (self.server_address[1],)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        # (start, end) time of every request, in the order they started
+        self.requests = []
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            position = len(server.requests)
+            server.requests.append((time.time(), None))
+        try:
+            # Keep the request open long enough for concurrent clients to
+            # send theirs
+            time.sleep(server.delay)
+            status, content_type, body = server.respond(self.path)
+            if status != 200:
+                self.send_error(status)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+                server.requests[position] = (server.requests[position][0], time.time())
+
+    def log_message(self, *args):
+        pass
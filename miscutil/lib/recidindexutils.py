@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of INSPIRE.
+## Copyright (C) 2026 CERN.
+##
+## INSPIRE is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## INSPIRE is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with INSPIRE; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Indexes mapping MARC field values to record IDs.
+
+They are built with a handful of queries straight on the bibxxx tables and
+are meant to replace one perform_request_search per looked up value in
+batch jobs and format elements.
+
+RecidIndex lives in memory. HashedIndexFile is its on-disk counterpart for
+the big indexes spanning the whole HEP collection: a sorted array of
+(64 bit key hash, recid) entries which is mmapped and probed by binary
+search, so that many processes can share it without loading it.
+"""
+
+import datetime
+import heapq
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict
+from hashlib import md5
+from tempfile import mkstemp
+
+from invenio.dbquery import run_sql
+from invenio.intbitset import intbitset
+from invenio.search_engine import get_collection_reclist, search_pattern
+
+
+def get_tag_values(tag, recids=None, chunk_size=1000):
+    """
+    Return the (recid, value) pairs of the given MARC tag, e.g. '110__u'.
+
+    If recids is given, only the values of these records are returned.
+    """
+    bibxxx = 'bib%sx' % tag[0:2]
+    bibrec_bibxxx = 'bibrec_' + bibxxx
+    query = "SELECT bb.id_bibrec, b.value FROM %s AS bb JOIN %s AS b ON bb.id_bibxxx=b.id WHERE b.tag=%%s" % (bibrec_bibxxx, bibxxx)
+    if recids is None:
+        return run_sql(query, (tag, ))
+    ret = []
+    recids = list(recids)
+    for i in xrange(0, len(recids), chunk_size):
+        chunk = recids[i:i + chunk_size]
+        ret.extend(run_sql(query + " AND bb.id_bibrec IN (%s)" % ','.join(['%s'] * len(chunk)), tuple([tag] + chunk)))
+    return ret
+
+
+def get_field_values(tags, recids=None, chunk_size=1000):
+    """
+    Return the (recid, field_number, tag, value) rows of the given tags.
+
+    Rows with the same recid and field_number belong to the same field
+    instance. All the tags must share the same bibxxx table, e.g.
+    ['773__p', '773__v', '773__c'].
+    """
+    bibxxx = 'bib%sx' % tags[0][0:2]
+    bibrec_bibxxx = 'bibrec_' + bibxxx
+    query = "SELECT bb.id_bibrec, bb.field_number, b.tag, b.value FROM %s AS bb JOIN %s AS b ON bb.id_bibxxx=b.id WHERE b.tag IN (%s)" % (bibrec_bibxxx, bibxxx, ','.join(['%s'] * len(tags)))
+    if recids is None:
+        return run_sql(query, tuple(tags))
+    ret = []
+    recids = list(recids)
+    for i in xrange(0, len(recids), chunk_size):
+        chunk = recids[i:i + chunk_size]
+        ret.extend(run_sql(query + " AND bb.id_bibrec IN (%s)" % ','.join(['%s'] * len(chunk)), tuple(list(tags) + chunk)))
+    return ret
+
+
+def get_modified_recids(since):
+    """Return the records modified since the given datetime."""
+    return intbitset(run_sql("SELECT id FROM bibrec WHERE modification_date>=%s", (since.strftime('%Y-%m-%d %H:%M:%S'), )))
+
+
+def normalize_value(value):
+    """Default key normalization: case and surrounding spaces do not matter."""
+    return value.strip().lower()
+
+
+class LRUCache(object):
+    """A dictionary holding at most maxsize keys, evicting the least recently used."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        value = self.data.pop(key)
+        self.data[key] = value
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+
+
+class RecidIndex(object):
+    """
+    Map the normalized values of some MARC tags to the records having them.
+
+    The index is restricted to a collection or to the result of a search
+    pattern. Keys carried by a single record are stored as plain integers
+    and only ambiguous keys hold an intbitset, which keeps the structure
+    compact. refresh() only re-reads the records modified since the
+    previous load.
+    """
+
+    def __init__(self, tags, collection=None, pattern=None, normalize=normalize_value):
+        self.tags = tags
+        self.collection = collection
+        self.pattern = pattern
+        self.normalize = normalize
+        self.index = {}
+        self.record_keys = {}
+        self.last_updated = None
+        self.last_refresh = 0
+
+    def get_reclist(self):
+        """Return the records the index is restricted to."""
+        if self.pattern is not None:
+            return search_pattern(p=self.pattern)
+        if self.collection is not None:
+            return intbitset(get_collection_reclist(self.collection))
+        return intbitset(run_sql("SELECT id FROM bibrec"))
+
+    def load(self):
+        """Build the whole index from scratch."""
+        now = datetime.datetime.now()
+        self.index = {}
+        self.record_keys = {}
+        self._add_values(self.get_reclist(), dict((tag, get_tag_values(tag)) for tag in self.tags))
+        self.last_updated = now
+        self.last_refresh = time.time()
+
+    def refresh(self):
+        """Update the index with the records modified since the last load."""
+        if self.last_updated is None:
+            return self.load()
+        now = datetime.datetime.now()
+        modified = get_modified_recids(self.last_updated)
+        for recid in modified:
+            for key in self.record_keys.pop(recid, ()):
+                self._remove(key, recid)
+        if modified:
+            self._add_values(self.get_reclist() & modified, dict((tag, get_tag_values(tag, modified)) for tag in self.tags))
+        self.last_updated = now
+        self.last_refresh = time.time()
+
+    def refresh_if_older_than(self, seconds):
+        """
+        Refresh the index if it was loaded more than seconds ago.
+
+        @return: True if the index was (re)loaded.
+        """
+        if self.last_updated is None:
+            self.load()
+        elif time.time() - self.last_refresh > seconds:
+            self.refresh()
+        else:
+            return False
+        return True
+
+    def _add_values(self, reclist, values):
+        record_keys = {}
+        for tag in self.tags:
+            for recid, value in values[tag]:
+                if recid not in reclist:
+                    continue
+                key = self.normalize(value)
+                if not key:
+                    continue
+                keys = record_keys.setdefault(recid, set())
+                if key in keys:
+                    continue
+                keys.add(key)
+                self._add(key, recid)
+        for recid, keys in record_keys.iteritems():
+            self.record_keys[recid] = tuple(keys)
+
+    def _add(self, key, recid):
+        current = self.index.get(key)
+        if current is None:
+            self.index[key] = recid
+        elif isinstance(current, intbitset):
+            current.add(recid)
+        elif current != recid:
+            self.index[key] = intbitset([current, recid])
+
+    def _remove(self, key, recid):
+        current = self.index.get(key)
+        if current is None:
+            return
+        if isinstance(current, intbitset):
+            current.discard(recid)
+            if len(current) == 1:
+                self.index[key] = current[0]
+        elif current == recid:
+            del self.index[key]
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, value):
+        """Return the intbitset of the records having value."""
+        current = self.index.get(self.normalize(value))
+        if current is None:
+            return intbitset()
+        if isinstance(current, intbitset):
+            return intbitset(current)
+        return intbitset([current])
+
+    def get_unique(self, value):
+        """Return the only record having value, or None if there are zero or many."""
+        current = self.index.get(self.normalize(value))
+        if current is None or isinstance(current, intbitset):
+            return None
+        return current
+
+
+HASHED_INDEX_MAGIC = 'RECIDX01'
+HASHED_INDEX_HEADER = struct.Struct('<8sQ19s5x')
+HASHED_INDEX_ENTRY = struct.Struct('<QI')
+
+
+def hash_key(key):
+    """Return the 64 bit hash under which key is stored in a HashedIndexFile."""
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return struct.unpack('<Q', md5(key).digest()[:8])[0]
+
+
+def write_hashed_index(path, entries, count, last_updated):
+    """
+    Write a HashedIndexFile at path.
+
+    entries must be count (key hash, recid) pairs sorted by hash and recid.
+    The file is written aside and then renamed, so that readers never see
+    it half written, nor concurrent writers each other's file.
+    """
+    fd, tmp_path = mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                           dir=os.path.dirname(path) or '.')
+    out = os.fdopen(fd, 'wb')
+    out.write(HASHED_INDEX_HEADER.pack(HASHED_INDEX_MAGIC, count, last_updated.strftime('%Y-%m-%d %H:%M:%S')))
+    written = 0
+    previous = None
+    for entry in entries:
+        if entry == previous:
+            continue
+        out.write(HASHED_INDEX_ENTRY.pack(*entry))
+        previous = entry
+        written += 1
+    if written != count:
+        # Fewer entries than announced (duplicates or dropped records)
+        out.seek(0)
+        out.write(HASHED_INDEX_HEADER.pack(HASHED_INDEX_MAGIC, written, last_updated.strftime('%Y-%m-%d %H:%M:%S')))
+    out.close()
+    # Readable by every process, as a file created with open() would be
+    os.chmod(tmp_path, 0644)
+    os.rename(tmp_path, path)
+
+
+def build_hashed_index(path, pairs, last_updated):
+    """Write at path a new HashedIndexFile holding the given (key, recid) pairs."""
+    # A single long per entry is much lighter than a tuple when sorting
+    # millions of them.
+    entries = sorted(set((hash_key(key) << 32) | recid for key, recid in pairs))
+    write_hashed_index(path, ((entry >> 32, entry & 0xffffffff) for entry in entries), len(entries), last_updated)
+
+
+def update_hashed_index(path, modified, pairs, last_updated):
+    """
+    Update the HashedIndexFile at path with the records in modified.
+
+    The existing entries of these records are dropped and replaced by the
+    given (key, recid) pairs. The old and new entries are merged as sorted
+    streams, so only the new entries are held in memory.
+    """
+    old = HashedIndexFile(path)
+    new_entries = sorted(set((hash_key(key), recid) for key, recid in pairs))
+    kept_entries = ((key_hash, recid) for key_hash, recid in old.iter_entries() if recid not in modified)
+    count = len(old) + len(new_entries)
+    write_hashed_index(path, heapq.merge(kept_entries, new_entries), count, last_updated)
+    old.close()
+
+
+class HashedIndexFile(object):
+    """
+    Read-only access to an on-disk index written by build_hashed_index().
+
+    Entries sharing the same key hash are adjacent, so a key carried by
+    several records is detected by looking at the neighbours of the first
+    match.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.mmap = None
+        self.count = 0
+        self.last_updated = None
+        self.open()
+
+    def open(self):
+        index_file = open(self.path, 'rb')
+        self.mtime = os.fstat(index_file.fileno()).st_mtime
+        try:
+            self.mmap = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            index_file.close()
+        magic, self.count, last_updated = HASHED_INDEX_HEADER.unpack_from(self.mmap, 0)
+        if magic != HASHED_INDEX_MAGIC:
+            raise ValueError("%s is not a recid index file" % self.path)
+        self.last_updated = datetime.datetime.strptime(last_updated, '%Y-%m-%d %H:%M:%S')
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+    def reopen_if_changed(self):
+        """Reopen the file if it was replaced since it was opened."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime != self.mtime:
+            self.close()
+            self.open()
+
+    def __len__(self):
+        return self.count
+
+    def _entry(self, position):
+        return HASHED_INDEX_ENTRY.unpack_from(self.mmap, HASHED_INDEX_HEADER.size + position * HASHED_INDEX_ENTRY.size)
+
+    def iter_entries(self):
+        for position in xrange(self.count):
+            yield self._entry(position)
+
+    def get(self, key):
+        """Return the intbitset of the records having key."""
+        key_hash = hash_key(key)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle)[0] < key_hash:
+                low = middle + 1
+            else:
+                high = middle
+        ret = intbitset()
+        while low < self.count:
+            entry_hash, recid = self._entry(low)
+            if entry_hash != key_hash:
+                break
+            ret.add(recid)
+            low += 1
+        return ret
+
+    def get_unique(self, key):
+        """Return the only record having key, or None if there are zero or many."""
+        recids = self.get(key)
+        if len(recids) == 1:
+            return recids[0]
+        return None
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of INSPIRE.
+## Copyright (C) 2026 CERN.
+##
+## INSPIRE is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## INSPIRE is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with INSPIRE; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Resolve references to HEP records without querying the search engine.
+
+The resolver index maps normalized DOIs, pubnotes (journal, volume, first
+page), report numbers and ISBNs of the HEP collection to their recids. It
+is written to CFG_REFERENCE_RESOLVER_INDEX by bst_reference_resolver_index
+and shared by every process through HashedIndexFile.
+
+The records modified since the last update of the file are read straight
+from the database by ReferenceResolver, which completes the file with
+them, so callers can trust a miss.
+"""
+
+import datetime
+import os
+import re
+import time
+
+from invenio.config import CFG_CACHEDIR
+from invenio.intbitset import intbitset
+from invenio.search_engine import get_collection_reclist
+from invenio.recidindexutils import get_field_values, get_tag_values, \
+    get_modified_recids, build_hashed_index, update_hashed_index, HashedIndexFile
+
+CFG_REFERENCE_RESOLVER_INDEX = os.path.join(CFG_CACHEDIR, 'reference_resolver.idx')
+
+# Re-read the records modified since the last update of the index at most
+# once every CFG_REFERENCE_RESOLVER_RECENT_INTERVAL seconds.
+CFG_REFERENCE_RESOLVER_RECENT_INTERVAL = 300
+
+RE_SPACES = re.compile(r'\s+')
+RE_DOI_PREFIX = re.compile(r'^(doi:|https?://(dx\.)?doi\.org/)', re.I)
+
+
+def normalize_doi(doi):
+    return RE_DOI_PREFIX.sub('', doi.strip()).lower()
+
+
+def normalize_pubnote(journal, volume, page):
+    """Pubnotes are matched on the journal, volume and first page."""
+    page = page.split('-')[0]
+    return RE_SPACES.sub('', '%s,%s,%s' % (journal, volume, page)).lower()
+
+
+def normalize_reportnumber(reportnumber):
+    reportnumber = RE_SPACES.sub('', reportnumber).lower()
+    if reportnumber.startswith('arxiv:'):
+        reportnumber = reportnumber[len('arxiv:'):]
+    return reportnumber
+
+
+def normalize_isbn(isbn):
+    return isbn.replace('-', '').replace(' ', '').lower()
+
+
+def get_reference_keys(recids=None):
+    """
+    Return the (key, recid) pairs of the resolver index for the given
+    records, or for all the records if recids is None.
+    """
+    keys = []
+    fields = {}
+    for recid, field_number, tag, value in get_field_values(['0247_a', '0247_2'], recids):
+        fields.setdefault((recid, field_number), {})[tag[-1]] = value
+    for (recid, dummy), subfields in fields.iteritems():
+        doi = subfields.get('a')
+        if doi and (subfields.get('2', '').upper() == 'DOI' or doi.startswith('10.')):
+            keys.append(('doi:' + normalize_doi(doi), recid))
+
+    fields = {}
+    for recid, field_number, tag, value in get_field_values(['773__p', '773__v', '773__c'], recids):
+        fields.setdefault((recid, field_number), {})[tag[-1]] = value
+    for (recid, dummy), subfields in fields.iteritems():
+        if 'p' in subfields and 'v' in subfields and 'c' in subfields:
+            keys.append(('pubnote:' + normalize_pubnote(subfields['p'], subfields['v'], subfields['c']), recid))
+
+    for tag in ('037__a', '088__a'):
+        for recid, value in get_tag_values(tag, recids):
+            keys.append(('repno:' + normalize_reportnumber(value), recid))
+
+    for recid, value in get_tag_values('020__a', recids):
+        keys.append(('isbn:' + normalize_isbn(value), recid))
+    return keys
+
+
+def build_reference_resolver_index(path=CFG_REFERENCE_RESOLVER_INDEX):
+    """Build the resolver index from scratch in one pass over HEP."""
+    now = datetime.datetime.now()
+    hep = intbitset(get_collection_reclist('HEP'))
+    pairs = [(key, recid) for key, recid in get_reference_keys() if recid in hep]
+    build_hashed_index(path, pairs, now)
+    return len(pairs)
+
+
+def update_reference_resolver_index(path=CFG_REFERENCE_RESOLVER_INDEX):
+    """
+    Update the resolver index with the records modified since it was built.
+
+    @return: the number of modified records.
+    """
+    now = datetime.datetime.now()
+    resolver = HashedIndexFile(path)
+    modified = get_modified_recids(resolver.last_updated)
+    resolver.close()
+    hep = intbitset(get_collection_reclist('HEP'))
+    pairs = get_reference_keys(modified & hep)
+    update_hashed_index(path, modified, pairs, now)
+    return len(modified)
+
+
+class ReferenceResolver(object):
+    """
+    The resolver index file, completed with the keys of the HEP records
+    modified since its last update.
+    """
+
+    def __init__(self, path=CFG_REFERENCE_RESOLVER_INDEX):
+        self.index = HashedIndexFile(path)
+        self.recent_since = None
+        self.recent_checked = 0
+        self.recent_recids = intbitset()
+        self.recent_keys = {}
+
+    def refresh(self):
+        """
+        Reopen the index file if it was replaced, and re-read the records
+        modified since its last update if they are outdated.
+        """
+        self.index.reopen_if_changed()
+        if self.recent_since == self.index.last_updated and \
+           time.time() - self.recent_checked < CFG_REFERENCE_RESOLVER_RECENT_INTERVAL:
+            return
+        modified = get_modified_recids(self.index.last_updated)
+        hep = intbitset(get_collection_reclist('HEP'))
+        recent_keys = {}
+        for key, recid in get_reference_keys(modified & hep):
+            recent_keys.setdefault(key, intbitset()).add(recid)
+        self.recent_recids = modified
+        self.recent_keys = recent_keys
+        self.recent_since = self.index.last_updated
+        self.recent_checked = time.time()
+
+    def get(self, key):
+        """Return the intbitset of the records having key."""
+        recids = self.index.get(key)
+        if self.recent_recids:
+            # The index file may be outdated for these
+            recids -= self.recent_recids
+        return recids | self.recent_keys.get(key, intbitset())
+
+    def get_unique(self, key):
+        """Return the only record having key, or None if there are zero or many."""
+        recids = self.get(key)
+        if len(recids) == 1:
+            return recids[0]
+        return None
+
+
+_RESOLVER = []
+def get_reference_resolver():
+    """Return the shared resolver, or None if its index was never built."""
+    if not _RESOLVER:
+        if not os.path.exists(CFG_REFERENCE_RESOLVER_INDEX):
+            return None
+        _RESOLVER.append(ReferenceResolver(CFG_REFERENCE_RESOLVER_INDEX))
+    resolver = _RESOLVER[0]
+    resolver.refresh()
+    return resolver
+
+
+def resolve_citation_element(resolver, citation_element):
+    """
+    Return the recid the given refextract citation element points to.
+
+    Identifiers are tried in the same order as the search based matching:
+    DOI, pubnote, report number and ISBN. Only unambiguous matches count.
+    """
+    if 'doi_string' in citation_element:
+        recid = resolver.get_unique('doi:' + normalize_doi(citation_element['doi_string']))
+        if recid:
+            return recid
+    if 'journal_title' in citation_element:
+        recid = resolver.get_unique('pubnote:' + normalize_pubnote(citation_element['journal_title'],
+                                                                   citation_element['volume'],
+                                                                   citation_element['page']))
+        if recid:
+            return recid
+    if 'report_num' in citation_element:
+        recid = resolver.get_unique('repno:' + normalize_reportnumber(citation_element['report_num']))
+        if recid:
+            return recid
+    if 'ISBN' in citation_element:
+        recid = resolver.get_unique('isbn:' + normalize_isbn(citation_element['ISBN']))
+        if recid:
+            return recid
+    return None